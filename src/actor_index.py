@@ -0,0 +1,201 @@
+import argparse
+import json
+import os
+import pandas as pd
+
+from bs4 import BeautifulSoup, SoupStrainer
+from concurrent.futures import ThreadPoolExecutor
+from wikipedia_scraper import CACHE_DIR, Page_Cache, create_session, fetch_cached
+
+
+thisfile_path = os.path.dirname(os.path.abspath(__file__))
+project_path = os.path.abspath(os.path.join(thisfile_path, os.pardir))
+
+METADATA_PATH = os.path.join(project_path, 'data', 'metadata', 'movies_metadata.json')
+INDEX_PATH = os.path.join(project_path, 'data', 'metadata', 'actor_index.csv')
+ACTOR_RACE_PATH = os.path.join(project_path, 'data', 'actor_race.csv')
+ACTORS_LIST_PATH = os.path.join(project_path, 'data', 'actors.csv')
+
+INDEX_COLUMNS = ['key', 'name', 'page_title', 'birth_date', 'not_white', 'source']
+
+# Source of the entries whose page could not be fetched, crawled again on the
+# next run; until then they hold the guess from the name alone
+FAILED_SOURCE = 'fetch_failed'
+
+# The page title and the birth date are all that is read from an actor page
+ACTOR_STRAINER = SoupStrainer(['title', 'span'])
+
+
+def actor_key(name, url):
+    '''
+    Index key of an actor: the wikipedia url, or the name for actors
+    listed without a link
+    '''
+    return url if url else 'name:' + name
+
+
+def read_cast(metadata_path=METADATA_PATH):
+    '''
+    One row per (movie, actor) from the scraped metadata, in cast order
+    '''
+    with open(metadata_path, 'r', encoding='utf-8') as read_file:
+        metadata = json.load(read_file)
+
+    rows = [
+        (int(film_id), film['title'], actor, actor_key(actor, url))
+        for film_id, film in metadata.items()
+        for actor, url in zip(film['actors'], film['actors_urls'])
+    ]
+
+    return pd.DataFrame(rows, columns=['index', 'movie_title', 'actors', 'key'])
+
+
+def read_nonwhite_names(actors_list_path=ACTORS_LIST_PATH):
+    '''
+    Names of the wikipedia list of non-white actors, cleaned the same way as
+    in actor_df.ipynb: first two words, up to a bracket or a dash
+    '''
+    names = pd.read_csv(actors_list_path, on_bad_lines='skip', encoding='utf-8-sig')['actor_id']
+    names = names.str.split(' ').str[:2].str.join(' ').str.extract(r'(^[^\(|^\-]+)')[0]
+
+    return set(names.dropna())
+
+
+def load_index(index_path=INDEX_PATH):
+
+    if not os.path.exists(index_path):
+        return pd.DataFrame(columns=INDEX_COLUMNS)
+
+    return pd.read_csv(index_path, sep=';', dtype={'birth_date': object})
+
+
+def save_index(index, index_path=INDEX_PATH):
+
+    tmp_path = index_path + '.tmp'
+    index.sort_values('key').to_csv(tmp_path, sep=';', index=False)
+    os.replace(tmp_path, index_path)
+
+
+def seed_index(cast, actor_race_path=ACTOR_RACE_PATH):
+    '''
+    Index entries for the actors labelled by hand in actor_race.csv, matched to
+    their urls through the movie and the position in its cast (the names of
+    actor_race.csv went through a latin-1 decoding and do not always match)
+    '''
+    labels = pd.read_csv(actor_race_path, sep=';')
+    labels['position'] = labels.groupby('index').cumcount()
+    cast = cast.assign(position=cast.groupby('index').cumcount())
+    seeded = cast.merge(labels[['index', 'position', 'not_white']], on=['index', 'position'])
+
+    return pd.DataFrame({
+        'key': seeded['key'],
+        'name': seeded['actors'],
+        'page_title': None,
+        'birth_date': None,
+        'not_white': seeded['not_white'],
+        'source': 'actor_race',
+    }).drop_duplicates('key')
+
+
+def parse_actor_page(html_text):
+    '''
+    Page title and birth date (or None) from the html of an actor page
+    '''
+    soup = BeautifulSoup(html_text, features='lxml', parse_only=ACTOR_STRAINER)
+
+    title = soup.find('title')
+    page_title = title.string.rsplit(' - Wikipedia', 1)[0] if title is not None else None
+    bday = soup.find('span', attrs={'class': 'bday'})
+    birth_date = bday.string if bday is not None else None
+
+    return page_title, birth_date
+
+
+def crawl_actor(session, cache, key, name, nonwhite_names):
+
+    page_title, birth_date = None, None
+    source = 'actors_list'
+
+    if not key.startswith('name:'):
+        html_text, _ = fetch_cached(session, cache, key)
+        if html_text is not None:
+            page_title, birth_date = parse_actor_page(html_text)
+        else:
+            source = FAILED_SOURCE
+
+    not_white = int(name in nonwhite_names or page_title in nonwhite_names)
+
+    return key, name, page_title, birth_date, not_white, source
+
+
+def update_index(cast, index, cache_dir=CACHE_DIR, workers=8):
+    '''
+    Crawl the actors of cast that are not in the index yet or whose page
+    could not be fetched before, each url once however many films it appears
+    in, and return the extended index
+    '''
+    index = index[index['source'] != FAILED_SOURCE]
+    new_actors = (cast[~cast['key'].isin(index['key'])]
+                  .drop_duplicates('key')[['key', 'actors']])
+
+    print(f'{cast["key"].nunique() - len(new_actors)} actors already indexed, crawling {len(new_actors)}')
+
+    if len(new_actors) == 0:
+        return index
+
+    nonwhite_names = read_nonwhite_names()
+    session = create_session(workers)
+    cache = Page_Cache(cache_dir)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        rows = list(executor.map(
+            lambda actor: crawl_actor(session, cache, actor[0], actor[1], nonwhite_names),
+            zip(new_actors['key'], new_actors['actors'])))
+
+    session.close()
+
+    crawled = pd.DataFrame(rows, columns=INDEX_COLUMNS)
+
+    n_failed = int((crawled['source'] == FAILED_SOURCE).sum())
+    if n_failed > 0:
+        print(f'{n_failed} actor pages could not be fetched, they are crawled again on the next run')
+
+    return pd.concat([index, crawled], ignore_index=True)
+
+
+def cast_labels(cast, index):
+    '''
+    Cast of every movie with its not_white label, same columns as actor_race.csv
+    '''
+    labelled = cast.merge(index[['key', 'not_white']], on='key', how='left')
+
+    return labelled[['index', 'movie_title', 'actors', 'not_white']]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Crawl the actors of the scraped films into the actor index')
+    parser.add_argument('--metadata', default=METADATA_PATH)
+    parser.add_argument('--index', default=INDEX_PATH)
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    cast = read_cast(args.metadata)
+    index = load_index(args.index)
+
+    # the hand made labels take precedence over the crawled ones
+    if len(index) == 0 and os.path.exists(ACTOR_RACE_PATH):
+        index = seed_index(cast)
+
+    index = update_index(cast, index, args.cache_dir, args.workers)
+    save_index(index, args.index)
+
+    labels = cast_labels(cast, index)
+    print(f'{len(index)} actors indexed, {int(labels["not_white"].sum())} of '
+          f'{len(labels)} cast members not white')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+import argparse
+import glob
+import os
+import time
+import numpy as np
+import pandas as pd
+
+from sentiment_analysis import (
+    Roberta_Sentiment,
+    fixed_size_batches,
+    length_bucketed_batches,
+)
+
+
+def read_sentiment_texts(movies_path, n_texts, seed=0):
+    '''
+    Read the text column of all <movie>_sentiment.csv files and draw a sample
+    '''
+    texts = []
+
+    for file in glob.glob(os.path.join(movies_path, "*", "*_sentiment.csv")):
+
+        if "subset" in os.path.basename(file):
+            continue
+
+        df = pd.read_csv(file, sep="\t", usecols=["text"])
+        texts.extend(df["text"].astype(str).tolist())
+
+    rng = np.random.default_rng(seed)
+    n_texts = min(n_texts, len(texts))
+
+    return [texts[i] for i in rng.choice(len(texts), n_texts, replace=False)]
+
+
+def padded_tokens(lengths, batches):
+    '''
+    Number of tokens the model actually processes once every batch is padded
+    to its longest member
+    '''
+    return sum(len(batch) * max(lengths[i] for i in batch) for batch in batches)
+
+
+def run_benchmark(roberta, texts, batch_size, max_tokens):
+
+    preprocessed = [roberta.preprocess(text) for text in texts]
+    lengths = [len(ids) for ids in roberta.tokenizer(preprocessed, truncation=True)["input_ids"]]
+    real_tokens = sum(lengths)
+
+    setups = [
+        (f"fixed batch_size={batch_size}", {"batch_size": batch_size},
+         fixed_size_batches(len(texts), batch_size)),
+        (f"bucketed max_tokens={max_tokens}", {"max_tokens": max_tokens},
+         length_bucketed_batches(lengths, max_tokens)),
+    ]
+
+    for name, kwargs, batches in setups:
+
+        start = time.perf_counter()
+        roberta.get_sentiment_batch(texts, **kwargs)
+        elapsed = time.perf_counter() - start
+
+        padded = padded_tokens(lengths, batches)
+
+        print(f"{name}:")
+        print(f"  batches: {len(batches)}")
+        print(f"  time: {elapsed:.2f} s")
+        print(f"  tweets/s: {len(texts) / elapsed:.1f}")
+        print(f"  tokens/s: {real_tokens / elapsed:.1f}")
+        print(f"  padding overhead: {100 * (padded - real_tokens) / padded:.1f}%")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Compare fixed size batching with length bucketed batching")
+    parser.add_argument("--n-texts", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--max-tokens", type=int, default=4096)
+    args = parser.parse_args()
+
+    movies_path = os.path.abspath(
+        os.path.join(os.path.dirname(__file__), "..", "data/twitter")
+    )
+
+    texts = read_sentiment_texts(movies_path, args.n_texts)
+    print(f"benchmarking on {len(texts)} tweets")
+
+    roberta = Roberta_Sentiment()
+    run_benchmark(roberta, texts, args.batch_size, args.max_tokens)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import pandas as pd
+
+
+thisfile_path = os.path.dirname(os.path.abspath(__file__))
+
+# Every measurement runs in a new interpreter, so nothing is imported or loaded yet
+STEPS = {
+    'import': '''
+start = time.perf_counter()
+import sentiment_analysis
+timings['import_s'] = time.perf_counter() - start
+''',
+    'import_ml': '''
+start = time.perf_counter()
+import torch
+import transformers
+timings['import_torch_transformers_s'] = time.perf_counter() - start
+''',
+    'first_score': '''
+start = time.perf_counter()
+import sentiment_analysis
+timings['import_s'] = time.perf_counter() - start
+roberta = sentiment_analysis.load_model(backend, model_dir)
+timings['load_model_s'] = time.perf_counter() - start - timings['import_s']
+roberta.get_sentiment_batch(['what a movie #inception'])
+timings['first_score_s'] = time.perf_counter() - start
+''',
+    'cached_score': '''
+start = time.perf_counter()
+import sentiment_analysis
+reader = sentiment_analysis.CSV_reader(cache_path=cache_path, backend=backend, model_dir=model_dir)
+reader.score_texts(['what a movie #inception'])
+timings['cached_score_s'] = time.perf_counter() - start
+timings['model_loaded'] = len(sentiment_analysis._models) > 0
+reader.close()
+''',
+}
+
+
+def run_step(step, backend, model_dir, cache_path):
+    '''
+    Timings of one step measured in a new python process, and the wall time
+    of the whole process
+    '''
+    code = '\n'.join([
+        'import json, time',
+        f'backend, model_dir, cache_path = {backend!r}, {model_dir!r}, {cache_path!r}',
+        'timings = {}',
+        STEPS[step],
+        'print(json.dumps(timings))',
+    ])
+
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', code], cwd=thisfile_path,
+                            capture_output=True, text=True)
+    wall = time.perf_counter() - start
+
+    if result.returncode != 0:
+        raise RuntimeError(f'{step} failed:\n{result.stderr}')
+
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    timings['process_s'] = wall
+
+    return timings
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Import time and time to first score of the sentiment module from a cold start')
+    parser.add_argument('--steps', nargs='*', choices=list(STEPS), default=list(STEPS))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--backend', default='torch')
+    parser.add_argument('--model-dir', default=None,
+                        help='local copy of the model, see sentiment_analysis.py --save-model')
+    parser.add_argument('--cache', default=os.path.abspath(
+        os.path.join(thisfile_path, '..', 'data', 'cache', 'sentiment_cache.sqlite')))
+    args = parser.parse_args()
+
+    rows = []
+
+    for step in args.steps:
+        for _ in range(args.repeat):
+            rows.append(dict(step=step, **run_step(step, args.backend, args.model_dir, args.cache)))
+
+    # medians of the repeats
+    report = pd.DataFrame(rows).groupby('step', sort=False).median(numeric_only=True)
+    print(report.round(3).to_string())
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,20 @@
+import argparse
 import pandas as pd
 import json
 import os
 import numpy as np
 import glob
 
+from actor_index import INDEX_PATH, cast_labels, load_index, read_cast
+from sentiment_aggregates import SCORE_COLUMNS, load_aggregate, metrics_from_totals
+from tweet_storage import TWITTER_PATH, locate_csv, read_movie_table
+
 
 thisfile_path = os.path.dirname(os.path.abspath(__file__))
 project_path = os.path.abspath(os.path.join(thisfile_path, os.pardir))
 
+SCORES_PATH = os.path.join(project_path, 'data', 'movies_with_scores.csv')
+
 # Mappings of movie id with its folder name of tweets
 map_folder2movieid_dict = {
     4: 'bridgerton',
@@ -20,73 +27,70 @@ map_folder2movieid_dict = {
 }
 
 
-def locate_sentimentcsv(movie_id, map_folder2movieid_dict):
+def sentiment_metrics(probabilities):
     '''
-    Helper function to get csv filepath of a certain movie
+    Sentiment metrics in one pass over the (N, 3) matrix of negative, neutral
+    and positive probabilities
     '''
-    # Get folder name from mapping dictionary by id
-    folder_name = map_folder2movieid_dict[movie_id]
-    folder_path = os.path.join(project_path, 'data', 'twitter',
-                               folder_name)
-    # Get the csv filepath by pattern matching inside folder
-
-    for file in os.listdir(folder_path):
+    n_tweets = probabilities.shape[0]
 
-        if file.endswith("_sentiment.csv") and "subset" not in file:
-            return os.path.join(folder_path, file)
+    # select most probable one as the choice of the model
+    dominant = np.argmax(probabilities, axis=1)
+    counts = np.bincount(dominant, minlength=3)
+    sums = probabilities.sum(axis=0)
 
-    return None
+    return metrics_from_totals(counts, sums, n_tweets)
 
 
-def calculate_sentiment_score(movie_id, map_folder2movieid_dict,
-                              sentiment_cols=['negative', 'neutral', 'positive']):
+def collapse_clusters(sentiment_data):
     '''
-    For each movie, calculate certain metrics related to sentiment based on model output.
-    Returns a list of values ot be added as columns
+    Keep one row per near duplicate cluster, so a tweet copied or retweeted
+    many times counts once. Rows without a cluster are all kept.
     '''
+    clustered = sentiment_data['cluster_id'].notna()
+    first_of_cluster = ~sentiment_data['cluster_id'].duplicated() & clustered
 
-    # Get csv file for movie and read
-    csv_filepath = locate_sentimentcsv(movie_id,  map_folder2movieid_dict)
+    return sentiment_data[first_of_cluster | ~clustered]
 
-    sentiment_data = pd.read_csv(
-        csv_filepath, usecols=sentiment_cols, sep="\t")
 
-    # ----------- Calculation of different sentiment metrics -------------------
+def calculate_sentiment_score(movie_id, map_folder2movieid_dict,
+                              sentiment_cols=['negative', 'neutral', 'positive'],
+                              use_aggregates=True, collapse=False):
+    '''
+    For each movie, calculate certain metrics related to sentiment based on model output.
+    Returns a series of values to be added as columns
+    '''
 
-    n_tweets = int(sentiment_data.shape[0])
+    folder_name = map_folder2movieid_dict[movie_id]
 
-    # 1-Get how many tweets there are per cattegory in percentage
-    data_percent = sentiment_data.copy(deep=True).rename(columns={
-        'negative': 'perc_negative',
-        'neutral': 'perc_neutral',
-        'positive': 'perc_positive'
-    })
+    if collapse:
 
-    data_percent['overall_sentiment'] = data_percent.apply(
-        (lambda row: row.index[np.argmax(row)]),
-        axis=1)  # select most probable one as the choice of the model
+        try:
+            sentiment_data = read_movie_table(
+                'sentiment', folder_name, columns=sentiment_cols + ['cluster_id'])
+            sentiment_data = collapse_clusters(sentiment_data)
+        except ValueError:
+            # output scored without --near-duplicates, there is nothing to collapse
+            print(f'no clusters for movie {movie_id}, using all rows')
+            sentiment_data = read_movie_table('sentiment', folder_name, columns=sentiment_cols)
 
-    data_percent = (data_percent.groupby(
-        'overall_sentiment').size()*100/n_tweets).round(decimals=2)
+        return sentiment_metrics(sentiment_data[sentiment_cols].to_numpy(dtype=np.float64))
 
-    # 2-Get the average probability for each cattegory
-    data_scores_mean = sentiment_data.copy(deep=True).rename(columns={
-        'negative': 'neg_score_avg',
-        'neutral': 'neutr_score_avg',
-        'positive': 'pos_score_avg'
-    }).mean().round(decimals=2)
+    # Metrics are derived directly from the aggregate kept up to date by the
+    # sentiment analysis when it matches the current output
+    if use_aggregates:
 
-    # 3-Get a combined score weighting the different scores of the model
-    weighted_score_data = sentiment_data.copy(deep=True).sum()
+        movie_dir = os.path.join(TWITTER_PATH, folder_name)
+        csv_path = locate_csv(movie_dir, 'sentiment') if os.path.isdir(movie_dir) else None
+        aggregate = load_aggregate(csv_path) if csv_path is not None else None
 
-    sentiment_score = ((weighted_score_data['negative']*-1 +
-                        weighted_score_data['neutral']*0 +
-                        weighted_score_data['positive']*1)/n_tweets).round(decimals=4)
+        if aggregate is not None and len(aggregate.counts) > 0:
+            return aggregate.scores()
 
-    data_out = pd.concat([data_percent, data_scores_mean,
-                          pd.Series([sentiment_score, n_tweets], index=['sentiment_score', 'n_tweets'])])
+    # Read only the sentiment columns of the movie (parquet when converted, csv otherwise)
+    sentiment_data = read_movie_table('sentiment', folder_name, columns=sentiment_cols)
 
-    return data_out
+    return sentiment_metrics(sentiment_data[sentiment_cols].to_numpy(dtype=np.float64))
 
 
 def add_diversityscore(movies, actors):
@@ -94,17 +98,14 @@ def add_diversityscore(movies, actors):
     Adds columns related to diversity score to movies dataframe based on the presence of the presence
     of non-white actors in their cast, given by a boolean column 'not_white' in actors dataframe
     '''
-    # Calculate diversity score as proportion of non-white actor in the main cast
+    # Calculate diversity score as proportion of non-white actor in the main cast,
+    # actors without a label are left out of the count
     scores = (actors
-              .groupby('movie_title').agg(
-                  n_nonwhite=pd.NamedAgg(
-                      column='not_white', aggfunc=sum),
-                  n_actors=pd.NamedAgg(
-                      column='not_white', aggfunc=len),
-                  diversity_score=pd.NamedAgg(column='not_white', aggfunc=(
-                      lambda x: round(sum(x) / len(x), ndigits=3)))
-              )
+              .groupby('movie_title')['not_white']
+              .agg(n_nonwhite='sum', n_actors='count')
               )
+    scores['diversity_score'] = (scores['n_nonwhite'] / scores['n_actors']).round(3)
+
     movies_withscore = (movies
                         .merge(scores, left_on=['film_name'],
                                right_on=['movie_title']))
@@ -112,23 +113,85 @@ def add_diversityscore(movies, actors):
     return movies_withscore
 
 
-def add_sentimentscore(movies, map_folder2movieid_dict):
+def add_sentimentscore(movies, map_folder2movieid_dict, use_aggregates=True, collapse=False):
     '''
     Adds columns related to sentiment score to movies dataframe based on the output
     of the sentiment analysis model applied to tweets
     '''
 
     # Calculate sentiment score for each
-    movies_scores = movies.apply(
-        lambda row: calculate_sentiment_score(
-            row['id'],  map_folder2movieid_dict),
-        axis=1, result_type='expand')
+    movies_scores = []
+
+    for movie_id in movies['id']:
+
+        try:
+            movies_scores.append(calculate_sentiment_score(
+                movie_id, map_folder2movieid_dict, use_aggregates=use_aggregates,
+                collapse=collapse))
+        except FileNotFoundError:
+            print(f'no sentiment data for movie {movie_id}, leaving its scores empty')
+            movies_scores.append(pd.Series(np.nan, index=SCORE_COLUMNS))
+
+    movies_scores = pd.DataFrame(movies_scores, index=movies.index)
     movies = pd.concat([movies, movies_scores], axis='columns')
     return movies
 
 
-def main():
+def check_scores(movies_with_scores, expected_path):
+    '''
+    Compare computed scores with a saved movies_with_scores.csv, for the movies
+    whose sentiment data is available. Returns the mismatching rows.
+    '''
+    expected = pd.read_csv(expected_path, sep=';').set_index('id')
+    computed = movies_with_scores.set_index('id')
+    computed = computed[computed['n_tweets'].notna()]
+
+    columns = [column for column in expected.columns if column != 'film_name']
+    expected = expected.loc[computed.index, columns]
+    computed = computed[columns]
+
+    matches = np.isclose(computed.to_numpy(dtype=float), expected.to_numpy(dtype=float),
+                         rtol=0, atol=1e-9).all(axis=1)
+
+    return pd.concat([computed[~matches], expected[~matches]], keys=['computed', 'expected'])
+
+
+def keep_saved_scores(movies_with_scores, saved_path):
+    '''
+    Sentiment scores of the movies without sentiment data taken from the
+    saved movies_with_scores.csv, so a run without their tweets does not
+    blank them
+    '''
+    if not os.path.exists(saved_path):
+        return movies_with_scores
 
+    saved = pd.read_csv(saved_path, sep=';').set_index('id')
+    movies_with_scores = movies_with_scores.set_index('id')
+
+    missing = movies_with_scores.index[movies_with_scores['n_tweets'].isna()]
+    missing = missing[missing.isin(saved.index)]
+
+    if len(missing) > 0:
+        print(f'no sentiment data for movies {list(missing)}, keeping their saved scores')
+        movies_with_scores.loc[missing, SCORE_COLUMNS] = saved.loc[missing, SCORE_COLUMNS]
+
+    return movies_with_scores.reset_index()
+
+
+def save_scores(movies_with_scores, scores_path=SCORES_PATH):
+    '''
+    Write the scores, movies without sentiment data keep their saved scores
+    '''
+    movies_with_scores = keep_saved_scores(movies_with_scores, scores_path)
+    movies_with_scores.to_csv(scores_path, sep=';', index=False)
+
+    return movies_with_scores
+
+
+def compute_movie_scores(use_aggregates=True, collapse=False):
+    '''
+    Movies of data/movies.csv with their diversity and sentiment scores
+    '''
     # ------------------ Reading data ----------------------
 
     # read list of films
@@ -145,24 +208,54 @@ def main():
         .T
     )
 
-    # read actors' etnicity data
-    actors = pd.read_csv(
-        # file used as starting point is movies_minimalversion.csv
-        os.path.join(project_path, 'data', 'actor_race.csv'),
-        delimiter=';',
-        header=0)
+    # read actors' etnicity data, from the actor index when it was crawled
+    if os.path.exists(INDEX_PATH):
+        actors = cast_labels(read_cast(), load_index())
+    else:
+        actors = pd.read_csv(
+            # file used as starting point is movies_minimalversion.csv
+            os.path.join(project_path, 'data', 'actor_race.csv'),
+            delimiter=';',
+            header=0)
 
     # --------------------- Processing ---------------------
 
     movies_with_scores = (
         movies
         .pipe(add_diversityscore, actors)
-        .pipe(add_sentimentscore, map_folder2movieid_dict)
+        .pipe(add_sentimentscore, map_folder2movieid_dict, use_aggregates, collapse)
     )
 
+    return movies_with_scores
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Calculate movie scores')
+    parser.add_argument('--check', action='store_true',
+                        help='compare with data/movies_with_scores.csv instead of overwriting it')
+    parser.add_argument('--recompute', action='store_true',
+                        help='ignore saved sentiment aggregates and read all sentiment rows')
+    parser.add_argument('--collapse-clusters', action='store_true',
+                        help='count every cluster of near duplicate tweets once')
+    args = parser.parse_args()
+
+    movies_with_scores = compute_movie_scores(use_aggregates=not args.recompute,
+                                              collapse=args.collapse_clusters)
+
+    if args.check:
+
+        mismatches = check_scores(movies_with_scores, SCORES_PATH)
+
+        if len(mismatches.index) > 0:
+            print(mismatches)
+            raise SystemExit('computed scores differ from movies_with_scores.csv')
+
+        print('computed scores match movies_with_scores.csv')
+        return
+
     # -------------------- Saving --------------------------
-    movies_with_scores.to_csv(os.path.join(
-        project_path, 'data/movies_with_scores.csv'), sep=';', index=False)
+    movies_with_scores = save_scores(movies_with_scores)
     print(movies_with_scores)
 
 
@@ -0,0 +1,140 @@
+import argparse
+import asyncio
+import time
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from twitter_lookup import MAX_IDS_PER_REQUEST, Lookup_Client, make_batches
+
+
+class Stub_Lookup_Api:
+
+    """
+    Local stand-in for GET /2/tweets. Answers the scripted error statuses
+    first, then returns a tweet for every requested id, and records the ids
+    of every request it received.
+    """
+
+    def __init__(self, statuses=()):
+
+        self.statuses = list(statuses)
+        self.requests = []
+
+    async def handle(self, request):
+
+        ids = request.query['ids'].split(',')
+        self.requests.append(ids)
+
+        if len(self.statuses) > 0:
+
+            status = self.statuses.pop(0)
+
+            if status == 429:
+                # the window resets right away, the client waits its minimum of a second
+                return web.Response(status=429, headers={
+                    'x-rate-limit-remaining': '0',
+                    'x-rate-limit-reset': str(int(time.time())),
+                })
+
+            return web.Response(status=status, text='service unavailable')
+
+        return web.json_response({
+            'data': [{'id': tweet_id, 'created_at': '2022-03-18T12:00:00.000Z'} for tweet_id in ids],
+        })
+
+
+async def run_stub(statuses, id_batches, max_retries):
+    '''
+    Lookup of id_batches against a stub answering statuses first, returns
+    the responses of the client and the requests the stub received
+    '''
+    api = Stub_Lookup_Api(statuses)
+    app = web.Application()
+    app.router.add_get('/2/tweets', api.handle)
+
+    async with TestServer(app) as server:
+
+        client = Lookup_Client('token', base_url=str(server.make_url('/2/tweets')),
+                               max_retries=max_retries, backoff_base=1.0)
+        responses = await client.lookup_async(id_batches)
+
+    return responses, api.requests
+
+
+def returned_ids(responses):
+
+    return [tweet['id'] for response in responses for tweet in response['data']]
+
+
+def check_batching():
+
+    ids = [str(tweet_id) for tweet_id in range(1000, 1250)]
+    responses, requests = asyncio.run(run_stub([], make_batches(ids), max_retries=0))
+
+    sizes = sorted(len(request) for request in requests)
+    assert sizes == [50, MAX_IDS_PER_REQUEST, MAX_IDS_PER_REQUEST], sizes
+    assert returned_ids(responses) == ids, 'responses out of batch order'
+
+
+def check_rate_limit_retry():
+
+    start = time.monotonic()
+    responses, requests = asyncio.run(run_stub([429], [['1', '2']], max_retries=0))
+
+    # waiting out a 429 is not a failure, even without retries left
+    assert len(requests) == 2, len(requests)
+    assert returned_ids(responses) == ['1', '2']
+    assert time.monotonic() - start >= 1.0, 'request repeated before the reset'
+
+
+def check_unavailable_retry():
+
+    responses, requests = asyncio.run(run_stub([503, 503], [['1']], max_retries=2))
+
+    assert len(requests) == 3, len(requests)
+    assert returned_ids(responses) == ['1']
+
+
+def check_retries_exhausted():
+
+    responses, requests = asyncio.run(run_stub([503] * 3, [['1'], ['2']], max_retries=1))
+
+    # the batch that keeps failing gives None, the other one is not affected
+    assert responses[0] is None or responses[1] is None, responses
+    assert len([response for response in responses if response is None]) == 1, responses
+    assert len(requests) == 4, len(requests)
+
+
+CHECKS = {
+    'batching': check_batching,
+    'rate_limit': check_rate_limit_retry,
+    'unavailable': check_unavailable_retry,
+    'retries_exhausted': check_retries_exhausted,
+}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Check the batching and retries of the tweet lookup client against a local stub api')
+    parser.add_argument('--checks', nargs='*', choices=list(CHECKS), default=list(CHECKS))
+    args = parser.parse_args()
+
+    failed = []
+
+    for name in args.checks:
+        try:
+            CHECKS[name]()
+            print(f'{name}: ok')
+        except AssertionError as e:
+            print(f'{name}: failed {e}')
+            failed.append(name)
+
+    if len(failed) > 0:
+        raise SystemExit(f'{len(failed)} lookup client checks failed')
+
+    print('lookup client checks passed')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,47 @@
-from os import listdir
-from os.path import isfile, join
+import argparse
 import os
-import pandas as pd
 
+from sampling import STRATA, sample_chunks
+from tweet_storage import SCORED_COLUMNS, TWITTER_PATH, read_tweet_chunks, tweet_csv_files
 
-def main():
-    movie_title = "wolf_of_wall_street"
-    dir_path = "/Users/kamil/Documents/Dokumenty/ITU/Sem1/Data_in_the_wild/project/DITW_project/data/twitter/" + movie_title
-    all_files = [f for f in listdir(dir_path) if isfile(join(dir_path, f))]
-    all_files = sorted(all_files)
-    tweets_per_file = 28
-    subset_all = pd.DataFrame()
 
-    for file in all_files:
-        df = pd.read_csv(f"{dir_path}/{file}")
-        subset_all = pd.concat([subset_all, df.head(tweets_per_file)], ignore_index=True)
+def construct_subset(movie_title, dir_path, size=500, seed=0, stratify='month',
+                     allocation='equal'):
+    '''
+    Reproducible sample of size tweets of a movie directory saved as
+    subset_<movie>.csv, drawn in one pass over the collected files. By default
+    every month gets the same share of the subset. Returns the number of
+    tweets in the subset.
+    '''
+    # tweets to annotate need their text, the dehydrated copies only hold ids
+    all_files = tweet_csv_files(dir_path, required_columns=SCORED_COLUMNS)
+
+    chunks = (chunk for _, _, chunk in read_tweet_chunks(
+        all_files, chunk_size=100000, required_columns=SCORED_COLUMNS))
+    subset_all = sample_chunks(chunks, size, seed=seed, stratify=stratify, allocation=allocation)
 
     subset_all.to_csv(f"{dir_path}/subset_{movie_title}.csv")
 
+    return len(subset_all.index)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Construct the annotation subset of a movie")
+    parser.add_argument("movie", help="name of the movie directory in data/twitter")
+    parser.add_argument("--twitter-path", default=TWITTER_PATH)
+    parser.add_argument("--size", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stratify", choices=STRATA + ["none"], default="month")
+    parser.add_argument("--allocation", choices=["equal", "proportional"], default="equal",
+                        help="share of the subset per stratum")
+    args = parser.parse_args()
+
+    n_tweets = construct_subset(args.movie, os.path.join(args.twitter_path, args.movie),
+                                args.size, args.seed,
+                                None if args.stratify == "none" else args.stratify,
+                                args.allocation)
+    print(f"Subset of {n_tweets} tweets saved for {args.movie}")
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
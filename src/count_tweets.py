@@ -1,24 +1,272 @@
+import argparse
 from os import listdir
 from os.path import isfile, join
 import os
 import pandas as pd
+import pyarrow.parquet as pq
 
+from concurrent.futures import ProcessPoolExecutor
+from tweet_storage import PARQUET_PATH, TWITTER_PATH, UNKNOWN_MONTH, month_from_file_name
+
+
+thisfile_path = os.path.dirname(os.path.abspath(__file__))
+project_path = os.path.abspath(os.path.join(thisfile_path, os.pardir))
+
+MANIFEST_PATH = os.path.join(project_path, 'data', 'cache', 'manifest.csv')
+
+MANIFEST_COLUMNS = ['path', 'movie', 'kind', 'month', 'rows', 'bytes', 'mtime_ns',
+                    'start_date', 'end_date']
+
+SCAN_BLOCK_SIZE = 1 << 22
+
+
+def count_csv_rows(path):
+    '''
+    Number of data rows of a csv file without parsing it: newlines are counted
+    block by block, skipping the ones inside double quoted fields (tweets with
+    line breaks). The header line is not counted.
+    '''
+    records = 0
+    in_quotes = False
+    last_byte = b'\n'
+
+    with open(path, 'rb') as read_file:
+        for block in iter(lambda: read_file.read(SCAN_BLOCK_SIZE), b''):
+
+            # split on quotes: the parts alternate between outside and inside a field,
+            # an escaped quote ("") closes and reopens the field and changes nothing
+            parts = block.split(b'"')
+            outside = parts[1::2] if in_quotes else parts[0::2]
+            records += sum(part.count(b'\n') for part in outside)
+
+            in_quotes = in_quotes != (len(parts) % 2 == 0)
+            last_byte = block[-1:]
+
+    # last line without a trailing newline
+    if last_byte != b'\n':
+        records += 1
+
+    return max(records - 1, 0)
+
+
+def file_kind(file_name):
+
+    if file_name.startswith('start_'):
+        return 'tweets_dehydrated' if file_name.endswith('_dehydr.csv') else 'tweets'
+    if file_name.startswith('subset_'):
+        return 'subset'
+    for kind in ['sentiment_date', 'sentiment', 'annotations']:
+        if kind in file_name:
+            return kind
+
+    return 'other'
+
+
+def window_dates(file_name):
+    '''
+    Start and end date of the collection window in a start_..._end_... name
+    '''
+    parts = file_name.split('_')
+
+    try:
+        start = '-'.join(parts[1:4])
+        end = '-'.join(parts[5:8])
+        return str(pd.Timestamp(start).date()), str(pd.Timestamp(end).date())
+    except ValueError:
+        return None, None
+
+
+def describe_file(entry):
+    '''
+    Manifest row of one file, run in the worker processes
+    '''
+    path, movie, kind, month = entry
+    stat = os.stat(path)
+
+    if path.endswith('.parquet'):
+        # row count from the footer, no column data is read
+        rows = pq.ParquetFile(path).metadata.num_rows
+    else:
+        rows = count_csv_rows(path)
+
+    start_date, end_date = None, None
+
+    if kind.startswith('tweets'):
+        start_date, end_date = window_dates(os.path.basename(path))
+    elif month != UNKNOWN_MONTH:
+        period = pd.Period(month, freq='M')
+        start_date, end_date = str(period.start_time.date()), str(period.end_time.date())
+
+    return (path, movie, kind, month, rows, stat.st_size, stat.st_mtime_ns, start_date, end_date)
+
+
+def list_files(twitter_path=TWITTER_PATH, parquet_path=PARQUET_PATH, movies=None):
+    '''
+    (path, movie, kind, month) of every csv file of the movie directories and
+    every parquet file of the converted tables
+    '''
+    entries = []
+
+    for movie_dir in sorted(entry.path for entry in os.scandir(twitter_path) if entry.is_dir()):
+
+        movie = os.path.basename(movie_dir)
+        if movies is not None and movie not in movies:
+            continue
+
+        for file in sorted(listdir(movie_dir)):
+            if file.endswith('.csv') and isfile(join(movie_dir, file)):
+                entries.append((join(movie_dir, file), movie, file_kind(file),
+                                month_from_file_name(file)))
+
+    if os.path.isdir(parquet_path):
+        for root, _, files in sorted(os.walk(parquet_path)):
+            for file in sorted(files):
+                if not file.endswith('.parquet'):
+                    continue
+                # data/parquet/<table>/movie=<movie>/month=YYYY-MM/part-0.parquet
+                table, movie, partition = os.path.relpath(root, parquet_path).split(os.sep)[:3]
+                movie = movie.split('=', 1)[-1]
+                if movies is not None and movie not in movies:
+                    continue
+                entries.append((join(root, file), movie, f'parquet_{table}',
+                                partition.split('=', 1)[-1]))
+
+    return entries
+
+
+def load_manifest(manifest_path=MANIFEST_PATH):
+
+    if not os.path.exists(manifest_path):
+        return pd.DataFrame(columns=MANIFEST_COLUMNS)
+
+    return pd.read_csv(manifest_path, dtype={'month': str, 'start_date': str, 'end_date': str})
+
+
+def build_manifest(twitter_path=TWITTER_PATH, parquet_path=PARQUET_PATH, movies=None,
+                   manifest_path=MANIFEST_PATH, workers=None):
+    '''
+    Inventory of the dataset with one row per file. Files whose size and mtime
+    match the cached manifest are not scanned again, the others are counted in
+    parallel.
+    '''
+    entries = list_files(twitter_path, parquet_path, movies)
+    cached = load_manifest(manifest_path).set_index('path')
+
+    rows, to_scan = [], []
+
+    for entry in entries:
+
+        path = entry[0]
+        stat = os.stat(path)
+
+        if path in cached.index and cached.at[path, 'bytes'] == stat.st_size \
+                and cached.at[path, 'mtime_ns'] == stat.st_mtime_ns:
+            rows.append(tuple([path] + cached.loc[path, MANIFEST_COLUMNS[1:]].tolist()))
+        else:
+            to_scan.append(entry)
+
+    if len(to_scan) > 0:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            rows.extend(executor.map(describe_file, to_scan, chunksize=4))
+
+    print(f'{len(entries) - len(to_scan)} files unchanged, scanned {len(to_scan)}')
+
+    manifest = pd.DataFrame(rows, columns=MANIFEST_COLUMNS).sort_values('path')
+
+    # entries of other movies are kept when only some movies were scanned
+    if movies is not None and len(cached.index) > 0:
+        others = cached.reset_index()
+        others = others[~others['movie'].isin(movies)]
+        manifest = pd.concat([others[MANIFEST_COLUMNS], manifest]).sort_values('path')
+
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    tmp_path = manifest_path + '.tmp'
+    manifest.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, manifest_path)
+
+    return manifest.reset_index(drop=True)
+
+
+def file_rows(paths, manifest_path=MANIFEST_PATH):
+    '''
+    Number of data rows of each of paths, from the manifest when it is up to
+    date for the file and by scanning it otherwise
+    '''
+    manifest = load_manifest(manifest_path).set_index('path')
+    rows = {}
+
+    for path in paths:
+
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+
+        if path in manifest.index and manifest.at[path, 'bytes'] == stat.st_size \
+                and manifest.at[path, 'mtime_ns'] == stat.st_mtime_ns:
+            rows[path] = int(manifest.at[path, 'rows'])
+        else:
+            rows[path] = count_csv_rows(path)
+
+    return rows
+
+
+def summarize(manifest):
+    '''
+    Rows, bytes and date range per movie, kind of file and month
+    '''
+    return (manifest
+            .groupby(['movie', 'kind', 'month'])
+            .agg(files=('path', 'size'), rows=('rows', 'sum'), bytes=('bytes', 'sum'),
+                 start_date=('start_date', 'min'), end_date=('end_date', 'max')))
+
+
+def tweet_totals(manifest):
+    '''
+    Tweets per movie counted once: the rows of its collected files, or of its
+    dehydrated copies when only those are there
+    '''
+    tweets = manifest[manifest['kind'].isin(['tweets', 'tweets_dehydrated'])]
+    rows = tweets.pivot_table(index='movie', columns='kind', values='rows', aggfunc='sum')
+    rows = rows.reindex(columns=['tweets', 'tweets_dehydrated'])
+
+    return rows['tweets'].fillna(rows['tweets_dehydrated']).fillna(0).astype(int)
+
+
+def count_movie_tweets(dir_path):
 
-def main():
-    dir_path = "/Users/kamil/Documents/Dokumenty/ITU/Sem1/Data_in_the_wild/project/DITW_project/data/twitter/wolf_of_wall_street"
     all_files = [f for f in listdir(dir_path) if isfile(join(dir_path, f))]
     all_files = sorted(all_files)
     total = 0
 
     for file in all_files:
         file_name = os.path.basename(file)
-        df = pd.read_csv(f"{dir_path}/{file}")
-        length = len(df.index)
+        length = count_csv_rows(join(dir_path, file))
         total += length
         print(f"Tweet count ({file_name}): {length}")
 
     print(f"Total tweet count: {total}")
 
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Inventory of the tweets of all movies, cached in data/cache/manifest.csv")
+    parser.add_argument("movies", nargs="*", help="movie directories in data/twitter, all by default")
+    parser.add_argument("--twitter-path", default=TWITTER_PATH)
+    parser.add_argument("--parquet-path", default=PARQUET_PATH)
+    parser.add_argument("--manifest", default=MANIFEST_PATH)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    manifest = build_manifest(args.twitter_path, args.parquet_path, args.movies or None,
+                              args.manifest, args.workers)
+
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None,
+                           'display.width', 200):
+        print(summarize(manifest))
+
+    print(f"Total tweet count: {int(tweet_totals(manifest).sum())}")
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,42 +1,26 @@
-import requests
 import os
-import time
 import pathlib
 import pandas as pd
 import numpy as np
 
+from tweet_storage import (
+    TWITTER_PATH,
+    clean_frame,
+    has_parquet,
+    is_snowflake,
+    locate_csv,
+    read_movie_table,
+    snowflake_dates,
+    write_table,
+)
+from tweet_store import Tweet_Store
+from twitter_lookup import Lookup_Client
+
 
 def auth():
     return os.getenv('TWITTERTOKEN')
 
 
-def create_headers(bearer_token):
-    headers = {"Authorization": "Bearer {}".format(bearer_token)}
-    return headers
-
-
-def create_url(tweet_ids):
-    tweet_fields = "tweet.fields=id,created_at"
-    ids = f"ids={tweet_ids}"
-    url = "https://api.twitter.com/2/tweets?{}&{}".format(ids, tweet_fields)
-    return url
-
-
-def connect_to_endpoint(url, headers):
-    try:
-        response = requests.request("GET", url, headers = headers)
-        if response.status_code != 200:
-            raise Exception(response.status_code, response.text)
-        
-    except Exception as e:
-        x = 5*60
-        print(e)
-        print(f"request limit exceeded, pausing for {x} seconds")
-        time.sleep(x)
-        connect_to_endpoint(url, headers)
-    return response.json()
-
-
 def get_df(json_response):
     for tweet in json_response['data']:
         tweet_id = tweet['id']
@@ -64,103 +48,206 @@ def get_sentiment_file(directory):
 
     return sentiment_file
 
-def get_json(url, headers):
-    try:
-        json_response = connect_to_endpoint(url, headers)
-        if "status" in json_response:
-            print(json_response)
-            if json_response.status == 429:
-                x = 5*60
-                print(f"request limit exceeded, pausing for {x} seconds")
-                time.sleep(x)
-                json_response = connect_to_endpoint(url, headers)
-    except Exception as e:
-        x = 5*60
-        print(e)
-        print(f"request limit exceeded, pausing for {x} seconds")
-        time.sleep(x)
-        json_response = connect_to_endpoint(url, headers)
-    return json_response
+def collect_missing(json_responses):
+    '''
+    Ids the api reported as missing (deleted or protected tweets) with the reason
+    '''
+    missing = []
+
+    for json_response in json_responses:
+        for error in json_response.get('errors', []):
+            missing.append((error.get('value'), error.get('title')))
+
+    return pd.DataFrame(missing, columns=['id', 'reason'])
+
+
+def collect_dates(store, ids):
+    '''
+    Typed table of (id, date) for every tweet of ids known to the tweet store
+    '''
+    stored = store.get_many(ids, columns=['id', 'created_at'])
+    stored = stored[stored['created_at'].notna()]
+
+    return pd.DataFrame({
+        'id': stored['id'].to_numpy(dtype=np.int64),
+        'date': stored['created_at'].str.split('T').str[0].to_numpy(),
+    })
+
+
+def add_dates(sentiment_df, dates_df):
+    '''
+    Join the dates onto the sentiment rows by int64 id with one hash lookup
+    '''
+    dates = dates_df.set_index('id')['date']
+    sentiment_df = sentiment_df.assign(
+        date=sentiment_df['id'].astype(np.int64).map(dates))
+
+    # undated tweets keep the 0.0 placeholder used in the existing files
+    sentiment_df['date'] = sentiment_df['date'].fillna('0.0')
+
+    return sentiment_df
+
+
+def load_sentiment(movie):
+    '''
+    Sentiment rows of a movie directory with an id, parquet when converted, csv otherwise
+    '''
+    movie_name = os.path.basename(os.path.normpath(movie))
+    sentiment_file = get_sentiment_file(movie)
+    sentiment_df = read_movie_table("sentiment", movie_name)
+
+    # somehow we have na values?
+    sentiment_df = sentiment_df[sentiment_df['id'].notna()]
+
+    return movie_name, sentiment_file, sentiment_df
+
+
+def empty_dates():
+
+    return pd.DataFrame({'id': np.empty(0, dtype=np.int64), 'date': np.empty(0, dtype=object)})
+
+
+def load_known_dates(movie):
+    '''
+    Id -> date table of the tweets already dated in the _sentiment_date.csv of
+    a movie directory, so a rerun never loses a date the api gave before
+    '''
+    dated_path = locate_csv(movie, 'sentiment_date')
+
+    if dated_path is None:
+        return empty_dates()
+
+    dated = pd.read_csv(dated_path, sep='\t', usecols=['id', 'date'], dtype={'date': str})
+    dated = dated[dated['id'].notna() & dated['date'].notna() & (dated['date'] != '0.0')]
+
+    return pd.DataFrame({
+        'id': dated['id'].astype(np.int64).to_numpy(),
+        'date': dated['date'].to_numpy(),
+    }).drop_duplicates('id')
+
+
+def fetch_dates(store, client, ids):
+    '''
+    Id -> date table for ids, only tweets whose date is not in the tweet store
+    go to the api. Returns the table and the number of requests that failed.
+    '''
+    if len(ids) == 0:
+        return empty_dates(), 0
+
+    json_responses = store.fetch_missing(ids, client, required_column='created_at')
 
+    failed = [response for response in json_responses if response is None]
+    if len(failed) > 0:
+        print(f"{len(failed)} requests failed after all retries")
+
+    # deleted tweets are reported instead of breaking their batch
+    missing_df = collect_missing(
+        [response for response in json_responses if response is not None])
+
+    if len(missing_df.index) > 0:
+        print(f"{len(missing_df.index)} tweets not returned by the api:")
+        print(missing_df['reason'].value_counts().to_string())
+
+    return collect_dates(store, ids), len(failed)
+
+
+def get_dates(store, client, ids, known_dates=None):
+    '''
+    Id -> date table for ids: decoded locally for Snowflake ids, taken from
+    known_dates or looked up (tweet store, then api) for the older sequential
+    ids. Returns the table and the number of lookup requests that failed.
+    '''
+    ids = np.unique(np.asarray(ids, dtype=np.int64))
+    local_dates = snowflake_dates(ids)
+    legacy_ids = ids[~is_snowflake(ids)]
+
+    if known_dates is None:
+        known_dates = empty_dates()
+
+    known_dates = known_dates[known_dates['id'].isin(legacy_ids)]
+    legacy_ids = legacy_ids[~np.isin(legacy_ids, known_dates['id'].to_numpy())].tolist()
+
+    print(f"{len(local_dates.index)} dates decoded from tweet ids, {len(known_dates.index)} "
+          f"known from the dated files, {len(legacy_ids)} older tweets to look up")
+
+    fetched_dates, n_failed = fetch_dates(store, client, legacy_ids)
+
+    return pd.concat([local_dates, known_dates, fetched_dates], ignore_index=True), n_failed
+
+
+def save_dated(movie, movie_name, sentiment_file, sentiment_df, dates_df):
+
+    sentiment_df = clean_frame(add_dates(sentiment_df, dates_df))
+    n_undated = int((sentiment_df['date'] == '0.0').sum())
+    print(f"{movie_name}: dated {len(sentiment_df.index) - n_undated} tweets, {n_undated} without date")
+
+    file_name = pathlib.Path(sentiment_file).stem
+    out_file_name = f"{file_name}_date.csv"
+    out_file_path = os.path.join(movie, out_file_name)
+    # crlf like the committed files, so carriage returns inside tweets are quoted
+    sentiment_df.to_csv(out_file_path, sep="\t", encoding="utf-8", index=False,
+                        lineterminator="\r\n")
+    print(f"saved to {out_file_path}")
+
+    if has_parquet("sentiment", movie_name):
+        write_table(sentiment_df, "sentiment_date", movie_name)
+        print(f"saved {movie_name} sentiment_date as parquet")
+
+    return len(sentiment_df.index)
+
+
+def date_movie(movie, store, client):
+    '''
+    Date the sentiment rows of a single movie directory, returns the number of rows
+    '''
+    movie_name, sentiment_file, sentiment_df = load_sentiment(movie)
+    ids = sentiment_df['id'].astype(np.int64).tolist()
+
+    dates_df, n_failed = get_dates(store, client, ids, load_known_dates(movie))
+    n_rows = save_dated(movie, movie_name, sentiment_file, sentiment_df, dates_df)
+
+    # the dates found are saved, but the movie is not done until the lookups succeed
+    if n_failed > 0:
+        raise RuntimeError(f"{movie_name}: {n_failed} date lookup requests failed, rerun to retry them")
+
+    return n_rows
 
 
 def main():
     bearer_token = auth()
-    headers = create_headers(bearer_token)
-    
-    cwd = pathlib.Path().resolve()
-    movies_path = os.path.abspath(
-        os.path.join(cwd, "data/twitter")
-    )
+    client = Lookup_Client(bearer_token)
+
     # get list of directories for movies
-    movies_list = get_movie_dirs(movies_path)
+    movies_list = get_movie_dirs(TWITTER_PATH)
+
+    store = Tweet_Store()
+    movies = []
+    all_ids = []
+    known_dates = []
 
-    counter = 0
     for movie in movies_list:
-        if counter >= 299:
-            x = 15*60
-            print(f"Pausing for {x} seconds after 300 requests")
-            time.sleep(x)
-            counter = 0
-        print(f"running for {movie}")
-
-        # get sentiment csv file
-        sentiment_file = get_sentiment_file(movie)
-        sentiment_df = pd.read_csv(sentiment_file, sep="\t")
-        
-        length = len(sentiment_df.index)
-        # adding column "date"
-        sentiment_df = sentiment_df.assign(date=pd.Series(np.zeros(length)).values)
-
-        # somehow we have na values?
-        sentiment_df = sentiment_df[sentiment_df['id'].notna()]
-
-        # These ids cannot be found anymore and break the search for all 100 in their respective query, probably the tweets got deleted
-        failing_ids = [1514335562576052224, 1534314350307069952]
-        sentiment_df = sentiment_df[~sentiment_df['id'].isin(failing_ids)]
-
-        # looping over df in steps of 100, getting 100 ids and sending those to api
-        total = 0
-        for i in range(0, length, 99):
-            j = min(length, i+99)
-            df = sentiment_df.loc[i:j, :]
-
-            ids = df['id']
-            ids_list = ids.to_list()
-            # print(f"Looking for {len(ids_list)} ids (should be 100)")
-            total += len(ids_list)
-            if len(ids_list) == 0:
-                print(f"no ids left for {sentiment_file} df[{i}:{j}]")
-                break   
-            ids_string = ','.join(map(str, map(int, ids_list)))
-            url = create_url(ids_string)
-
-            # Catching only exception for too many requests in connect_to_endpoint
-            json_response = get_json(url, headers)
-
-
-            # using try except block here in case no data is returned, maybe better way to handle it?
-            try:
-                for tweet in json_response['data']:
-                    tweet_id = tweet['id']
-                    date = tweet['created_at'].split('T')[0]
-                    sentiment_df.loc[sentiment_df['id'].astype(float) == float(tweet_id), 'date'] = date
-            except KeyError:
-                print("no tweets returned")
-                print(json_response)
-            except Exception as e:
-                print(e)
-            
-            counter += 100
-
-        print(f"Looked for {total} tweets")
-        
-        file_name = pathlib.Path(sentiment_file).stem
-        out_file_name = f"{file_name}_date.csv"
-        out_file_path = os.path.join(movie, out_file_name)
-        sentiment_df.to_csv(out_file_path, sep="\t", encoding="utf-8", index=False)
-        print(f"saved to {out_file_path}")
+        print(f"preparing {movie}")
+
+        movie_name, sentiment_file, sentiment_df = load_sentiment(movie)
+
+        # ids of all movies are sent to the api together
+        all_ids.extend(sentiment_df['id'].astype(np.int64).tolist())
+        known_dates.append(load_known_dates(movie))
+        movies.append((movie, movie_name, sentiment_file, sentiment_df))
+
+    # one id -> date table for all movies
+    dates_df, n_failed = get_dates(store, client, all_ids,
+                                   pd.concat(known_dates, ignore_index=True).drop_duplicates('id'))
+
+    for movie, movie_name, sentiment_file, sentiment_df in movies:
+
+        save_dated(movie, movie_name, sentiment_file, sentiment_df, dates_df)
+
+    store.close()
+
+    if n_failed > 0:
+        print(f"{n_failed} date lookup requests failed, rerun to retry them")
+
 
 if __name__ == "__main__":
     main()
-    
\ No newline at end of file
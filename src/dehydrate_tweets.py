@@ -1,12 +1,20 @@
+import argparse
 from os import listdir
 from os.path import isfile, join
 import os
 import pandas as pd
 
-def main():
-    dir_path = "/Users/kamil/Documents/Dokumenty/ITU/Sem1/Data_in_the_wild/project/DITW_project/data/twitter/wolf_of_wall_street"
+from tweet_storage import TWITTER_PATH
+
+
+def dehydrate_movie(dir_path):
+    '''
+    Write an id-only _dehydr copy of every collected file of a movie directory,
+    returns the number of tweets written
+    '''
     all_files = [f for f in listdir(dir_path) if isfile(join(dir_path, f))]
     all_files = sorted(all_files)
+    total = 0
 
     for file in all_files:
         if file.endswith('en.csv'):
@@ -16,7 +24,19 @@ def main():
             df = pd.read_csv(f"{dir_path}/{file}")
             df = df["id"]
             df.to_csv(f"{dir_path}/{new_file_name}")
+            total += len(df.index)
+
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dehydrate the collected tweets of a movie")
+    parser.add_argument("movie", help="name of the movie directory in data/twitter")
+    parser.add_argument("--twitter-path", default=TWITTER_PATH)
+    args = parser.parse_args()
+
+    dehydrate_movie(os.path.join(args.twitter_path, args.movie))
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,379 @@
+import argparse
+import glob
+import json
+import os
+import numpy as np
+import pandas as pd
+
+from tweet_storage import TWITTER_PATH
+
+
+LABELS = ['negative', 'neutral', 'positive']
+N_LABELS = len(LABELS)
+
+# Label code of tweets left without a label
+MISSING = -1
+
+# Annotations every other annotator and the model are compared to
+REFERENCE = 'final'
+
+MODEL_FILE = 'subset_{movie}_sentiment.csv'
+
+JSON_BLOCK_SIZE = 1 << 16
+
+
+def label_codes(labels):
+    '''
+    Codes 0, 1, 2 of the labels; sub-labels such as "negative-racial" count
+    as their main label and case is ignored
+    '''
+    labels = pd.Series(labels, dtype=object).str.lower().str.split('-').str[0]
+
+    return labels.map({label: i for i, label in enumerate(LABELS)}).fillna(MISSING).to_numpy(dtype=np.int8)
+
+
+def iter_json_array(path, block_size=JSON_BLOCK_SIZE):
+    '''
+    Objects of a json array file one at a time, without holding the parsed
+    array in memory
+    '''
+    decoder = json.JSONDecoder()
+    buffer = ''
+
+    with open(path, 'r', encoding='utf-8') as read_file:
+
+        started = False
+
+        for block in iter(lambda: read_file.read(block_size), ''):
+
+            buffer += block
+            position = 0
+
+            while True:
+
+                # skip the separators between objects
+                while position < len(buffer) and buffer[position] in ' \t\r\n,[':
+                    started = started or buffer[position] == '['
+                    position += 1
+
+                if position >= len(buffer) or buffer[position] == ']':
+                    break
+
+                try:
+                    obj, end = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    # object continues in the next block
+                    break
+
+                yield obj
+                position = end
+
+            buffer = buffer[position:]
+
+        if not started:
+            raise ValueError(f'{path} is not a json array')
+
+
+def read_label_studio_json(path):
+    '''
+    (tweet_id, label) of every task of a Label Studio json export, the label
+    of the last annotation that was not cancelled
+    '''
+    tweet_ids, labels = [], []
+
+    for task in iter_json_array(path):
+
+        label = None
+        for annotation in task['annotations']:
+            if annotation.get('was_cancelled'):
+                continue
+            for result in annotation['result']:
+                if result.get('type') == 'choices':
+                    label = result['value']['choices'][0]
+
+        tweet_ids.append(task['data']['id'])
+        labels.append(label)
+
+    return pd.DataFrame({
+        'tweet_id': np.asarray(tweet_ids, dtype=np.float64).astype(np.int64),
+        'label': label_codes(labels),
+    })
+
+
+def read_label_studio_csv(path, subset):
+    '''
+    (tweet_id, label) of a flattened Label Studio export. Its id column is
+    the task id, so tweets are matched to the subset by text and, for tweets
+    sharing a text, by their order among them.
+    '''
+    annotations = pd.read_csv(path, usecols=['id', 'text', 'sentiment']).sort_values('id')
+    annotations['occurrence'] = annotations.groupby('text').cumcount()
+
+    subset = subset.assign(occurrence=subset.groupby('text').cumcount())
+    matched = annotations.merge(subset[['text', 'occurrence', 'tweet_id']],
+                                on=['text', 'occurrence'], how='inner')
+
+    return pd.DataFrame({
+        'tweet_id': matched['tweet_id'].to_numpy(dtype=np.int64),
+        'label': label_codes(matched['sentiment']),
+    })
+
+
+def read_subset(movie_dir):
+
+    movie = os.path.basename(os.path.normpath(movie_dir))
+    subset = pd.read_csv(os.path.join(movie_dir, f'subset_{movie}.csv'), usecols=['id', 'text'])
+
+    return pd.DataFrame({'tweet_id': subset['id'].to_numpy(dtype=np.float64).astype(np.int64),
+                         'text': subset['text']})
+
+
+def read_model_output(path):
+    '''
+    (tweet_id, label) of a model output, the label being the most likely sentiment
+    '''
+    output = pd.read_csv(path, sep='\t', usecols=['id'] + LABELS)
+    output = output[output['id'].notna()]
+
+    return pd.DataFrame({
+        'tweet_id': output['id'].to_numpy(dtype=np.float64).astype(np.int64),
+        'label': output[LABELS].to_numpy(dtype=np.float64).argmax(axis=1).astype(np.int8),
+    })
+
+
+def read_movie_labels(movie_dir, model_file=MODEL_FILE):
+    '''
+    Labels of one movie aligned by tweet id: one int8 column per annotator
+    (json exports preferred over their csv copies), the final annotations
+    and the model output
+    '''
+    movie = os.path.basename(os.path.normpath(movie_dir))
+    subset = read_subset(movie_dir)
+    raters = {}
+
+    for path in sorted(glob.glob(os.path.join(movie_dir, f'{movie}_annotations_*'))):
+
+        name, extension = os.path.splitext(os.path.basename(path)[len(f'{movie}_annotations_'):])
+
+        if extension == '.json':
+            raters[name] = read_label_studio_json(path)
+        elif extension == '.csv' and name not in raters \
+                and not os.path.exists(os.path.splitext(path)[0] + '.json'):
+            raters[name] = read_label_studio_csv(path, subset)
+
+    model_path = os.path.join(movie_dir, model_file.format(movie=movie))
+    if os.path.exists(model_path):
+        raters['model'] = read_model_output(model_path)
+
+    labels = pd.DataFrame(index=pd.Index(subset['tweet_id'].unique(), name='tweet_id'))
+
+    for name, rater in raters.items():
+        rater = rater.drop_duplicates('tweet_id').set_index('tweet_id')['label']
+        labels[name] = rater.reindex(labels.index).fillna(MISSING).to_numpy(dtype=np.int8)
+
+    return labels
+
+
+def confusion_matrix(true, pred, n_labels=N_LABELS):
+    '''
+    Counts of (true, predicted) label pairs, rows are the true labels
+    '''
+    return np.bincount(true * n_labels + pred, minlength=n_labels * n_labels).reshape(n_labels, n_labels)
+
+
+def confusion_metrics(confusion):
+    '''
+    Accuracy, Cohen's kappa, macro F1 and per-class F1 of confusion matrices,
+    vectorized over any leading dimensions
+    '''
+    confusion = np.asarray(confusion, dtype=np.float64)
+    total = confusion.sum(axis=(-2, -1))
+    diagonal = np.diagonal(confusion, axis1=-2, axis2=-1)
+    true_totals = confusion.sum(axis=-1)
+    pred_totals = confusion.sum(axis=-2)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+
+        accuracy = diagonal.sum(axis=-1) / total
+        expected = (true_totals * pred_totals).sum(axis=-1) / total ** 2
+        kappa = (accuracy - expected) / (1 - expected)
+
+        # classes never predicted or never present have a F1 of 0
+        f1 = np.nan_to_num(2 * diagonal / (true_totals + pred_totals))
+
+    metrics = {'accuracy': accuracy, 'kappa': kappa, 'macro_f1': f1.mean(axis=-1)}
+    metrics.update({f'f1_{label}': f1[..., i] for i, label in enumerate(LABELS)})
+
+    return metrics
+
+
+def fleiss_kappa(ratings):
+    '''
+    Fleiss' kappa of a (tweets, raters) label array, over the tweets labelled
+    by every rater
+    '''
+    ratings = np.asarray(ratings)
+    ratings = ratings[(ratings != MISSING).all(axis=1)]
+    n_items, n_raters = ratings.shape
+
+    if n_items == 0 or n_raters < 2:
+        return np.nan
+
+    # raters per tweet and label
+    counts = np.zeros((n_items, N_LABELS))
+    np.add.at(counts, (np.repeat(np.arange(n_items), n_raters), ratings.ravel()), 1)
+
+    agreement = ((counts ** 2).sum(axis=1) - n_raters) / (n_raters * (n_raters - 1))
+    label_shares = counts.sum(axis=0) / (n_items * n_raters)
+    expected = (label_shares ** 2).sum()
+
+    return (agreement.mean() - expected) / (1 - expected)
+
+
+def bootstrap_confusions(true, pred, groups, n_groups, n_boot=1000, seed=0):
+    '''
+    Confusion matrices of n_boot resamples of every group at once: each
+    resample draws with replacement within every group, so the groups keep
+    their size. Returns an array (n_boot, n_groups, labels, labels).
+    '''
+    order = np.argsort(groups, kind='stable')
+    true, pred, groups = true[order], pred[order], groups[order]
+
+    sizes = np.bincount(groups, minlength=n_groups)
+    offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+
+    rng = np.random.default_rng(seed)
+    draws = rng.random((n_boot, len(groups)))
+    indices = offsets[groups] + (draws * sizes[groups]).astype(np.int64)
+
+    # one code per (resample, group, true, predicted), counted in a single bincount
+    codes = ((np.arange(n_boot)[:, None] * n_groups + groups) * N_LABELS
+             + true[indices]) * N_LABELS + pred[indices]
+    counts = np.bincount(codes.ravel(), minlength=n_boot * n_groups * N_LABELS * N_LABELS)
+
+    return counts.reshape(n_boot, n_groups, N_LABELS, N_LABELS)
+
+
+def compare(labels, true_col, pred_col, n_boot=1000, seed=0, level=0.95):
+    '''
+    Metrics of pred_col against true_col for every movie and all movies
+    together, with bootstrap confidence intervals
+    '''
+    pairs = labels[(labels[true_col] != MISSING) & (labels[pred_col] != MISSING)]
+    movies = sorted(pairs['movie'].unique())
+
+    if len(movies) == 0:
+        return pd.DataFrame()
+
+    groups = pd.Categorical(pairs['movie'], categories=movies).codes.astype(np.int64)
+    true = pairs[true_col].to_numpy(dtype=np.int64)
+    pred = pairs[pred_col].to_numpy(dtype=np.int64)
+
+    confusions = np.stack([confusion_matrix(true[groups == g], pred[groups == g])
+                           for g in range(len(movies))])
+    confusions = np.concatenate([confusions, confusions.sum(axis=0, keepdims=True)])
+
+    resampled = bootstrap_confusions(true, pred, groups, len(movies), n_boot, seed)
+    resampled = np.concatenate([resampled, resampled.sum(axis=1, keepdims=True)], axis=1)
+
+    point = confusion_metrics(confusions)
+    intervals = confusion_metrics(resampled)
+    tail = (1 - level) / 2 * 100
+
+    report = pd.DataFrame(point, index=pd.Index(movies + ['all'], name='movie'))
+    report.insert(0, 'n', confusions.sum(axis=(1, 2)))
+
+    for metric in ['accuracy', 'kappa', 'macro_f1']:
+        low, high = np.nanpercentile(intervals[metric], [tail, 100 - tail], axis=0)
+        report.insert(report.columns.get_loc(metric) + 1, f'{metric}_low', low)
+        report.insert(report.columns.get_loc(metric) + 2, f'{metric}_high', high)
+
+    report.insert(0, 'pred', pred_col)
+    report.insert(0, 'true', true_col)
+
+    return report
+
+
+def annotator_agreement(labels):
+    '''
+    Fleiss' kappa of the annotators of every movie, the final annotations
+    and the model left out
+    '''
+    rows = []
+
+    for movie, movie_labels in labels.groupby('movie'):
+
+        annotators = [col for col in movie_labels.columns
+                      if col not in ('movie', 'tweet_id', 'model', REFERENCE)
+                      and (movie_labels[col] != MISSING).any()]
+        ratings = movie_labels[annotators].to_numpy()
+
+        rows.append({'movie': movie, 'annotators': len(annotators),
+                     'n': int((ratings != MISSING).all(axis=1).sum()),
+                     'fleiss_kappa': fleiss_kappa(ratings)})
+
+    return pd.DataFrame(rows).set_index('movie')
+
+
+def read_all_labels(twitter_path=TWITTER_PATH, model_file=MODEL_FILE):
+    '''
+    Aligned labels of every movie with annotations, annotators renamed to
+    annotator_1, annotator_2, ... so movies annotated by different people
+    share columns
+    '''
+    frames = []
+
+    for movie_dir in sorted(entry.path for entry in os.scandir(twitter_path) if entry.is_dir()):
+
+        if len(glob.glob(os.path.join(movie_dir, '*_annotations_*'))) == 0:
+            continue
+
+        labels = read_movie_labels(movie_dir, model_file)
+        annotators = [col for col in labels.columns if col not in ('model', REFERENCE)]
+        labels = labels.rename(columns={name: f'annotator_{i + 1}' for i, name in enumerate(annotators)})
+        labels.insert(0, 'movie', os.path.basename(movie_dir))
+        frames.append(labels.reset_index())
+
+    labels = pd.concat(frames, ignore_index=True)
+    rater_cols = [col for col in labels.columns if col not in ('movie', 'tweet_id')]
+    labels[rater_cols] = labels[rater_cols].fillna(MISSING).astype(np.int8)
+
+    return labels
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Agreement of the annotators and accuracy of the model on the annotated subsets')
+    parser.add_argument('--twitter-path', default=TWITTER_PATH)
+    parser.add_argument('--model-file', default=MODEL_FILE,
+                        help='model output of every movie directory, {movie} is replaced by its name')
+    parser.add_argument('--n-boot', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=None, help='csv file for the model and annotator comparisons')
+    args = parser.parse_args()
+
+    labels = read_all_labels(args.twitter_path, args.model_file)
+    annotators = sorted(col for col in labels.columns if col.startswith('annotator_'))
+
+    reports = [compare(labels, REFERENCE, 'model', args.n_boot, args.seed)]
+    reports += [compare(labels, first, second, args.n_boot, args.seed)
+                for i, first in enumerate(annotators) for second in annotators[i + 1:]]
+    report = pd.concat(reports)
+
+    with pd.option_context('display.max_columns', None, 'display.width', 200):
+        print(report.round(3).to_string())
+        print(annotator_agreement(labels).round(3).to_string())
+
+        model_confusion = labels[(labels[REFERENCE] != MISSING) & (labels['model'] != MISSING)]
+        confusion = confusion_matrix(model_confusion[REFERENCE].to_numpy(dtype=np.int64),
+                                     model_confusion['model'].to_numpy(dtype=np.int64))
+        print(pd.DataFrame(confusion, index=pd.Index(LABELS, name=REFERENCE),
+                           columns=pd.Index(LABELS, name='model')).to_string())
+
+    if args.out is not None:
+        report.to_csv(args.out)
+
+
+if __name__ == '__main__':
+    main()
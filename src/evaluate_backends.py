@@ -0,0 +1,98 @@
+import argparse
+import glob
+import os
+import time
+import numpy as np
+import pandas as pd
+
+from evaluate_annotations import MISSING, confusion_matrix, confusion_metrics, label_codes
+from sentiment_analysis import BACKENDS, load_model
+
+
+def read_annotations(movies_path):
+    '''
+    Read the final annotations of all movies, keeping text and label
+    '''
+    annotations = []
+
+    for file in sorted(glob.glob(os.path.join(movies_path, "*", "*_annotations_final.csv"))):
+
+        df = pd.read_csv(file, usecols=["text", "sentiment"])
+        annotations.append(df)
+
+    annotations = pd.concat(annotations, ignore_index=True)
+
+    annotations["label"] = label_codes(annotations["sentiment"])
+
+    return annotations[annotations["label"] != MISSING].reset_index(drop=True)
+
+
+def evaluate_backend(backend, texts, labels, batch_size, max_tokens, reference=None,
+                     model_dir=None):
+
+    roberta = load_model(backend, model_dir)
+
+    start = time.perf_counter()
+    scores = roberta.get_sentiment_batch(texts, batch_size=batch_size, max_tokens=max_tokens)
+    elapsed = time.perf_counter() - start
+
+    predictions = scores.argmax(axis=1)
+    metrics = confusion_metrics(confusion_matrix(labels, predictions))
+    result = {
+        "backend": backend,
+        "time_s": round(elapsed, 2),
+        "tweets_per_s": round(len(texts) / elapsed, 1),
+        "accuracy_vs_annotations": round(float((predictions == labels).mean()), 4),
+        "macro_f1_vs_annotations": round(float(metrics["macro_f1"]), 4),
+        "kappa_vs_annotations": round(float(metrics["kappa"]), 4),
+    }
+
+    if reference is not None:
+        result["agreement_vs_torch"] = round(
+            float((predictions == reference.argmax(axis=1)).mean()), 4)
+        result["max_abs_diff_vs_torch"] = round(
+            float(np.abs(scores - reference).max()), 4)
+
+    return result, scores
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Compare speed and agreement of the sentiment model backends")
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=BACKENDS)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--max-tokens", type=int, default=4096)
+    parser.add_argument("--model-dir", default=None,
+                        help="local copy of the model, see sentiment_analysis.py --save-model")
+    args = parser.parse_args()
+
+    movies_path = os.path.abspath(
+        os.path.join(os.path.dirname(__file__), "..", "data/twitter")
+    )
+
+    annotations = read_annotations(movies_path)
+    texts = annotations["text"].astype(str).tolist()
+    labels = annotations["label"].to_numpy(dtype=int)
+    print(f"evaluating on {len(texts)} annotated tweets")
+
+    # the fp32 pytorch model is the reference every other backend is compared to
+    backends = ["torch"] + [backend for backend in args.backends if backend != "torch"]
+    reference = None
+    results = []
+
+    for backend in backends:
+
+        result, scores = evaluate_backend(
+            backend, texts, labels, args.batch_size, args.max_tokens, reference, args.model_dir)
+
+        if backend == "torch":
+            reference = scores
+
+        results.append(result)
+
+    print(pd.DataFrame(results).set_index("backend"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,401 @@
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+import pandas as pd
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from create_timeseries_twitter_api import auth, date_movie
+from calculate_moviescores import SCORES_PATH, compute_movie_scores, map_folder2movieid_dict, save_scores
+from dehydrate_tweets import dehydrate_movie
+from rename_files import rename_movie_files
+from render_plots import render_plots
+from sentiment_analysis import CSV_reader
+from sentiment_rollups import rollup_movie, rollup_path
+from tweet_storage import TWITTER_PATH, tweet_csv_files
+from tweet_store import Tweet_Store
+from twitter_lookup import Lookup_Client
+
+
+thisfile_path = os.path.dirname(os.path.abspath(__file__))
+project_path = os.path.abspath(os.path.join(thisfile_path, os.pardir))
+
+STATE_PATH = os.path.join(project_path, 'data', 'cache', 'pipeline_state.json')
+
+STAGES = ['rename', 'dehydrate', 'sentiment', 'dates', 'rollups', 'scores', 'plots']
+
+# Files read by the scores stage besides the sentiment outputs
+SCORE_INPUTS = [
+    os.path.join(project_path, 'data', 'movies.csv'),
+    os.path.join(project_path, 'data', 'metadata', 'movies_metadata.json'),
+    os.path.join(project_path, 'data', 'metadata', 'actor_index.csv'),
+    os.path.join(project_path, 'data', 'actor_race.csv'),
+]
+
+HASH_BLOCK_SIZE = 1 << 20
+
+
+class Stage:
+
+    """
+    One step of the pipeline. inputs is called when the stage is about to run,
+    so it sees the files written by the stages it runs after, and run returns
+    the number of rows the stage wrote.
+    """
+
+    def __init__(self, key, inputs, outputs, run, after=(), params=None, model=False):
+
+        self.key = key
+        self.inputs = inputs
+        self.outputs = outputs
+        self.run = run
+        self.after = list(after)
+        self.params = params or {}
+        # stages using the sentiment model run one at a time on its own thread
+        self.model = model
+
+
+class Pipeline:
+
+    """
+    Runs stages as a DAG: a stage starts once the stages it runs after are
+    done, independent stages (e.g. the branches of different movies) run in
+    parallel, and a stage whose input contents and parameters hash the same
+    as in its last successful run is skipped.
+    """
+
+    def __init__(self, state_path=STATE_PATH, workers=4):
+
+        self.state_path = state_path
+        self.workers = workers
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.state = self.load_state()
+
+    def load_state(self):
+
+        if not os.path.exists(self.state_path):
+            return {'files': {}, 'stages': {}}
+
+        with open(self.state_path, 'r') as read_file:
+            return json.load(read_file)
+
+    def save_state(self):
+
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        tmp_path = self.state_path + '.tmp'
+
+        with self.lock:
+            with open(tmp_path, 'w') as write_file:
+                json.dump(self.state, write_file, indent=4)
+            os.replace(tmp_path, self.state_path)
+
+    def add(self, stage):
+
+        self.stages[stage.key] = stage
+
+    def file_hash(self, path):
+        '''
+        Content hash of a file, rehashed only when its size or mtime changed
+        '''
+        stat = os.stat(path)
+        signature = [stat.st_size, stat.st_mtime_ns]
+
+        with self.lock:
+            cached = self.state['files'].get(path)
+        if cached is not None and cached[:2] == signature:
+            return cached[2]
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as read_file:
+            for block in iter(lambda: read_file.read(HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+
+        with self.lock:
+            self.state['files'][path] = signature + [digest.hexdigest()]
+
+        return digest.hexdigest()
+
+    def input_hash(self, stage, inputs):
+
+        digest = hashlib.sha256(json.dumps(stage.params, sort_keys=True).encode('utf-8'))
+
+        for path in sorted(inputs):
+            digest.update(os.path.relpath(path, project_path).encode('utf-8'))
+            digest.update(self.file_hash(path).encode('utf-8'))
+
+        return digest.hexdigest()
+
+    def run_stage(self, stage, force=False):
+
+        inputs = [path for path in stage.inputs() if os.path.exists(path)]
+
+        if len(inputs) == 0:
+            return {'status': 'no inputs', 'seconds': 0.0, 'rows': None}
+
+        input_hash = self.input_hash(stage, inputs)
+        previous = self.state['stages'].get(stage.key)
+        outputs_exist = all(os.path.exists(path) for path in stage.outputs)
+
+        if not force and outputs_exist and previous is not None \
+                and previous['input_hash'] == input_hash:
+            return {'status': 'unchanged', 'seconds': 0.0, 'rows': previous['rows']}
+
+        print(f'running {stage.key} on {len(inputs)} input files')
+        start = time.perf_counter()
+        rows = stage.run()
+        seconds = time.perf_counter() - start
+
+        with self.lock:
+            self.state['stages'][stage.key] = {
+                'input_hash': input_hash,
+                'rows': rows,
+                'seconds': round(seconds, 3),
+                'finished_at': pd.Timestamp.now().isoformat(timespec='seconds'),
+            }
+        self.save_state()
+
+        return {'status': 'ran', 'seconds': seconds, 'rows': rows}
+
+    def run(self, force=False):
+        '''
+        Run all stages, returns a report with the status, wall time and rows
+        of every stage
+        '''
+        results = {}
+        pending = dict(self.stages)
+        running = {}
+
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        model_pool = ThreadPoolExecutor(max_workers=1)
+
+        try:
+            while len(pending) > 0 or len(running) > 0:
+
+                progress = False
+
+                for key, stage in list(pending.items()):
+
+                    after = [results.get(dependency) for dependency in stage.after
+                             if dependency in self.stages]
+
+                    if any(result is None for result in after):
+                        continue
+
+                    del pending[key]
+                    progress = True
+
+                    if any(result['status'] in ('failed', 'blocked') for result in after):
+                        results[key] = {'status': 'blocked', 'seconds': 0.0, 'rows': None}
+                        continue
+
+                    executor = model_pool if stage.model else pool
+                    running[executor.submit(self.run_stage, stage, force)] = key
+
+                if len(running) == 0:
+                    if not progress:
+                        raise ValueError(f'stages waiting on each other: {sorted(pending)}')
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+
+                    key = running.pop(future)
+
+                    try:
+                        results[key] = future.result()
+                    except Exception as e:
+                        print(f'{key} failed: {e!r}')
+                        results[key] = {'status': 'failed', 'seconds': 0.0, 'rows': None}
+
+        finally:
+            pool.shutdown()
+            model_pool.shutdown()
+            self.save_state()
+
+        report = pd.DataFrame.from_dict(results, orient='index')
+        report.index.name = 'stage'
+
+        return report.loc[list(self.stages)]
+
+
+def raw_files(movie_dir):
+    '''
+    Collected files still named with the characters replaced by rename_files
+    '''
+    return [os.path.join(movie_dir, file) for file in sorted(os.listdir(movie_dir))
+            if file.startswith('start') and any(c in file for c in ':-,#')]
+
+
+def collected_files(movie_dir):
+
+    return [os.path.join(movie_dir, file) for file in sorted(os.listdir(movie_dir))
+            if file.startswith('start_') and file.endswith('en.csv')]
+
+
+def tweet_files(movie_dir):
+    '''
+    Files scored by the sentiment analysis, same selection as CSV_reader.get_csv_files
+    (the dehydrated copies written by the dehydrate stage are left out)
+    '''
+    return tweet_csv_files(movie_dir)
+
+
+class Sentiment_Runner:
+
+    """
+    One CSV_reader (and model) shared by the sentiment stages of all movies,
+    created on first use on the thread of the model stages
+    """
+
+    def __init__(self, sample_size=10000, **reader_args):
+
+        self.sample_size = sample_size
+        self.reader_args = reader_args
+        self.reader = None
+
+    def run(self, movie_dir):
+
+        # the model itself is only loaded once a tweet misses the cache
+        if self.reader is None:
+            self.reader = CSV_reader(**self.reader_args)
+
+        out_file_path = self.reader.run_on_movie_dir(movie_dir, self.sample_size)
+
+        # only dehydrated files, nothing was scored
+        if out_file_path is None:
+            return 0
+
+        return count_rows(out_file_path)
+
+    def close(self):
+
+        if self.reader is not None:
+            self.reader.report_cache_stats()
+            self.reader.close()
+
+
+def count_rows(csv_path, sep='\t'):
+
+    return sum(len(chunk.index) for chunk in pd.read_csv(
+        csv_path, sep=sep, usecols=[0], chunksize=100000))
+
+
+def run_dates(movie_dir):
+
+    store = Tweet_Store()
+
+    try:
+        return date_movie(movie_dir, store, Lookup_Client(auth()))
+    finally:
+        store.close()
+
+
+def run_scores():
+
+    movies_with_scores = save_scores(compute_movie_scores())
+
+    return len(movies_with_scores.index)
+
+
+def build_pipeline(movies, stages, sentiment_runner, state_path=STATE_PATH, workers=4):
+    '''
+    Branch rename -> dehydrate -> sentiment -> dates -> rollups for every movie
+    directory, joined by the scores stage over all sentiment outputs and the
+    plots stage over all rollups
+    '''
+    pipeline = Pipeline(state_path, workers)
+    sentiment_outputs = []
+    rollup_outputs = []
+
+    for movie in movies:
+
+        movie_dir = os.path.join(TWITTER_PATH, movie)
+        sentiment_path = os.path.join(movie_dir, f'{movie}_sentiment.csv')
+        dated_path = os.path.join(movie_dir, f'{movie}_sentiment_date.csv')
+        rollup_outputs.append(rollup_path(movie))
+        sentiment_outputs.append(sentiment_path)
+
+        branch = [
+            Stage(f'rename:{movie}', lambda d=movie_dir: raw_files(d), [],
+                  lambda d=movie_dir: rename_movie_files(d)),
+            Stage(f'dehydrate:{movie}', lambda d=movie_dir: collected_files(d), [],
+                  lambda d=movie_dir: dehydrate_movie(d), after=[f'rename:{movie}']),
+            Stage(f'sentiment:{movie}', lambda d=movie_dir: tweet_files(d), [sentiment_path],
+                  lambda d=movie_dir: sentiment_runner.run(d), after=[f'dehydrate:{movie}'],
+                  params={'sample_size': sentiment_runner.sample_size,
+                          'backend': sentiment_runner.reader_args.get('backend', 'torch')},
+                  model=True),
+            Stage(f'dates:{movie}', lambda p=sentiment_path: [p], [dated_path],
+                  lambda d=movie_dir: run_dates(d), after=[f'sentiment:{movie}']),
+            Stage(f'rollups:{movie}', lambda p=dated_path: [p], [rollup_path(movie)],
+                  lambda d=movie_dir: rollup_movie(d), after=[f'dates:{movie}']),
+        ]
+
+        for stage in branch:
+            if stage.key.split(':')[0] in stages:
+                pipeline.add(stage)
+
+    if 'scores' in stages:
+        pipeline.add(Stage('scores', lambda: SCORE_INPUTS + sentiment_outputs, [SCORES_PATH],
+                           run_scores, after=[f'sentiment:{movie}' for movie in movies]))
+
+    if 'plots' in stages:
+        movie_ids = [movie_id for movie_id, folder in map_folder2movieid_dict.items()
+                     if folder in movies]
+        # figures are skipped one by one by render_plots itself
+        pipeline.add(Stage('plots', lambda: rollup_outputs, [],
+                           lambda: render_plots(movie_ids, workers=workers),
+                           after=[f'rollups:{movie}' for movie in movies]))
+
+    return pipeline
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Run the data pipeline, recomputing only stages whose inputs changed')
+    parser.add_argument('--movies', nargs='*', default=None,
+                        help='movie directories in data/twitter, all of them by default')
+    parser.add_argument('--stages', nargs='*', choices=STAGES, default=STAGES)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--force', action='store_true', help='rerun stages with unchanged inputs')
+    parser.add_argument('--state', default=STATE_PATH)
+    parser.add_argument('--sample-size', type=int, default=10000,
+                        help='number of tweets sampled per movie, 0 scores all of them')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--max-tokens', type=int, default=4096)
+    parser.add_argument('--backend', default='torch')
+    parser.add_argument('--model-dir', default=None,
+                        help='local copy of the sentiment model, loaded without network access')
+    parser.add_argument('--cache', default=os.path.join(
+        project_path, 'data', 'cache', 'sentiment_cache.sqlite'))
+    args = parser.parse_args()
+
+    movies = args.movies or sorted(
+        entry.name for entry in os.scandir(TWITTER_PATH) if entry.is_dir())
+
+    sentiment_runner = Sentiment_Runner(
+        sample_size=args.sample_size or None,
+        batch_size=args.batch_size,
+        max_tokens=args.max_tokens,
+        cache_path=args.cache,
+        backend=args.backend,
+        model_dir=args.model_dir,
+    )
+
+    pipeline = build_pipeline(movies, args.stages, sentiment_runner, args.state, args.workers)
+
+    try:
+        report = pipeline.run(force=args.force)
+    finally:
+        sentiment_runner.close()
+
+    print(report.to_string())
+
+
+if __name__ == '__main__':
+    main()
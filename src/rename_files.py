@@ -1,27 +1,48 @@
+import argparse
 from pathlib import Path
 from os import listdir
 from os.path import isfile, join
 import os
 import pandas as pd
 
-def main():
-    dir_path = "/Users/kamil/Documents/Dokumenty/ITU/Sem1/Data_in_the_wild/project/DITW_project/data/twitter/wolf_of_wall_street"
+from tweet_storage import TWITTER_PATH
+
+
+def rename_movie_files(dir_path):
+    '''
+    Copy the collected files of a movie directory to names without ":", "-",
+    "," and "#", returns the number of tweets written
+    '''
     all_files = [f for f in listdir(dir_path) if isfile(join(dir_path, f))]
     all_files = sorted(all_files)
+    total = 0
 
     for file in all_files:
         file_name = os.path.basename(file)
         #print(file_name)
-        
+
         if file.startswith('start'):
-            df = pd.read_csv(f"{dir_path}/{file}")
             new_file_name = file.replace(":", "_")
             new_file_name = new_file_name.replace("-", "_")
             new_file_name = new_file_name.replace(",", "_")
             new_file_name = new_file_name.replace("#", "_")
+            if new_file_name == file:
+                continue
+            df = pd.read_csv(f"{dir_path}/{file}")
             df.to_csv(f"{dir_path}/{new_file_name}")
-        
+            total += len(df.index)
+
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rename the collected files of a movie")
+    parser.add_argument("movie", help="name of the movie directory in data/twitter")
+    parser.add_argument("--twitter-path", default=TWITTER_PATH)
+    args = parser.parse_args()
+
+    rename_movie_files(os.path.join(args.twitter_path, args.movie))
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,281 @@
+import argparse
+import hashlib
+import json
+import os
+import matplotlib
+import pandas as pd
+
+# figures are only written to files, also in the worker processes
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+from concurrent.futures import ProcessPoolExecutor
+from calculate_moviescores import map_folder2movieid_dict
+from sentiment_rollups import ROLLUP_PATH, load_rollup, rollup_path
+
+
+thisfile_path = os.path.dirname(os.path.abspath(__file__))
+project_path = os.path.abspath(os.path.join(thisfile_path, os.pardir))
+
+IMG_PATH = os.path.join(project_path, 'data', 'img')
+SCORES_PATH = os.path.join(project_path, 'data', 'movies_with_scores.csv')
+STATE_PATH = os.path.join(project_path, 'data', 'cache', 'plot_state.json')
+
+FIGURES = ['tweetbysentimentcount', 'sentimentscore', 'sentimentratio', 'all']
+
+# Release date marked on the time axis, empty when it does not make sense
+RELEASE_DATES = {
+    7: '2015-05-14',
+    3: '2019-12-20',
+    4: '',
+    5: '2010-07-29',
+    1: '',
+    6: '2014-01-09',
+}
+
+LABELS = ['negative', 'neutral', 'positive']
+COLORS = ['r', 'b', 'g']
+
+# Part of the hash of every figure, bump the version when the drawing code changes
+PLOT_CONFIG = {
+    'version': 1,
+    'figsize': [15, 5],
+    'linewidth': 0.8,
+    'dpi': 100,
+}
+
+
+def figure_path(movie_id, figure, img_dir=IMG_PATH):
+
+    return os.path.join(img_dir, f'{movie_id}_plot_{figure}.png')
+
+
+def daily_counts(rollup):
+    '''
+    Tweets per day and dominant sentiment, the data behind all figures
+    '''
+    counts = rollup.totals('D')[['n_' + label for label in LABELS]]
+    counts.columns = LABELS
+
+    return counts
+
+
+def data_hash(counts):
+
+    return hashlib.sha256(pd.util.hash_pandas_object(counts).to_numpy().tobytes()).hexdigest()
+
+
+def figure_hash(counts_hash, figure, film_name, release_date):
+
+    config = dict(PLOT_CONFIG, figure=figure, film_name=film_name, release_date=release_date)
+
+    return hashlib.sha256(
+        (counts_hash + json.dumps(config, sort_keys=True)).encode('utf-8')).hexdigest()
+
+
+def plot_series(counts):
+    '''
+    Lines of the figures as in create_time_series.ipynb: counts of the days
+    with tweets of a sentiment, score and ratio of the days with tweets of
+    every sentiment
+    '''
+    complete = counts[(counts > 0).all(axis=1)]
+
+    score = (complete['positive'] - complete['negative']) / complete.sum(axis=1)
+    ratio = complete['positive'] / complete['negative']
+
+    return {
+        'counts': {label: counts[label][counts[label] > 0] for label in LABELS},
+        'score': score,
+        'ratio': ratio,
+    }
+
+
+def set_ticks(counts, release_date):
+
+    ticks = [counts.index.min(), counts.index.max()]
+    if release_date != '':
+        ticks.append(pd.Timestamp(release_date))
+
+    plt.xticks(ticks)
+
+
+def draw_counts(ax, series):
+
+    for label, color in zip(LABELS, COLORS):
+        ax.plot(series['counts'][label].index, series['counts'][label].to_numpy(),
+                label=label, color=color)
+
+
+def render_figure(figure, counts, series, film_name, release_date, path):
+
+    if figure == 'all':
+
+        fig, axs = plt.subplots(3, 1, sharex=True)
+        fig.subplots_adjust(hspace=0)
+        draw_counts(axs[0], series)
+        axs[1].plot(series['score'].index, series['score'].to_numpy())
+        axs[2].plot(series['ratio'].index, series['ratio'].to_numpy())
+        set_ticks(counts, release_date)
+        plt.xlabel('date')
+        fig.suptitle(film_name)
+
+    else:
+
+        fig, ax = plt.subplots(figsize=PLOT_CONFIG['figsize'])
+
+        if figure == 'tweetbysentimentcount':
+            draw_counts(ax, series)
+            plt.ylim([0, counts.to_numpy().max() + 10])
+            plt.title(f"Amount of tweets by sentiment for '{film_name}'")
+            plt.ylabel('# tweets')
+            ax.legend(LABELS)
+
+        elif figure == 'sentimentscore':
+            ax.plot(series['score'].index, series['score'].to_numpy())
+            plt.ylim([-1, 1])
+            plt.title(f"Sentiment score for '{film_name}'")
+            plt.ylabel('sentiment score')
+
+        elif figure == 'sentimentratio':
+            ax.plot(series['ratio'].index, series['ratio'].to_numpy())
+            plt.ylim([0, (series['ratio'].max() if len(series['ratio']) > 0 else 0) + 0.3])
+            plt.title(f"Pos/Neg ratio for '{film_name}'")
+            plt.ylabel('pos/neg ratio')
+
+        set_ticks(counts, release_date)
+        plt.xlabel('date')
+
+    fig.autofmt_xdate()
+
+    tmp_path = path + '.tmp.png'
+    fig.savefig(tmp_path, dpi=PLOT_CONFIG['dpi'])
+    plt.close(fig)
+    os.replace(tmp_path, path)
+
+
+def render_movie(job):
+    '''
+    Render the figures of one movie, run in the worker processes. Returns
+    the paths written with the hash of their inputs.
+    '''
+    movie_id, path, figures, film_name, release_date, img_dir = job
+
+    plt.rcParams['lines.linewidth'] = PLOT_CONFIG['linewidth']
+
+    counts = daily_counts(load_rollup(path))
+    series = plot_series(counts)
+    counts_hash = data_hash(counts)
+    rendered = {}
+
+    for figure in figures:
+        out_path = figure_path(movie_id, figure, img_dir)
+        render_figure(figure, counts, series, film_name, release_date, out_path)
+        rendered[out_path] = figure_hash(counts_hash, figure, film_name, release_date)
+
+    return rendered
+
+
+def load_state(state_path=STATE_PATH):
+
+    if not os.path.exists(state_path):
+        return {}
+
+    with open(state_path, 'r') as read_file:
+        return json.load(read_file)
+
+
+def save_state(state, state_path=STATE_PATH):
+
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    tmp_path = state_path + '.tmp'
+
+    with open(tmp_path, 'w') as write_file:
+        json.dump(state, write_file, indent=4)
+
+    os.replace(tmp_path, state_path)
+
+
+def plan_jobs(movie_ids, state, rollup_dir=ROLLUP_PATH, img_dir=IMG_PATH, force=False):
+    '''
+    Figures to render per movie: the ones missing or whose data or config
+    hash differs from the one they were rendered with
+    '''
+    film_names = pd.read_csv(SCORES_PATH, sep=';').set_index('id')['film_name']
+    jobs = []
+    n_unchanged = 0
+
+    for movie_id in movie_ids:
+
+        path = rollup_path(map_folder2movieid_dict[movie_id], rollup_dir)
+        rollup = load_rollup(path)
+
+        if rollup is None:
+            print(f'no rollup for movie {movie_id}, run sentiment_rollups.py first')
+            continue
+
+        film_name = film_names[movie_id]
+        release_date = RELEASE_DATES.get(movie_id, '')
+        counts_hash = data_hash(daily_counts(rollup))
+
+        figures = [
+            figure for figure in FIGURES
+            if force or not os.path.exists(figure_path(movie_id, figure, img_dir))
+            or state.get(figure_path(movie_id, figure, img_dir))
+            != figure_hash(counts_hash, figure, film_name, release_date)
+        ]
+        n_unchanged += len(FIGURES) - len(figures)
+
+        if len(figures) > 0:
+            jobs.append((movie_id, path, figures, film_name, release_date, img_dir))
+
+    print(f'{n_unchanged} figures unchanged, rendering {sum(len(job[2]) for job in jobs)}')
+
+    return jobs
+
+
+def render_plots(movie_ids, rollup_dir=ROLLUP_PATH, img_dir=IMG_PATH, state_path=STATE_PATH,
+                 workers=None, force=False):
+    '''
+    Render the figures of movie_ids in a process pool, one movie per task,
+    returns the number of figures rendered
+    '''
+    state = load_state(state_path)
+    jobs = plan_jobs(movie_ids, state, rollup_dir, img_dir, force)
+
+    if len(jobs) == 0:
+        return 0
+
+    os.makedirs(img_dir, exist_ok=True)
+    n_rendered = 0
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for rendered in executor.map(render_movie, jobs):
+            state.update(rendered)
+            n_rendered += len(rendered)
+
+    save_state(state, state_path)
+
+    return n_rendered
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Render the time series figures of every movie from the sentiment rollups')
+    parser.add_argument('--movies', nargs='*', type=int, default=sorted(RELEASE_DATES),
+                        help='movie ids, all movies with dated tweets by default')
+    parser.add_argument('--rollup-path', default=ROLLUP_PATH)
+    parser.add_argument('--img-path', default=IMG_PATH)
+    parser.add_argument('--state', default=STATE_PATH)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--force', action='store_true', help='render unchanged figures too')
+    args = parser.parse_args()
+
+    n_rendered = render_plots(args.movies, args.rollup_path, args.img_path, args.state,
+                              args.workers, args.force)
+    print(f'rendered {n_rendered} figures')
+
+
+if __name__ == '__main__':
+    main()
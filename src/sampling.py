@@ -0,0 +1,177 @@
+import numpy as np
+import pandas as pd
+
+
+STRATA = ['month', 'tweet_type']
+
+
+def tweet_type(chunk):
+    '''
+    'retweet' for retweets, 'original' for every other tweet (including
+    quotes and replies, which carry their own text)
+    '''
+    if 'referenced_tweet_type' not in chunk:
+        raise ValueError('tweet_type strata need the referenced_tweet_type column, '
+                         'dehydrated files only have ids')
+
+    return pd.Series(
+        np.where(chunk['referenced_tweet_type'] == 'retweeted', 'retweet', 'original'),
+        index=chunk.index)
+
+
+def strata_of(chunk, stratify):
+
+    if stratify == 'tweet_type':
+        return tweet_type(chunk)
+
+    return chunk[stratify].astype(str)
+
+
+class Reservoir:
+
+    """
+    Uniform sample without replacement of at most `size` rows from a stream of
+    chunks, in a single pass and bounded memory. Every row gets a random key
+    and the rows with the `size` smallest keys are kept (bottom-k sampling),
+    which is reservoir sampling done a chunk at a time with numpy. The same
+    seed and the same stream give the same sample.
+    """
+
+    def __init__(self, size, seed=0):
+
+        self.size = size
+        self.rng = np.random.default_rng(seed)
+        self.kept = None
+        self.keys = np.empty(0)
+        self.n_seen = 0
+
+    def threshold(self):
+
+        return self.keys.max() if len(self.keys) >= self.size else np.inf
+
+    def add(self, chunk, keys=None):
+
+        if keys is None:
+            keys = self.rng.random(len(chunk.index))
+
+        self.n_seen += len(chunk.index)
+
+        # only rows that beat the current largest kept key can enter
+        candidates = keys < self.threshold()
+        if not candidates.any():
+            return
+
+        chunk = chunk[candidates]
+        keys = keys[candidates]
+
+        kept = chunk if self.kept is None else pd.concat([self.kept, chunk], ignore_index=True)
+        keys = np.concatenate([self.keys, keys])
+
+        order = np.argsort(keys, kind='stable')[:self.size]
+        self.kept = kept.iloc[order].reset_index(drop=True)
+        self.keys = keys[order]
+
+    def take(self, n):
+        '''
+        The n rows with the smallest keys, itself a uniform sample of the stream
+        '''
+        if self.kept is None:
+            return None
+
+        return self.kept.iloc[:n]
+
+
+class Stratified_Reservoir:
+
+    """
+    One reservoir per stratum (e.g. month or retweet vs original), each able
+    to hold the whole sample. The rows per stratum are only decided at the end,
+    once the size of every stratum is known: proportional to the stratum
+    sizes, or equal for every stratum with the leftover of small strata spread
+    over the others.
+    """
+
+    def __init__(self, size, stratify, seed=0, allocation='proportional'):
+
+        self.size = size
+        self.stratify = stratify
+        self.allocation = allocation
+        self.rng = np.random.default_rng(seed)
+        self.reservoirs = {}
+
+    def add(self, chunk):
+
+        keys = self.rng.random(len(chunk.index))
+        strata = strata_of(chunk, self.stratify)
+
+        codes, uniques = pd.factorize(strata)
+
+        for code, stratum in enumerate(uniques):
+
+            positions = np.flatnonzero(codes == code)
+
+            if stratum not in self.reservoirs:
+                self.reservoirs[stratum] = Reservoir(self.size)
+
+            self.reservoirs[stratum].add(chunk.iloc[positions], keys[positions])
+
+    def allocate(self):
+
+        strata = sorted(self.reservoirs)
+        available = np.array([min(self.reservoirs[s].n_seen, self.size) for s in strata])
+        total = min(self.size, int(available.sum()))
+
+        if self.allocation == 'proportional':
+
+            seen = np.array([self.reservoirs[s].n_seen for s in strata], dtype=np.float64)
+            quotas = seen / seen.sum() * total
+            counts = np.floor(quotas).astype(int)
+
+            # largest remainders get the rows lost to rounding
+            for i in np.argsort(counts - quotas, kind='stable')[:total - counts.sum()]:
+                counts[i] += 1
+
+            return dict(zip(strata, counts))
+
+        counts = np.zeros(len(strata), dtype=int)
+
+        # fill strata evenly, small strata give their leftover to the others
+        while counts.sum() < total:
+            open_strata = np.flatnonzero(counts < available)
+            share = max((total - counts.sum()) // len(open_strata), 1)
+            for i in open_strata[:total - counts.sum()]:
+                counts[i] = min(counts[i] + share, available[i])
+
+        return dict(zip(strata, counts))
+
+    def take(self):
+
+        samples = [self.reservoirs[stratum].take(n)
+                   for stratum, n in self.allocate().items() if n > 0]
+
+        return pd.concat(samples, ignore_index=True) if len(samples) > 0 else None
+
+
+def sample_chunks(chunks, size, seed=0, stratify=None, allocation='proportional'):
+    '''
+    Reproducible sample of size rows from an iterable of dataframes, read in
+    one pass. With stratify ('month' or 'tweet_type') the sample is drawn per
+    stratum with the given allocation ('proportional' or 'equal').
+    '''
+    if stratify is None:
+        sampler = Reservoir(size, seed)
+    else:
+        sampler = Stratified_Reservoir(size, stratify, seed, allocation)
+
+    columns = None
+
+    for chunk in chunks:
+        columns = chunk.columns
+        sampler.add(chunk)
+
+    sample = sampler.take(size) if stratify is None else sampler.take()
+
+    if sample is None:
+        return pd.DataFrame(columns=columns)
+
+    return sample.reset_index(drop=True)
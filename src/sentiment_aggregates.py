@@ -0,0 +1,180 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+
+from tweet_storage import UNKNOWN_MONTH
+
+
+SENTIMENT_COLS = ['negative', 'neutral', 'positive']
+
+# Columns added to the movies dataframe by the sentiment metrics
+SCORE_COLUMNS = ['perc_negative', 'perc_neutral', 'perc_positive',
+                 'neg_score_avg', 'neutr_score_avg', 'pos_score_avg',
+                 'sentiment_score', 'n_tweets']
+
+# Weight of the negative, neutral and positive probability in the sentiment score
+SENTIMENT_WEIGHTS = np.array([-1, 0, 1])
+
+
+def metrics_from_totals(counts, sums, n_tweets):
+    '''
+    Sentiment metrics from the number of tweets per dominant sentiment and the
+    sums of the negative, neutral and positive probabilities
+    '''
+    # 1-Percentage of tweets per cattegory
+    perc = np.round(np.asarray(counts) * 100 / n_tweets, 2)
+
+    # 2-Average probability for each cattegory
+    score_avg = np.round(np.asarray(sums) / n_tweets, 2)
+
+    # 3-Combined score weighting the different scores of the model
+    sentiment_score = np.round(np.dot(sums, SENTIMENT_WEIGHTS) / n_tweets, 4)
+
+    return pd.Series(np.concatenate([perc, score_avg, [sentiment_score, n_tweets]]),
+                     index=SCORE_COLUMNS)
+
+
+class Sentiment_Aggregate:
+
+    """
+    Totals of the model output for one movie, kept per month: number of tweets
+    per dominant sentiment, sums of the probabilities and number of tweets.
+    Aggregates are updated with new rows only and merged across shards, and
+    all movie metrics are derived from them without reading the tweets again.
+    """
+
+    def __init__(self):
+
+        # month -> (counts per dominant sentiment, sums of probabilities)
+        self.counts = {}
+        self.sums = {}
+
+    def update(self, probabilities, months=None):
+
+        probabilities = np.asarray(probabilities, dtype=np.float64)
+
+        if months is None:
+            months = np.full(probabilities.shape[0], UNKNOWN_MONTH, dtype=object)
+
+        months = pd.Series(months).fillna(UNKNOWN_MONTH).to_numpy(dtype=object)
+        dominant = np.argmax(probabilities, axis=1)
+
+        month_codes, unique_months = pd.factorize(months)
+
+        # counts and sums of every month of the chunk in one pass
+        counts = np.zeros((len(unique_months), 3), dtype=np.int64)
+        np.add.at(counts, (month_codes, dominant), 1)
+        sums = np.zeros((len(unique_months), 3), dtype=np.float64)
+        np.add.at(sums, month_codes, probabilities)
+
+        for i, month in enumerate(unique_months):
+            self.add_month(month, counts[i], sums[i])
+
+    def add_month(self, month, counts, sums):
+
+        self.counts[month] = self.counts.get(month, np.zeros(3, dtype=np.int64)) + counts
+        self.sums[month] = self.sums.get(month, np.zeros(3, dtype=np.float64)) + sums
+
+    def merge(self, other):
+
+        for month in other.counts:
+            self.add_month(month, other.counts[month], other.sums[month])
+
+        return self
+
+    def totals(self, months=None):
+
+        months = list(self.counts) if months is None else months
+        counts = sum((self.counts[month] for month in months), np.zeros(3, dtype=np.int64))
+        sums = sum((self.sums[month] for month in months), np.zeros(3, dtype=np.float64))
+
+        return counts, sums, int(counts.sum())
+
+    def scores(self, months=None):
+        '''
+        Same metrics as calculate_moviescores.sentiment_metrics on the raw rows
+        '''
+        counts, sums, n_tweets = self.totals(months)
+
+        return metrics_from_totals(counts, sums, n_tweets)
+
+    def monthly_scores(self):
+
+        months = sorted(self.counts)
+
+        return pd.DataFrame([self.scores([month]) for month in months], index=months)
+
+    def to_dict(self):
+
+        return {
+            month: {'counts': self.counts[month].tolist(), 'sums': self.sums[month].tolist()}
+            for month in sorted(self.counts)
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+
+        aggregate = cls()
+
+        for month, totals in data.items():
+            aggregate.add_month(month, np.array(totals['counts'], dtype=np.int64),
+                                np.array(totals['sums'], dtype=np.float64))
+
+        return aggregate
+
+
+def aggregate_path(sentiment_path):
+    '''
+    Aggregate state stored next to a <movie>_sentiment.csv file
+    '''
+    return os.path.splitext(sentiment_path)[0] + '_aggregate.json'
+
+
+def save_aggregate(aggregate, sentiment_path):
+    '''
+    Save the aggregate of a sentiment output together with the size of the
+    output it covers, so a stale aggregate can be detected
+    '''
+    path = aggregate_path(sentiment_path)
+    tmp_path = path + '.tmp'
+
+    with open(tmp_path, 'w') as write_file:
+        json.dump({'out_bytes': os.path.getsize(sentiment_path),
+                   'months': aggregate.to_dict()}, write_file, indent=4)
+
+    os.replace(tmp_path, path)
+
+
+def load_aggregate(sentiment_path):
+    '''
+    Aggregate of a sentiment output, or None when there is none or the output
+    changed since it was saved
+    '''
+    path = aggregate_path(sentiment_path)
+
+    if not os.path.exists(path) or not os.path.exists(sentiment_path):
+        return None
+
+    with open(path, 'r') as read_file:
+        data = json.load(read_file)
+
+    if data['out_bytes'] != os.path.getsize(sentiment_path):
+        return None
+
+    return Sentiment_Aggregate.from_dict(data['months'])
+
+
+def build_aggregate(sentiment_path, chunk_size=100000):
+    '''
+    Aggregate a whole sentiment output, reading only the columns it needs
+    '''
+    aggregate = Sentiment_Aggregate()
+    header = pd.read_csv(sentiment_path, sep='\t', nrows=0).columns
+    columns = SENTIMENT_COLS + (['month'] if 'month' in header else [])
+
+    for chunk in pd.read_csv(sentiment_path, sep='\t', usecols=columns, chunksize=chunk_size):
+        months = chunk['month'] if 'month' in chunk else None
+        aggregate.update(chunk[SENTIMENT_COLS].to_numpy(), months)
+
+    return aggregate
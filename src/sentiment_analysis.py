@@ -1,18 +1,105 @@
 import os
+import json
+import argparse
 import pathlib
+import multiprocessing
 import pandas as pd
 import datetime as dt
+import threading
 import numpy as np
 
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
-from scipy.special import softmax
 
-from transformers import AutoModelForSequenceClassification
-from transformers import TFAutoModelForSequenceClassification
-from transformers import AutoTokenizer, AutoConfig
+# torch and transformers take seconds to import, they are only imported
+# once a model is loaded
+from count_tweets import file_rows
+from sentiment_aggregates import (
+    SENTIMENT_COLS,
+    Sentiment_Aggregate,
+    build_aggregate,
+    load_aggregate,
+    save_aggregate,
+)
+from sampling import STRATA, sample_chunks
+from sentiment_cache import Sentiment_Cache
+from text_clustering import Near_Duplicate_Index, preprocess
+from tweet_storage import (
+    SCORED_COLUMNS,
+    check_columns,
+    csv_to_parquet,
+    read_tweet_chunks,
+    tweet_csv_files,
+)
 
 MODEL = "cardiffnlp/twitter-roberta-base-sentiment-latest"
 
+# fp32 pytorch, dynamically quantized int8 pytorch and onnx runtime on cpu
+BACKENDS = ["torch", "int8", "onnx"]
+ONNX_MODEL_PATH = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "data/cache/onnx/model.onnx")
+)
+
+# With several workers every chunk of tweets is split into this many shards
+# per worker, and a chunk holds about this many tweets per shard so the pool
+# is not waiting on the slowest shard of a small chunk after every chunk
+SHARDS_PER_WORKER = 4
+ROWS_PER_SHARD = 256
+MIN_CHUNK_SIZE = 1000
+
+
+def softmax(logits, axis=-1):
+    """
+    Softmax of the logits along axis, shifted by the maximum for stability
+    """
+
+    exp = np.exp(logits - np.max(logits, axis=axis, keepdims=True))
+
+    return exp / np.sum(exp, axis=axis, keepdims=True)
+
+
+def fixed_size_batches(n_texts, batch_size):
+    """
+    Split indices of texts into consecutive batches of batch_size rows
+    """
+
+    return [
+        np.arange(start, min(start + batch_size, n_texts))
+        for start in range(0, n_texts, batch_size)
+    ]
+
+
+def length_bucketed_batches(lengths, max_tokens, max_batch_size=None):
+    """
+    Sort texts by token length and group them into batches whose padded size
+    (rows * longest text) stays under max_tokens, so short tweets are not
+    padded to the length of long ones
+    """
+
+    order = np.argsort(lengths, kind="stable")
+    batches = []
+    batch = []
+    longest = 0
+
+    for i in order:
+
+        longest_with_i = max(longest, lengths[i])
+        too_many_tokens = (len(batch) + 1) * longest_with_i > max_tokens
+        too_many_rows = max_batch_size is not None and len(batch) >= max_batch_size
+
+        if batch and (too_many_tokens or too_many_rows):
+            batches.append(np.array(batch))
+            batch = []
+            longest_with_i = lengths[i]
+
+        batch.append(i)
+        longest = longest_with_i
+
+    if batch:
+        batches.append(np.array(batch))
+
+    return batches
+
 
 class Roberta_Sentiment:
 
@@ -21,24 +108,101 @@ class Roberta_Sentiment:
     https://huggingface.co/cardiffnlp/twitter-roberta-base-sentiment-latest
     """
 
-    def __init__(self):
-        self.tokenizer = AutoTokenizer.from_pretrained(MODEL, device_map="auto")
-        self.config = AutoConfig.from_pretrained(MODEL, device_map="auto")
-        self.model = AutoModelForSequenceClassification.from_pretrained(MODEL, device_map="auto")
+    def __init__(self, backend="torch", model_dir=None):
 
-    # Preprocess text (username and link placeholders)
-    def preprocess(self, text):
+        if backend not in BACKENDS:
+            raise ValueError(f"unknown backend {backend}, expected one of {BACKENDS}")
+
+        import torch
+        from transformers import AutoConfig, AutoModelForSequenceClassification, AutoTokenizer
+
+        # a local copy of the model (see save_model) is loaded without any network access
+        source = MODEL if model_dir is None else model_dir
+        offline = {"local_files_only": model_dir is not None}
+
+        self.backend = backend
+        self.tokenizer = AutoTokenizer.from_pretrained(source, device_map="auto", **offline)
+        self.config = AutoConfig.from_pretrained(source, device_map="auto", **offline)
+        self.model = AutoModelForSequenceClassification.from_pretrained(
+            source, device_map="auto", **offline)
+        self.model.eval()
+        self.session = None
+
+        if backend == "int8":
 
-        text = str(text)
-        new_text = []
+            # weights of the linear layers are stored as int8, activations
+            # are quantized on the fly
+            self.model = torch.quantization.quantize_dynamic(
+                self.model, {torch.nn.Linear}, dtype=torch.qint8
+            )
 
-        for t in text.split(" "):
+        elif backend == "onnx":
 
-            t = "@user" if t.startswith("@") and len(t) > 1 else t
-            t = "http" if t.startswith("http") else t
-            new_text.append(t)
+            self.session = self.load_onnx_session(ONNX_MODEL_PATH)
+
+    def load_onnx_session(self, onnx_path):
+
+        import onnxruntime
+        import torch
+
+        if not os.path.exists(onnx_path):
+            self.export_onnx(onnx_path)
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = torch.get_num_threads()
+
+        return onnxruntime.InferenceSession(
+            onnx_path, options, providers=["CPUExecutionProvider"]
+        )
 
-        return " ".join(new_text)
+    def export_onnx(self, onnx_path):
+
+        import torch
+
+        os.makedirs(os.path.dirname(onnx_path), exist_ok=True)
+        dummy_input = self.tokenizer(["exporting the model"], return_tensors="pt")
+
+        torch.onnx.export(
+            self.model,
+            (dummy_input["input_ids"], dummy_input["attention_mask"]),
+            onnx_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["logits"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "logits": {0: "batch"},
+            },
+            opset_version=14,
+        )
+
+    # run the selected backend on a padded batch, returns logits
+    def forward(self, features):
+
+        if self.backend == "onnx":
+
+            encoded_input = self.tokenizer.pad(features, return_tensors="np")
+            inputs = {
+                "input_ids": encoded_input["input_ids"].astype(np.int64),
+                "attention_mask": encoded_input["attention_mask"].astype(np.int64),
+            }
+
+            return self.session.run(["logits"], inputs)[0]
+
+        import torch
+
+        encoded_input = self.tokenizer.pad(features, return_tensors="pt")
+
+        with torch.inference_mode():
+            output = self.model(**encoded_input)
+
+        return output[0].numpy()
+
+    # Preprocess text (username and link placeholders)
+    @staticmethod
+    def preprocess(text):
+
+        return preprocess(text)
 
     # get sentiment for text
     def get_sentiment(self, text, print_sentiment_score=False):
@@ -63,6 +227,38 @@ class Roberta_Sentiment:
 
         return scores_rounded
 
+    # get sentiment for a list of texts, one forward pass per batch
+    def get_sentiment_batch(self, texts, batch_size=32, max_tokens=None):
+
+        texts = [self.preprocess(text) for text in texts]
+        logits = np.zeros((len(texts), len(self.config.id2label)), dtype=np.float32)
+
+        if len(texts) == 0:
+            return logits
+
+        # tokenize once without padding, batches are padded separately
+        encoded = self.tokenizer(texts, truncation=True)
+
+        if max_tokens is None:
+            batches = fixed_size_batches(len(texts), batch_size)
+        else:
+            lengths = [len(ids) for ids in encoded["input_ids"]]
+            batches = length_bucketed_batches(lengths, max_tokens)
+
+        for batch in tqdm(batches):
+
+            features = [
+                {key: encoded[key][i] for key in encoded.keys()} for i in batch
+            ]
+
+            # pad only to the longest text in the batch
+            # and scatter back to the original order of texts
+            logits[batch] = self.forward(features)
+
+        scores = softmax(logits, axis=1)
+
+        return np.round(scores, 4)
+
     def print_sentiment(self, scores):
 
         ranking = np.argsort(scores)
@@ -75,12 +271,88 @@ class Roberta_Sentiment:
             print(f"{i+1}) {l} {np.round(float(s), 4)}")
 
 
+# Models loaded in this process, shared by every reader with the same backend and model
+_models = {}
+_models_lock = threading.Lock()
+
+
+def load_model(backend="torch", model_dir=None):
+    """
+    Model of the backend, loaded on the first call of the process and shared
+    by all later calls
+    """
+
+    key = (backend, model_dir)
+
+    with _models_lock:
+        if key not in _models:
+            _models[key] = Roberta_Sentiment(backend=backend, model_dir=model_dir)
+
+    return _models[key]
+
+
+def save_model(model_dir):
+    """
+    Download the model into model_dir, to be loaded offline with model_dir
+    """
+
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+    # the model is saved with its config
+    for auto_class in [AutoTokenizer, AutoModelForSequenceClassification]:
+        auto_class.from_pretrained(MODEL).save_pretrained(model_dir)
+
+
+# Settings of the model of a worker process of the CSV_reader pool
+_worker_model = None
+
+
+def init_worker(num_threads, backend, model_dir=None):
+
+    global _worker_model
+
+    import torch
+
+    torch.set_num_threads(num_threads)
+    # the model itself is loaded by the first shard the worker scores
+    _worker_model = (backend, model_dir)
+
+
+def score_shard(texts, batch_size, max_tokens):
+
+    return load_model(*_worker_model).get_sentiment_batch(
+        texts, batch_size=batch_size, max_tokens=max_tokens
+    )
+
+
+def load_checkpoint(checkpoint_path):
+
+    if not os.path.exists(checkpoint_path):
+        return None
+
+    with open(checkpoint_path, "r") as read_file:
+        return json.load(read_file)
+
+
+def save_checkpoint(checkpoint, checkpoint_path):
+
+    # write to a temporary file first so a crash never leaves half a checkpoint
+    tmp_path = checkpoint_path + ".tmp"
+
+    with open(tmp_path, "w") as write_file:
+        json.dump(checkpoint, write_file, indent=4)
+
+    os.replace(tmp_path, checkpoint_path)
+
+
 class CSV_reader:
     """
     Reading all csv files from each movie directory and running sentiment analysis on it
     """
 
-    def __init__(self, csv_file=None):
+    def __init__(self, csv_file=None, batch_size=32, max_tokens=None, workers=1,
+                 cache_path=None, backend="torch", storage="csv", sample_seed=0,
+                 sample_stratify=None, near_duplicates=False, model_dir=None):
 
         if csv_file is not None:
 
@@ -93,7 +365,127 @@ class CSV_reader:
         self.movies_path = os.path.abspath(
             os.path.join(os.path.dirname(__file__), "..", "data/twitter")
         )
-        self.roberta = Roberta_Sentiment()
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.workers = workers
+        self.pool = None
+        self.backend = backend
+        self.model_dir = model_dir
+        self.storage = storage
+        self.sample_seed = sample_seed
+        self.sample_stratify = sample_stratify
+        # near duplicate tweets share the score of their cluster leader
+        self.near_duplicates = near_duplicates
+        self.clusters = Near_Duplicate_Index() if near_duplicates else None
+        # scores of other backends differ slightly, so they are cached apart
+        self.model_name = MODEL if backend == "torch" else f"{MODEL}:{backend}"
+        self.cache = Sentiment_Cache(cache_path) if cache_path is not None else None
+        self.n_texts = 0
+        self.n_scored = 0
+
+    @property
+    def roberta(self):
+
+        # loaded when the first tweet misses the cache, with several workers
+        # every process of the pool loads its own model instead
+        return load_model(self.backend, self.model_dir)
+
+    def get_pool(self):
+
+        if self.pool is None:
+
+            # split the cores between workers so they do not oversubscribe
+            num_threads = max(1, os.cpu_count() // self.workers)
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_worker,
+                initargs=(num_threads, self.backend, self.model_dir),
+            )
+
+        return self.pool
+
+    def close(self):
+
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+        if self.cache is not None:
+            self.cache.close()
+
+    def report_cache_stats(self):
+
+        print(f"tweets: {self.n_texts}, scored by the model: {self.n_scored}")
+
+        if self.clusters is not None:
+            print(
+                f"near duplicate clusters: {self.clusters.n_clusters()} "
+                f"for {self.clusters.n_texts} tweets of the last movie"
+            )
+
+        if self.cache is not None:
+            print(
+                f"cache hit rate: {100 * self.cache.hit_rate():.1f}% "
+                f"({self.cache.hits} hits, {self.cache.misses} misses)"
+            )
+
+    def score_texts(self, texts):
+
+        # identical texts after preprocessing (e.g. retweets) are scored once
+        texts = [Roberta_Sentiment.preprocess(text) for text in texts]
+        codes, unique_texts = pd.factorize(pd.Series(texts, dtype=object))
+        unique_scores = np.zeros((len(unique_texts), 3), dtype=np.float32)
+
+        missing = np.arange(len(unique_texts))
+
+        if self.cache is not None:
+
+            keys = [Sentiment_Cache.make_key(self.model_name, text) for text in unique_texts]
+            cached = self.cache.get_many(keys)
+
+            for i, key in enumerate(keys):
+                if key in cached:
+                    unique_scores[i] = cached[key]
+
+            missing = np.array([i for i, key in enumerate(keys) if key not in cached], dtype=int)
+
+        if len(missing) > 0:
+
+            scores = self.run_model([unique_texts[i] for i in missing])
+            unique_scores[missing] = scores
+
+            if self.cache is not None:
+                self.cache.put_many([keys[i] for i in missing], scores)
+
+        self.n_texts += len(texts)
+        self.n_scored += len(missing)
+
+        return unique_scores[codes]
+
+    def run_model(self, texts):
+
+        if self.workers == 1:
+
+            return self.roberta.get_sentiment_batch(
+                texts, batch_size=self.batch_size, max_tokens=self.max_tokens
+            )
+
+        # more shards than workers so a slow shard does not stall the pool,
+        # map returns results in shard order so the merge is deterministic
+        n_shards = min(len(texts), self.workers * SHARDS_PER_WORKER)
+        if n_shards == 0:
+            return np.zeros((0, 3), dtype=np.float32)
+
+        shards = [list(shard) for shard in np.array_split(np.array(texts, dtype=object), n_shards)]
+        results = self.get_pool().map(
+            score_shard,
+            shards,
+            [self.batch_size] * n_shards,
+            [self.max_tokens] * n_shards,
+        )
+
+        return np.concatenate(list(results))
 
     def get_movie_dirs(self):
 
@@ -105,128 +497,243 @@ class CSV_reader:
 
     def get_csv_files(self, directory):
 
-        csv_files = []
-
-        for file in os.listdir(directory):
-
-            if file.endswith(".csv") and file.startswith("start_"):
-                csv_files.append(os.path.join(directory, file))
+        # the dehydrated copies and any file without text are left out
+        # here, before a checkpoint or output is written
+        return tweet_csv_files(directory, required_columns=SCORED_COLUMNS)
 
-        return csv_files
+    def score_df(self, df):
 
-    def read_tweets_from_files(self, files):
+        texts = df["text"].tolist()
 
-        all_tweets = pd.DataFrame()
+        if self.clusters is not None:
+            # only the leader of every cluster goes to the model
+            df["cluster_id"], texts = self.clusters.assign(texts)
 
-        for file in files:
+        scores = self.score_texts(texts)
 
-            df = pd.read_csv(file)
-            all_tweets = pd.concat([all_tweets, df], ignore_index=True)
+        df["negative"] = scores[:, 0]
+        df["neutral"] = scores[:, 1]
+        df["positive"] = scores[:, 2]
 
-        return all_tweets
+        return df
 
     def run_analysis_on_file(self, file, out_file_path, size=None):
 
         df = pd.read_csv(file)
-        length = len(df.index)
-        df = df.assign(negative=pd.Series(np.zeros(length)).values)
-        df = df.assign(neutral=pd.Series(np.zeros(length)).values)
-        df = df.assign(positive=pd.Series(np.zeros(length)).values)
+        self.run_analysis_on_df(df, out_file_path, size=size)
+
+    def run_analysis_on_df(self, df, out_file_path, size=None):
 
         if size is not None:
 
-            size = max(size, length)
+            size = min(size, len(df.index))
             print(f"using sample size {size}")
+            df = df.sample(size, random_state=self.sample_seed)
             print(f"df sample size is {len(df.index)}")
-            df = df.sample(size)
 
-        negative = [0]*size
-        neutral = [0]*size
-        positive = [0]*size
+        df = df.reset_index()
+        df = self.score_df(df)
 
-        df.reset_index(inplace=True)
+        df.to_csv(out_file_path, sep="\t", encoding="utf-8", index=False)
 
-        for index, row in tqdm(df.iterrows()):
+        aggregate = Sentiment_Aggregate()
+        aggregate.update(df[SENTIMENT_COLS].to_numpy(), df.get("month"))
+        save_aggregate(aggregate, out_file_path)
 
-            text = row["text"]
-            scores = self.roberta.get_sentiment(text)
+    def chunk_size(self):
+        """
+        Tweets read and scored at a time, enough for every worker to get
+        several full shards
+        """
+        return max(MIN_CHUNK_SIZE, self.workers * SHARDS_PER_WORKER * ROWS_PER_SHARD)
 
-            negative[index]=scores[0]
-            neutral[index]=scores[1]
-            positive[index]=scores[2]
+    def run_incremental_on_files(self, files, out_file_path, checkpoint_path, chunk_size=None):
+        """
+        Score all tweets of the files, appending results to out_file_path chunk
+        by chunk. Progress is recorded in checkpoint_path so an interrupted run
+        resumes where it stopped and a rerun only scores files that are new.
+        """
 
-        df["negative"] = negative
-        df["neutral"] = neutral
-        df["positive"] = positive
+        chunk_size = chunk_size or self.chunk_size()
 
-        df.to_csv(out_file_path, sep="\t", encoding="utf-8", index=False)
+        # a file without text would fail halfway, after the output was touched
+        check_columns(files, SCORED_COLUMNS)
 
-    def run_analysis_on_df(self, df, out_file_path, size=None):
+        checkpoint = load_checkpoint(checkpoint_path)
 
-        length = len(df.index)
-        df = df.assign(negative=pd.Series(np.zeros(length)).values)
-        df = df.assign(neutral=pd.Series(np.zeros(length)).values)
-        df = df.assign(positive=pd.Series(np.zeros(length)).values)
+        if checkpoint is None or not os.path.exists(out_file_path):
 
-        if size is not None:
+            # output is not ours to extend, start from scratch
+            if os.path.exists(out_file_path):
+                os.remove(out_file_path)
 
-            size = min(size, length)
-            print(f"using sample size {size}")
-            df = df.sample(size)
-            print(f"df sample size is {len(df.index)}")
+            checkpoint = {
+                "done_files": [],
+                "current_file": None,
+                "rows_done": 0,
+                "last_id": None,
+                "columns": None,
+                "out_bytes": 0,
+            }
 
-        negative = [0]*size
-        neutral = [0]*size
-        positive = [0]*size
-        
-        df.reset_index(inplace=True)
-            
-        for index, row in tqdm(df.iterrows()):
+        else:
 
-            text = row["text"]
-            scores = self.roberta.get_sentiment(text)
+            # drop rows appended after the last checkpoint was saved
+            os.truncate(out_file_path, checkpoint["out_bytes"])
 
-            negative[index]=scores[0]
-            neutral[index]=scores[1]
-            positive[index]=scores[2]
+        # totals of the rows already in the output, rebuilt if they are stale
+        aggregate = Sentiment_Aggregate()
 
-        df["negative"] = negative
-        df["neutral"] = neutral
-        df["positive"] = positive
+        if checkpoint["out_bytes"] > 0:
+            aggregate = load_aggregate(out_file_path) or build_aggregate(out_file_path)
 
-        df.to_csv(out_file_path, sep="\t", encoding="utf-8", index=False)
+        new_files = [
+            file for file in files
+            if os.path.basename(file) not in checkpoint["done_files"]
+        ]
+        print(f"{len(files) - len(new_files)} files already scored, {len(new_files)} to go")
 
-    def run_sentiment_analysis(self, sample_size=None):
+        skip_rows = {}
 
-        if self.csv_file is None:
+        if checkpoint["current_file"] is not None:
 
-            movie_dirs = self.get_movie_dirs()
+            skip_rows[checkpoint["current_file"]] = checkpoint["rows_done"]
+            print(
+                f"resuming {checkpoint['current_file']} after row {checkpoint['rows_done']} "
+                f"(tweet {checkpoint['last_id']})"
+            )
 
-            for movie_dir in movie_dirs:
+        # number of tweets to score from the dataset manifest, for the progress bar
+        n_rows = sum(file_rows(new_files).values()) - sum(skip_rows.values())
+        progress = tqdm(total=n_rows, unit="tweets", desc=os.path.basename(out_file_path))
+
+        chunks = read_tweet_chunks(new_files, chunk_size=chunk_size, skip_rows=skip_rows,
+                                   required_columns=SCORED_COLUMNS)
+        previous_file = checkpoint["current_file"]
+
+        for file_name, rows_read, chunk in chunks:
+
+            if previous_file is not None and file_name != previous_file:
+                self.mark_file_done(checkpoint, checkpoint_path, previous_file)
+
+            previous_file = file_name
+
+            if len(chunk.index) > 0:
+
+                chunk = self.score_df(chunk)
+
+                if checkpoint["columns"] is None:
+                    checkpoint["columns"] = list(chunk.columns)
+
+                chunk = chunk.reindex(columns=checkpoint["columns"])
+                chunk.to_csv(
+                    out_file_path,
+                    mode="a",
+                    header=checkpoint["out_bytes"] == 0,
+                    sep="\t",
+                    encoding="utf-8",
+                    index=False,
+                )
+
+                aggregate.update(chunk[SENTIMENT_COLS].to_numpy(), chunk.get("month"))
+                save_aggregate(aggregate, out_file_path)
 
-                csv_files = self.get_csv_files(movie_dir)
+                checkpoint["last_id"] = str(chunk["id"].iloc[-1])
+                checkpoint["out_bytes"] = os.path.getsize(out_file_path)
 
-                if len(csv_files) >= 0:
+            progress.update(rows_read - (checkpoint["rows_done"]
+                                         if checkpoint["current_file"] == file_name else 0))
 
-                    df = self.read_tweets_from_files(csv_files)
+            checkpoint["current_file"] = file_name
+            checkpoint["rows_done"] = rows_read
+            save_checkpoint(checkpoint, checkpoint_path)
 
-                    movie_name = os.path.basename(os.path.normpath(movie_dir))
-                    out_file_name = f"{movie_name}_sentiment.csv"
-                    out_file_path = os.path.join(movie_dir, out_file_name)
+        progress.close()
+
+        if previous_file is not None:
+            self.mark_file_done(checkpoint, checkpoint_path, previous_file)
+
+    def mark_file_done(self, checkpoint, checkpoint_path, file_name):
+
+        checkpoint["done_files"].append(file_name)
+        checkpoint["current_file"] = None
+        checkpoint["rows_done"] = 0
+        save_checkpoint(checkpoint, checkpoint_path)
+
+    def run_on_movie_dir(self, movie_dir, sample_size=None):
+        """
+        Score the tweets of one movie directory into <movie>_sentiment.csv,
+        returns the path of the output or None when there are no tweets
+        """
+        csv_files = self.get_csv_files(movie_dir)
+
+        if len(csv_files) == 0:
+            print(f"No csv files found in {movie_dir}")
+            return None
+
+        movie_name = os.path.basename(os.path.normpath(movie_dir))
+        out_file_name = f"{movie_name}_sentiment.csv"
+
+        if self.near_duplicates:
+            # clusters never span movies
+            self.clusters = Near_Duplicate_Index()
+        out_file_path = os.path.join(movie_dir, out_file_name)
+
+        print(
+            f"starting sentiment analysis on {movie_name} at {dt.datetime.now()}"
+        )
+
+        checkpoint_path = os.path.join(
+            movie_dir, f"{movie_name}_sentiment_checkpoint.json"
+        )
 
-                    print(
-                        f"starting sentiment analysis on {movie_name} at {dt.datetime.now()}"
-                    )
-                    self.run_analysis_on_df(df, out_file_path, size=sample_size)
-                    print(
-                        f"finished sentiment analysis on {movie_name} at {dt.datetime.now()}"
-                    )
-                    print(
-                        f"saved sentiment analysis on {movie_name} to {out_file_path}"
-                    )
+        if sample_size is None:
 
-                else:
-                    print(f"No csv files found in {movie_dir}")
+            # full runs are resumable and only score new files
+            self.run_incremental_on_files(
+                csv_files, out_file_path, checkpoint_path
+            )
+
+        else:
+
+            # a sampled output cannot be extended by a later full run
+            if os.path.exists(checkpoint_path):
+                os.remove(checkpoint_path)
+
+            # one pass over the files, only the sample is kept in memory
+            chunks = (chunk for _, _, chunk in read_tweet_chunks(
+                csv_files, chunk_size=100000, required_columns=SCORED_COLUMNS))
+            df = sample_chunks(chunks, sample_size, seed=self.sample_seed,
+                               stratify=self.sample_stratify)
+            print(f"sampled {len(df.index)} tweets (seed {self.sample_seed})")
+
+            self.run_analysis_on_df(df, out_file_path)
+
+        print(
+            f"finished sentiment analysis on {movie_name} at {dt.datetime.now()}"
+        )
+        print(
+            f"saved sentiment analysis on {movie_name} to {out_file_path}"
+        )
+
+        if self.storage == "parquet":
+
+            n_rows = csv_to_parquet(out_file_path, "sentiment", movie_name)
+            print(f"stored {n_rows} rows of {movie_name} sentiment as parquet")
+
+        return out_file_path
+
+    def run_sentiment_analysis(self, sample_size=None):
+
+        if self.csv_file is None:
+
+            movie_dirs = self.get_movie_dirs()
+
+            for movie_dir in movie_dirs:
+
+                self.run_on_movie_dir(movie_dir, sample_size)
+
+            self.report_cache_stats()
 
         else:
 
@@ -240,9 +747,62 @@ class CSV_reader:
             print(f"starting sentiment analysis on {file_name} at {dt.datetime.now()}")
             self.run_analysis_on_file(file, out_file_path)
             print(f"finished sentiment analysis on {file_name} at {dt.datetime.now()}")
+            self.report_cache_stats()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Run sentiment analysis on tweets")
+    parser.add_argument("--csv-file", default=None)
+    parser.add_argument("--sample-size", type=int, default=10000,
+                        help="number of tweets sampled per movie, 0 scores all of them")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--max-tokens", type=int, default=4096)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--cache", default=os.path.abspath(
+        os.path.join(os.path.dirname(__file__), "..", "data/cache/sentiment_cache.sqlite")))
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--backend", choices=BACKENDS, default="torch")
+    parser.add_argument("--storage", choices=["csv", "parquet"], default="csv",
+                        help="also store <movie>_sentiment as partitioned parquet")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the tweet sample")
+    parser.add_argument("--stratify", choices=STRATA, default=None,
+                        help="sample proportionally per month or per retweet/original")
+    parser.add_argument("--near-duplicates", action="store_true",
+                        help="score one tweet per cluster of near duplicates, "
+                             "the cluster ids are kept in a cluster_id column")
+    parser.add_argument("--model-dir", default=None,
+                        help="local copy of the model, loaded without network access")
+    parser.add_argument("--save-model", action="store_true",
+                        help="download the model into --model-dir and exit")
+    args = parser.parse_args()
+
+    if args.save_model:
+        if args.model_dir is None:
+            parser.error("--save-model needs --model-dir")
+        save_model(args.model_dir)
+        print(f"saved {MODEL} to {args.model_dir}")
+        return
+
+    csv_reader = CSV_reader(
+        csv_file=args.csv_file,
+        batch_size=args.batch_size,
+        max_tokens=args.max_tokens,
+        workers=args.workers,
+        cache_path=None if args.no_cache else args.cache,
+        backend=args.backend,
+        storage=args.storage,
+        sample_seed=args.seed,
+        sample_stratify=args.stratify,
+        near_duplicates=args.near_duplicates,
+        model_dir=args.model_dir,
+    )
+
+    try:
+        csv_reader.run_sentiment_analysis(sample_size=args.sample_size or None)
+    finally:
+        csv_reader.close()
 
 
 if __name__ == "__main__":
-
-    csv_reader = CSV_reader()
-    csv_reader.run_sentiment_analysis(sample_size=10000)
+    main()
@@ -0,0 +1,110 @@
+import hashlib
+import os
+import sqlite3
+import time
+import numpy as np
+
+
+# SQLite limits the number of variables bound in one statement
+QUERY_CHUNK_SIZE = 500
+
+
+class Sentiment_Cache:
+
+    """
+    On-disk cache of sentiment scores keyed on a hash of the model name and the
+    preprocessed text of a tweet. Once more than max_entries scores are stored
+    the least recently used ones are evicted.
+    """
+
+    def __init__(self, path, max_entries=2_000_000):
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS scores ("
+            "key TEXT PRIMARY KEY, negative REAL, neutral REAL, positive REAL, "
+            "last_used REAL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS scores_last_used ON scores (last_used)"
+        )
+        self.connection.commit()
+
+    @staticmethod
+    def make_key(model_name, text):
+
+        return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        '''
+        Returns a dict key -> scores for the keys present in the cache and marks
+        them as recently used
+        '''
+        found = {}
+        now = time.time()
+
+        for start in range(0, len(keys), QUERY_CHUNK_SIZE):
+
+            chunk = keys[start:start + QUERY_CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT key, negative, neutral, positive FROM scores WHERE key IN ({placeholders})",
+                chunk,
+            ).fetchall()
+
+            for key, negative, neutral, positive in rows:
+                found[key] = np.array([negative, neutral, positive], dtype=np.float32)
+
+            self.connection.execute(
+                f"UPDATE scores SET last_used = ? WHERE key IN ({placeholders})",
+                [now] + list(chunk),
+            )
+
+        self.connection.commit()
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+
+        return found
+
+    def put_many(self, keys, scores):
+
+        now = time.time()
+        rows = [
+            (key, float(score[0]), float(score[1]), float(score[2]), now)
+            for key, score in zip(keys, scores)
+        ]
+
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?)", rows
+        )
+        self.evict()
+        self.connection.commit()
+
+    def evict(self):
+
+        size = self.connection.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+
+        if size > self.max_entries:
+            self.connection.execute(
+                "DELETE FROM scores WHERE key IN "
+                "(SELECT key FROM scores ORDER BY last_used LIMIT ?)",
+                (size - self.max_entries,),
+            )
+
+    def hit_rate(self):
+
+        lookups = self.hits + self.misses
+
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def close(self):
+
+        self.connection.close()
@@ -0,0 +1,334 @@
+import argparse
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from sentiment_aggregates import SENTIMENT_COLS, SENTIMENT_WEIGHTS
+from tweet_storage import TWITTER_PATH, locate_csv
+
+
+thisfile_path = os.path.dirname(os.path.abspath(__file__))
+project_path = os.path.abspath(os.path.join(thisfile_path, os.pardir))
+
+ROLLUP_PATH = os.path.join(project_path, 'data', 'rollups')
+
+# Day, week (starting on monday) and month periods, keyed by their first day
+FREQS = ['D', 'W', 'M']
+
+COUNT_COLS = ['n_' + col for col in SENTIMENT_COLS]
+SUM_COLS = ['sum_' + col for col in SENTIMENT_COLS]
+TOTAL_COLS = COUNT_COLS + SUM_COLS + ['n_tweets']
+
+# Date of the tweets the api could not date
+UNDATED = '0.0'
+
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def daily_totals(chunk):
+    '''
+    Tweets per dominant sentiment, sums of the probabilities and number of
+    tweets for every day of a chunk of dated sentiment rows
+    '''
+    dates = pd.to_datetime(chunk['date'].where(chunk['date'] != UNDATED),
+                           format='%Y-%m-%d', errors='coerce')
+    dated = dates.notna().to_numpy()
+
+    probabilities = chunk[SENTIMENT_COLS].to_numpy(dtype=np.float64)[dated]
+    dominant = np.argmax(probabilities, axis=1)
+
+    totals = pd.DataFrame(np.eye(3, dtype=np.int64)[dominant], columns=COUNT_COLS)
+    totals[SUM_COLS] = probabilities
+    totals['n_tweets'] = 1
+    totals.index = pd.DatetimeIndex(dates[dated].to_numpy(), name='date')
+
+    return totals.groupby(level='date').sum(), int((~dated).sum())
+
+
+def add_metrics(totals):
+    '''
+    Metrics of every period of a totals table: share of tweets per dominant
+    sentiment, average probabilities, the probability weighted sentiment score
+    of the movie scores, the count based score and the positive to negative
+    ratio of the plots
+    '''
+    n_tweets = totals['n_tweets'].to_numpy(dtype=np.float64)
+    counts = totals[COUNT_COLS].to_numpy(dtype=np.float64)
+    sums = totals[SUM_COLS].to_numpy(dtype=np.float64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        metrics = pd.DataFrame(
+            np.column_stack([
+                counts * 100 / n_tweets[:, None],
+                sums / n_tweets[:, None],
+                sums @ SENTIMENT_WEIGHTS / n_tweets,
+                counts @ SENTIMENT_WEIGHTS / n_tweets,
+                np.where(counts[:, 0] > 0, counts[:, 2] / counts[:, 0], np.nan),
+            ]),
+            index=totals.index,
+            columns=(['perc_' + col for col in SENTIMENT_COLS]
+                     + [col + '_avg' for col in SENTIMENT_COLS]
+                     + ['sentiment_score', 'count_score', 'pos_neg_ratio']))
+
+    return pd.concat([totals, metrics], axis=1)
+
+
+class Movie_Rollup:
+
+    """
+    Daily totals of the model output of one movie, with the weekly and monthly
+    totals derived from them. Totals only ever add up, so new dated rows are
+    merged in without the old ones, and every range or rolling window is
+    answered from the totals alone: range queries with prefix sums over the
+    days, rolling windows with rolling sums of the totals.
+    """
+
+    def __init__(self, daily=None, meta=None):
+
+        if daily is None:
+            daily = pd.DataFrame(
+                {col: pd.Series(dtype=np.float64 if col in SUM_COLS else np.int64)
+                 for col in TOTAL_COLS},
+                index=pd.DatetimeIndex([], name='date'))
+
+        self.daily = daily.sort_index()
+        self.meta = meta or {'rows': 0, 'undated': 0}
+        self.tables = {}
+        self.prefix = None
+
+    def update(self, chunk):
+
+        totals, n_undated = daily_totals(chunk)
+
+        self.daily = pd.concat([self.daily, totals]).groupby(level='date').sum()
+        self.meta['rows'] += len(chunk.index)
+        self.meta['undated'] += n_undated
+
+        # derived tables are rebuilt on next use
+        self.tables = {}
+        self.prefix = None
+
+    def totals(self, freq='D'):
+
+        if freq not in self.tables:
+            if freq == 'D':
+                self.tables[freq] = self.daily
+            else:
+                starts = self.daily.index.to_period(freq).start_time
+                self.tables[freq] = self.daily.groupby(starts.rename('date')).sum()
+
+        return self.tables[freq]
+
+    def series(self, freq='D'):
+        '''
+        Totals and metrics of every day, week or month with tweets
+        '''
+        return add_metrics(self.totals(freq))
+
+    def range_totals(self, start=None, end=None):
+        '''
+        Totals of the tweets from start to end (dates included), from two
+        lookups in the prefix sums of the daily totals
+        '''
+        if self.prefix is None:
+            cumulative = self.daily[TOTAL_COLS].to_numpy(dtype=np.float64).cumsum(axis=0)
+            self.prefix = np.vstack([np.zeros((1, len(TOTAL_COLS))), cumulative])
+
+        days = self.daily.index.to_numpy()
+        first = 0 if start is None else np.searchsorted(days, np.datetime64(pd.Timestamp(start)), 'left')
+        last = len(days) if end is None else np.searchsorted(days, np.datetime64(pd.Timestamp(end)), 'right')
+
+        totals = pd.Series(self.prefix[max(last, first)] - self.prefix[first], index=TOTAL_COLS)
+        totals[COUNT_COLS + ['n_tweets']] = totals[COUNT_COLS + ['n_tweets']].round()
+
+        return totals
+
+    def range_metrics(self, start=None, end=None):
+
+        return add_metrics(self.range_totals(start, end).to_frame().T).iloc[0]
+
+    def rolling(self, window, freq='D', min_periods=1):
+        '''
+        Metrics over a rolling window of `window` days, weeks or months, also
+        counting the periods without tweets
+        '''
+        totals = self.totals(freq)
+
+        if len(totals.index) == 0:
+            return add_metrics(totals)
+
+        # every period of the calendar, so the window spans a fixed time
+        calendar = pd.date_range(totals.index.min(), totals.index.max(),
+                                 freq={'D': 'D', 'W': 'W-MON', 'M': 'MS'}[freq], name='date')
+        totals = totals.reindex(calendar, fill_value=0)
+
+        return add_metrics(totals.rolling(window, min_periods=min_periods).sum())
+
+    def to_table(self):
+
+        frames = [self.totals(freq).reset_index().assign(freq=freq) for freq in FREQS]
+        frame = pd.concat(frames, ignore_index=True)[['freq', 'date'] + TOTAL_COLS]
+
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+
+        return table.replace_schema_metadata({b'rollup': json.dumps(self.meta).encode('utf-8')})
+
+    @classmethod
+    def from_table(cls, table):
+
+        meta = json.loads(table.schema.metadata[b'rollup'])
+        frame = table.to_pandas()
+
+        tables = {freq: group.drop(columns='freq').set_index('date')
+                  for freq, group in frame.groupby('freq')}
+
+        rollup = cls(tables.get('D'), meta)
+        rollup.tables = {freq: tables.get(freq, rollup.daily.iloc[:0]) for freq in FREQS}
+        rollup.tables['D'] = rollup.daily
+
+        return rollup
+
+
+def rollup_path(movie, rollup_dir=ROLLUP_PATH):
+
+    return os.path.join(rollup_dir, f'{movie}.parquet')
+
+
+def save_rollup(rollup, path):
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    pq.write_table(rollup.to_table(), tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_rollup(path):
+
+    if not os.path.exists(path):
+        return None
+
+    return Movie_Rollup.from_table(pq.read_table(path))
+
+
+def prefix_hash(path, n_bytes):
+    '''
+    Hash of the first n_bytes of a file
+    '''
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as read_file:
+        while n_bytes > 0:
+            block = read_file.read(min(HASH_BLOCK_SIZE, n_bytes))
+            if not block:
+                break
+            digest.update(block)
+            n_bytes -= len(block)
+
+    return digest.hexdigest()
+
+
+def read_dated_chunks(dated_path, offset=0, chunk_size=100000):
+    '''
+    Chunks of the date and model output columns of a _sentiment_date.csv
+    file, starting at a row boundary offset bytes into the file
+    '''
+    header = pd.read_csv(dated_path, sep='\t', nrows=0).columns
+    columns = ['date'] + SENTIMENT_COLS
+
+    with open(dated_path, 'rb') as read_file:
+
+        if offset > 0:
+            read_file.seek(offset)
+            reader = pd.read_csv(read_file, sep='\t', header=None, names=header, usecols=columns,
+                                 dtype={'date': str}, chunksize=chunk_size)
+        else:
+            reader = pd.read_csv(read_file, sep='\t', usecols=columns,
+                                 dtype={'date': str}, chunksize=chunk_size)
+
+        for chunk in reader:
+            yield chunk
+
+
+def update_rollup(dated_path, path):
+    '''
+    Bring the rollup at path up to date with a _sentiment_date.csv file. When
+    the file only grew since the last update only the new rows are read,
+    otherwise the rollup is rebuilt. Returns the rollup and the number of rows read.
+    '''
+    rollup = load_rollup(path)
+    source_bytes = os.path.getsize(dated_path)
+    offset = 0
+
+    if rollup is not None and rollup.meta.get('source_bytes', 0) <= source_bytes \
+            and prefix_hash(dated_path, rollup.meta['source_bytes']) == rollup.meta['source_hash']:
+        offset = rollup.meta['source_bytes']
+    else:
+        rollup = Movie_Rollup()
+
+    n_rows = 0
+
+    if offset < source_bytes:
+        for chunk in read_dated_chunks(dated_path, offset):
+            rollup.update(chunk)
+            n_rows += len(chunk.index)
+
+    rollup.meta['source_bytes'] = source_bytes
+    rollup.meta['source_hash'] = prefix_hash(dated_path, source_bytes)
+    save_rollup(rollup, path)
+
+    return rollup, n_rows
+
+
+def rollup_movie(movie_dir, rollup_dir=ROLLUP_PATH):
+    '''
+    Update the rollup of a movie directory, returns the number of days with tweets
+    '''
+    movie = os.path.basename(os.path.normpath(movie_dir))
+    dated_path = locate_csv(movie_dir, 'sentiment_date')
+
+    rollup, n_rows = update_rollup(dated_path, rollup_path(movie, rollup_dir))
+    print(f'{movie}: read {n_rows} new rows, {rollup.meta["rows"]} rows in '
+          f'{len(rollup.daily.index)} days, {rollup.meta["undated"]} undated')
+
+    return len(rollup.daily.index)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Daily, weekly and monthly sentiment rollups of the dated sentiment outputs')
+    parser.add_argument('movies', nargs='*', help='movie directories in data/twitter, all by default')
+    parser.add_argument('--twitter-path', default=TWITTER_PATH)
+    parser.add_argument('--rollup-path', default=ROLLUP_PATH)
+    parser.add_argument('--freq', choices=FREQS, default='M', help='period of the printed series')
+    parser.add_argument('--start', default=None, help='first date of the printed range')
+    parser.add_argument('--end', default=None, help='last date of the printed range')
+    args = parser.parse_args()
+
+    movies = args.movies or sorted(
+        entry.name for entry in os.scandir(args.twitter_path) if entry.is_dir())
+
+    for movie in movies:
+
+        movie_dir = os.path.join(args.twitter_path, movie)
+        if locate_csv(movie_dir, 'sentiment_date') is None:
+            print(f'{movie}: no dated sentiment, skipping')
+            continue
+
+        rollup_movie(movie_dir, args.rollup_path)
+        rollup = load_rollup(rollup_path(movie, args.rollup_path))
+
+        series = rollup.series(args.freq)
+        if args.start is not None or args.end is not None:
+            series = series.loc[args.start:args.end]
+
+        print(series[['n_tweets', 'sentiment_score', 'count_score', 'pos_neg_ratio']].round(3).to_string())
+        print(rollup.range_metrics(args.start, args.end)[['n_tweets', 'sentiment_score']].to_string())
+
+
+if __name__ == '__main__':
+    main()
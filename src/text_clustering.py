@@ -0,0 +1,155 @@
+import hashlib
+import re
+import zlib
+import numpy as np
+import pandas as pd
+
+
+# Mersenne prime of the MinHash permutations (a * x + b) mod P
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+
+RETWEET_PREFIX = re.compile(r'^rt @user:?\s*')
+
+
+def preprocess(text):
+    '''
+    Replace user mentions and links the way the sentiment model was trained
+    '''
+    text = str(text)
+    new_text = []
+
+    for t in text.split(' '):
+
+        t = '@user' if t.startswith('@') and len(t) > 1 else t
+        t = 'http' if t.startswith('http') else t
+        new_text.append(t)
+
+    return ' '.join(new_text)
+
+
+def normalize(text):
+    '''
+    Text used to compare tweets: preprocessed, lower case, without the
+    "RT @user:" prefix and without the word cut off by retweet truncation
+    '''
+    text = RETWEET_PREFIX.sub('', preprocess(text).lower())
+    tokens = text.split()
+
+    if len(tokens) > 1 and tokens[-1].endswith('…'):
+        tokens = tokens[:-1]
+
+    return ' '.join(tokens)
+
+
+def text_id(text):
+    '''
+    Stable positive int64 id of a text, the same in every run
+    '''
+    digest = hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest()
+
+    return int.from_bytes(digest, 'little') & 0x7FFFFFFFFFFFFFFF
+
+
+class Near_Duplicate_Index:
+
+    """
+    Online clustering of tweets into exact and near duplicates. Exact
+    duplicates (same normalized text) are found by hashing. Other texts get a
+    MinHash signature of their word shingles, and LSH buckets over bands of
+    the signature give candidate clusters; a text joins the first candidate
+    whose leader agrees on at least `threshold` of the signature (estimated
+    Jaccard similarity), otherwise it leads a new cluster. Cluster ids are
+    derived from the leader text, so they do not depend on the run.
+    """
+
+    def __init__(self, threshold=0.8, num_perm=64, bands=8, shingle_size=3, seed=0):
+
+        if num_perm % bands != 0:
+            raise ValueError('num_perm must be a multiple of bands')
+
+        rng = np.random.default_rng(seed)
+
+        # a, b < 2**32 so that a * x + b fits in uint64 for 32 bit shingle hashes
+        self.a = rng.integers(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, 1 << 32, size=num_perm, dtype=np.uint64)
+
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+
+        self.exact = {}
+        self.buckets = {}
+        self.signatures = {}
+        self.leaders = {}
+        self.n_texts = 0
+
+    def signature(self, text):
+
+        tokens = text.split()
+        n = self.shingle_size
+        shingles = [' '.join(tokens[i:i + n]) for i in range(max(len(tokens) - n + 1, 1))]
+
+        hashes = np.array([zlib.crc32(shingle.encode('utf-8')) for shingle in shingles],
+                          dtype=np.uint64)
+
+        # (num_perm, n_shingles) permuted hashes, minimum per permutation
+        permuted = (np.outer(self.a, hashes) + self.b[:, None]) % MERSENNE_PRIME
+
+        return permuted.min(axis=1)
+
+    def band_keys(self, signature):
+
+        return [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes())
+                for band in range(self.bands)]
+
+    def find_or_add(self, text, normalized):
+
+        cluster_id = self.exact.get(normalized)
+        if cluster_id is not None:
+            return cluster_id
+
+        signature = self.signature(normalized)
+        band_keys = self.band_keys(signature)
+
+        for key in band_keys:
+            for candidate in self.buckets.get(key, []):
+                if np.mean(self.signatures[candidate] == signature) >= self.threshold:
+                    self.exact[normalized] = candidate
+                    return candidate
+
+        cluster_id = text_id(normalized)
+        self.signatures[cluster_id] = signature
+        self.leaders[cluster_id] = text
+        self.exact[normalized] = cluster_id
+
+        for key in band_keys:
+            self.buckets.setdefault(key, []).append(cluster_id)
+
+        return cluster_id
+
+    def assign(self, texts):
+        '''
+        Cluster id of every text and the preprocessed text of its cluster
+        leader, which is the one text of the cluster that needs scoring
+        '''
+        texts = [preprocess(text) for text in texts]
+        cluster_ids = np.array([self.find_or_add(text, normalize(text)) for text in texts],
+                               dtype=np.int64)
+        self.n_texts += len(texts)
+
+        return cluster_ids, [self.leaders[cluster_id] for cluster_id in cluster_ids]
+
+    def n_clusters(self):
+
+        return len(self.leaders)
+
+
+def cluster_texts(texts, threshold=0.8, num_perm=64, bands=8):
+    '''
+    Cluster ids of a list of texts, see Near_Duplicate_Index
+    '''
+    index = Near_Duplicate_Index(threshold=threshold, num_perm=num_perm, bands=bands)
+    cluster_ids, _ = index.assign(texts)
+
+    return pd.Series(cluster_ids, name='cluster_id')
@@ -0,0 +1,500 @@
+import argparse
+import os
+import re
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+
+thisfile_path = os.path.dirname(os.path.abspath(__file__))
+project_path = os.path.abspath(os.path.join(thisfile_path, os.pardir))
+
+TWITTER_PATH = os.path.join(project_path, 'data', 'twitter')
+PARQUET_PATH = os.path.join(project_path, 'data', 'parquet')
+
+TWEET_FIELDS = [
+    pa.field('id', pa.int64()),
+    pa.field('author_id', pa.int64()),
+    pa.field('like_count', pa.int64()),
+    pa.field('quote_count', pa.int64()),
+    pa.field('reply_count', pa.int64()),
+    pa.field('retweet_count', pa.int64()),
+    pa.field('referenced_tweet_id', pa.int64()),
+    pa.field('referenced_tweet_type', pa.string()),
+    pa.field('text', pa.string()),
+]
+
+SENTIMENT_FIELDS = [
+    pa.field('negative', pa.float64()),
+    pa.field('neutral', pa.float64()),
+    pa.field('positive', pa.float64()),
+]
+
+# Near duplicate cluster of a tweet, empty when the scoring did not cluster
+CLUSTER_FIELD = pa.field('cluster_id', pa.int64())
+
+# Schema of every table, the month partition key is not stored in the files
+SCHEMAS = {
+    'tweets': pa.schema(TWEET_FIELDS),
+    'sentiment': pa.schema(TWEET_FIELDS + SENTIMENT_FIELDS + [CLUSTER_FIELD]),
+    'sentiment_date': pa.schema(TWEET_FIELDS + SENTIMENT_FIELDS + [CLUSTER_FIELD,
+                                                                  pa.field('date', pa.date32())]),
+}
+
+# Month used for rows whose date is not known
+UNKNOWN_MONTH = 'unknown'
+
+# Tweet ids since November 2010 are Snowflake ids: milliseconds since this
+# epoch in the bits above the lowest 22
+SNOWFLAKE_EPOCH_MS = 1288834974657
+SNOWFLAKE_TIMESTAMP_SHIFT = 22
+
+# Ids up to this one were assigned sequentially and carry no timestamp
+LAST_SEQUENTIAL_ID = 29700859247
+
+MS_PER_DAY = 86400000
+
+INT_COLUMNS = [field.name for field in TWEET_FIELDS if field.type == pa.int64()]
+
+
+def table_path(table, movie):
+    '''
+    Directory holding the month partitions of a table for a movie
+    '''
+    return os.path.join(PARQUET_PATH, table, f'movie={movie}')
+
+
+def has_parquet(table, movie):
+
+    return os.path.isdir(table_path(table, movie))
+
+
+def parquet_mtime(table, movie):
+    '''
+    Modification time of the newest partition file of a table of a movie
+    '''
+    mtimes = [
+        os.path.getmtime(os.path.join(root, file))
+        for root, _, files in os.walk(table_path(table, movie)) for file in files
+    ]
+
+    return max(mtimes, default=0.0)
+
+
+def is_snowflake(ids):
+
+    return np.asarray(ids, dtype=np.int64) > LAST_SEQUENTIAL_ID
+
+
+def snowflake_days(ids):
+    '''
+    UTC creation days of Snowflake ids, decoded from the ids themselves
+    '''
+    created_ms = (np.asarray(ids, dtype=np.int64) >> SNOWFLAKE_TIMESTAMP_SHIFT) + SNOWFLAKE_EPOCH_MS
+
+    return (created_ms // MS_PER_DAY).astype('datetime64[D]')
+
+
+def snowflake_dates(ids):
+    '''
+    Table of (id, date) for the Snowflake ids of ids, with the UTC creation
+    date decoded from the id itself, no api request needed
+    '''
+    ids = np.asarray(ids, dtype=np.int64)
+    ids = ids[is_snowflake(ids)]
+
+    return pd.DataFrame({'id': ids, 'date': snowflake_days(ids).astype(str)})
+
+
+def snowflake_months(ids):
+    '''
+    Month of every id decoded from the Snowflake id, the unknown month for
+    missing and sequential ids. Ids stored as floats only lost their lowest
+    bits, the month is still right.
+    '''
+    ids = pd.to_numeric(pd.Series(ids), errors='coerce')
+    decodable = (ids.notna() & (ids > LAST_SEQUENTIAL_ID)).to_numpy()
+
+    months = np.full(len(ids.index), UNKNOWN_MONTH, dtype=object)
+    days = snowflake_days(ids[decodable].round().astype(np.int64))
+    months[decodable] = days.astype('datetime64[M]').astype(str)
+
+    return months
+
+
+def month_from_file_name(file_name):
+    '''
+    Month of a collected file named start_YYYY_MM_DD_end_..., e.g. 2019-06
+    '''
+    match = re.search(r'start_(\d{4})_(\d{2})_', os.path.basename(file_name))
+
+    return f'{match.group(1)}-{match.group(2)}' if match else UNKNOWN_MONTH
+
+
+# Suffix of the id-only copies written by dehydrate_tweets.py
+DEHYDRATED_SUFFIX = '_dehydr.csv'
+
+
+# Columns a tweet file needs to be scored by the sentiment analysis
+SCORED_COLUMNS = ['id', 'text']
+
+
+def missing_columns(path, columns):
+    '''
+    Columns of columns not in the header of a csv file
+    '''
+    header = pd.read_csv(path, nrows=0).columns
+
+    return [column for column in columns if column not in header]
+
+
+def check_columns(files, columns):
+    '''
+    Raise a ValueError naming the first file whose header lacks any of columns
+    '''
+    for file in files:
+        missing = missing_columns(file, columns)
+        if len(missing) > 0:
+            raise ValueError(f'{file} has no {", ".join(missing)} column')
+
+
+def tweet_csv_files(movie_dir, required_columns=None):
+    '''
+    Collected tweet files of a movie directory, without the dehydrated copies
+    that only hold tweet ids. With required_columns, files missing any of them
+    are left out with a warning.
+    '''
+    files = sorted(
+        os.path.join(movie_dir, file) for file in os.listdir(movie_dir)
+        if file.startswith('start_') and file.endswith('.csv')
+        and not file.endswith(DEHYDRATED_SUFFIX))
+
+    if required_columns is None:
+        return files
+
+    selected = []
+
+    for file in files:
+
+        missing = missing_columns(file, required_columns)
+
+        if len(missing) > 0:
+            print(f'skipping {os.path.basename(file)}: no {", ".join(missing)} column')
+        else:
+            selected.append(file)
+
+    return selected
+
+
+# Columns kept from the collected tweet files (junk index columns are dropped)
+# and their types, ids are read as nullable integers so they never go through float
+TWEET_DTYPES = {
+    'id': 'Int64',
+    'author_id': 'Int64',
+    'like_count': 'Int64',
+    'quote_count': 'Int64',
+    'reply_count': 'Int64',
+    'retweet_count': 'Int64',
+    'referenced_tweet_id': 'Int64',
+    'referenced_tweet_type': object,
+    'text': object,
+}
+
+
+def read_tweet_chunks(files, chunk_size=1000, skip_rows=None, required_columns=('id',)):
+    '''
+    Generator over the tweets of a movie yielding (file name, rows read from
+    the file so far, chunk) with chunks of at most chunk_size rows, so a movie
+    is never loaded into memory as a whole. skip_rows maps file names to the
+    number of rows already processed in that file. The headers of all files
+    are checked for required_columns before the first chunk is read.
+    '''
+
+    skip_rows = skip_rows or {}
+    check_columns(files, required_columns)
+
+    for file in files:
+
+        file_name = os.path.basename(file)
+        month = month_from_file_name(file_name)
+        skip = skip_rows.get(file_name, 0)
+        rows_read = skip
+
+        reader = pd.read_csv(
+            file,
+            usecols=lambda column: column in TWEET_DTYPES,
+            dtype=TWEET_DTYPES,
+            skiprows=range(1, skip + 1),
+            chunksize=chunk_size,
+        )
+
+        for chunk in reader:
+
+            rows_read += len(chunk.index)
+
+            # rows without an id cannot be traced back to a tweet
+            chunk = chunk[chunk['id'].notna()]
+            chunk = chunk.astype({'id': 'int64'})
+            chunk['month'] = month
+
+            yield file_name, rows_read, chunk.reset_index(drop=True)
+
+
+def months_from_dates(dates):
+
+    months = pd.to_datetime(dates, format='%Y-%m-%d', errors='coerce').dt.strftime('%Y-%m')
+
+    return months.fillna(UNKNOWN_MONTH)
+
+
+def clean_frame(df):
+    '''
+    Drop the index columns written by earlier scripts (index, Unnamed: 0,
+    Unnamed: 0.1, ...) and cast ids and counts read as floats back to int64
+    '''
+    df = df.drop(columns=[column for column in df.columns
+                          if column == 'index' or str(column).startswith('Unnamed:')])
+
+    for column in INT_COLUMNS:
+        if column in df:
+            df[column] = pd.to_numeric(df[column], errors='coerce').round().astype('Int64')
+
+    return df
+
+
+def normalize_frame(df, table):
+    '''
+    Keep the columns of the table schema (dropping Unnamed: and index junk),
+    and cast ids and counts to int64. Ids already stored as floats in old csv
+    files are converted as they are, the precision lost there cannot be recovered.
+    '''
+    schema = SCHEMAS[table]
+    df = df.reindex(columns=schema.names)
+
+    for column in INT_COLUMNS + ([CLUSTER_FIELD.name] if CLUSTER_FIELD.name in df else []):
+        df[column] = pd.to_numeric(df[column], errors='coerce').round().astype('Int64')
+
+    for field in SENTIMENT_FIELDS:
+        if field.name in df:
+            df[field.name] = pd.to_numeric(df[field.name], errors='coerce').astype('float64')
+
+    if 'date' in df:
+        # missing dates were written as 0.0 by the dating script
+        df['date'] = pd.to_datetime(df['date'], format='%Y-%m-%d', errors='coerce').dt.date
+
+    for column in ['referenced_tweet_type', 'text']:
+        df[column] = df[column].astype(object).where(df[column].notna(), None)
+
+    return df
+
+
+class Partition_Writer:
+
+    """
+    Writes frames of one table for one movie into month partitions
+    data/parquet/<table>/movie=<movie>/month=<YYYY-MM>/part-0.parquet,
+    replacing whatever was stored for that movie before.
+    """
+
+    def __init__(self, table, movie):
+
+        self.table = table
+        self.schema = SCHEMAS[table]
+        self.path = table_path(table, movie)
+        self.tmp_path = self.path + '.tmp'
+        self.writers = {}
+
+        if os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+
+    def write(self, df, months):
+
+        df = normalize_frame(df, self.table)
+
+        for month, month_df in df.groupby(pd.Series(months, index=df.index)):
+
+            if month not in self.writers:
+                month_path = os.path.join(self.tmp_path, f'month={month}')
+                os.makedirs(month_path, exist_ok=True)
+                self.writers[month] = pq.ParquetWriter(
+                    os.path.join(month_path, 'part-0.parquet'), self.schema)
+
+            self.writers[month].write_table(pa.Table.from_pandas(
+                month_df, schema=self.schema, preserve_index=False))
+
+    def close(self):
+
+        for writer in self.writers.values():
+            writer.close()
+
+        # swap in the new partitions only once all of them are written
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+
+        if os.path.exists(self.tmp_path):
+            os.rename(self.tmp_path, self.path)
+
+
+def row_months(df):
+    '''
+    Month partition of each row: its date for dated tables, else the month of
+    the file it was collected in, else the month in its Snowflake id, else the
+    unknown month
+    '''
+    if 'date' in df:
+        months = months_from_dates(df['date']).to_numpy(dtype=object)
+    elif 'month' in df:
+        months = df['month'].fillna(UNKNOWN_MONTH).to_numpy(dtype=object)
+    else:
+        months = np.full(len(df.index), UNKNOWN_MONTH, dtype=object)
+
+    # legacy sentiment files have neither a date nor the month column
+    unknown = months == UNKNOWN_MONTH
+
+    if 'id' in df and unknown.any():
+        months[unknown] = snowflake_months(df['id'].to_numpy()[unknown])
+
+    return list(months)
+
+
+def write_table(df, table, movie, months=None):
+    '''
+    Write a whole table of a movie, partitioned by the months given or by
+    row_months
+    '''
+    if months is None:
+        months = row_months(df)
+
+    writer = Partition_Writer(table, movie)
+    writer.write(df, list(months))
+    writer.close()
+
+
+def read_table(table, movie, columns=None, months=None):
+    '''
+    Read a table of a movie, only the bytes of the requested columns and months
+    are read from disk
+    '''
+    # month is a partition key taken from the directory names
+    partitioning = ds.partitioning(pa.schema([pa.field('month', pa.string())]), flavor='hive')
+    dataset = ds.dataset(table_path(table, movie), format='parquet', partitioning=partitioning)
+
+    filter_expression = ds.field('month').isin(months) if months is not None else None
+
+    return dataset.to_table(columns=columns, filter=filter_expression).to_pandas()
+
+
+def locate_csv(movie_dir, suffix):
+    '''
+    Find <movie>_<suffix>.csv of a movie directory (not the subset files)
+    '''
+    for file in sorted(os.listdir(movie_dir)):
+        if file.endswith(f'_{suffix}.csv') and not file.startswith('subset'):
+            return os.path.join(movie_dir, file)
+
+    return None
+
+
+def read_movie_table(table, movie, columns=None):
+    '''
+    Read a table of a movie from parquet when it was converted, otherwise from
+    the legacy tab separated <movie>_<table>.csv. A csv written after the
+    parquet copy (by a run without parquet output) wins over the stale copy.
+    '''
+    movie_dir = os.path.join(TWITTER_PATH, movie)
+    csv_path = locate_csv(movie_dir, table) if os.path.isdir(movie_dir) else None
+
+    if has_parquet(table, movie):
+
+        if csv_path is None or os.path.getmtime(csv_path) <= parquet_mtime(table, movie):
+            return read_table(table, movie, columns=columns)
+
+        print(f'{os.path.basename(csv_path)} is newer than the parquet {table} table, '
+              f'reading the csv (run tweet_storage.py to convert it)')
+
+    if csv_path is None:
+        raise FileNotFoundError(f'no {table} data for {movie}')
+
+    return pd.read_csv(csv_path, sep='\t', usecols=columns)
+
+
+def csv_to_parquet(csv_path, table, movie, sep='\t', month=None, chunk_size=100000):
+    '''
+    Stream a csv file of a movie into its parquet partitions. Rows go to the
+    given month or are partitioned by row_months.
+    '''
+    writer = Partition_Writer(table, movie)
+    n_rows = 0
+
+    for chunk in pd.read_csv(csv_path, sep=sep, chunksize=chunk_size):
+
+        months = [month] * len(chunk.index) if month is not None else row_months(chunk)
+
+        writer.write(chunk, months)
+        n_rows += len(chunk.index)
+
+    writer.close()
+
+    return n_rows
+
+
+def tweet_files_to_parquet(files, movie, chunk_size=100000):
+    '''
+    Stream the collected start_ files of a movie into the tweets table,
+    partitioned by the month in their file name
+    '''
+    writer = Partition_Writer('tweets', movie)
+    n_rows = 0
+
+    for file in files:
+
+        month = month_from_file_name(file)
+
+        for chunk in pd.read_csv(file, chunksize=chunk_size):
+            writer.write(chunk, [month] * len(chunk.index))
+            n_rows += len(chunk.index)
+
+    writer.close()
+
+    return n_rows
+
+
+def convert_twitter_tree(twitter_path=TWITTER_PATH):
+    '''
+    One-shot conversion of all movie directories under data/twitter to parquet
+    '''
+    for movie_dir in sorted(f.path for f in os.scandir(twitter_path) if f.is_dir()):
+
+        movie = os.path.basename(movie_dir)
+        tweet_files = sorted(
+            os.path.join(movie_dir, file) for file in os.listdir(movie_dir)
+            if file.startswith('start_') and file.endswith('.csv'))
+
+        if len(tweet_files) > 0:
+            n_rows = tweet_files_to_parquet(tweet_files, movie)
+            print(f'{movie}: {n_rows} tweets from {len(tweet_files)} files')
+
+        for table in ['sentiment', 'sentiment_date']:
+
+            csv_path = locate_csv(movie_dir, table)
+
+            if csv_path is not None:
+                n_rows = csv_to_parquet(csv_path, table, movie)
+                print(f'{movie}: {n_rows} rows of {table}')
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Convert the csv files under data/twitter to partitioned parquet')
+    parser.add_argument('--twitter-path', default=TWITTER_PATH)
+    args = parser.parse_args()
+
+    convert_twitter_tree(args.twitter_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+import argparse
+import json
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+
+from twitter_lookup import Lookup_Client, make_batches
+
+
+thisfile_path = os.path.dirname(os.path.abspath(__file__))
+project_path = os.path.abspath(os.path.join(thisfile_path, os.pardir))
+
+STORE_PATH = os.path.join(project_path, 'data', 'cache', 'tweets.sqlite')
+
+# Fields requested when rehydrating tweets, enough to rebuild the collected files
+REHYDRATE_FIELDS = 'id,text,author_id,created_at,public_metrics,referenced_tweets'
+
+COLUMNS = ['id', 'author_id', 'created_at', 'like_count', 'quote_count', 'reply_count',
+           'retweet_count', 'referenced_tweet_id', 'referenced_tweet_type', 'text', 'raw']
+
+# SQLite limits the number of variables bound in one statement
+QUERY_CHUNK_SIZE = 500
+
+
+def flatten_tweet(tweet):
+    '''
+    Row of the store from a tweet object of the api, fields the response did
+    not include are None
+    '''
+    metrics = tweet.get('public_metrics', {})
+    referenced = tweet.get('referenced_tweets', [{}])[0]
+
+    return (
+        int(tweet['id']),
+        int(tweet['author_id']) if 'author_id' in tweet else None,
+        tweet.get('created_at'),
+        metrics.get('like_count'),
+        metrics.get('quote_count'),
+        metrics.get('reply_count'),
+        metrics.get('retweet_count'),
+        int(referenced['id']) if 'id' in referenced else None,
+        referenced.get('type'),
+        tweet.get('text'),
+        json.dumps(tweet, ensure_ascii=False),
+    )
+
+
+class Tweet_Store:
+
+    """
+    Local SQLite store of every tweet seen in an api response, keyed by the
+    int64 tweet id. Fetchers read it first and only ask the api for misses.
+    """
+
+    def __init__(self, path=STORE_PATH):
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS tweets ('
+            'id INTEGER PRIMARY KEY, author_id INTEGER, created_at TEXT, '
+            'like_count INTEGER, quote_count INTEGER, reply_count INTEGER, '
+            'retweet_count INTEGER, referenced_tweet_id INTEGER, '
+            'referenced_tweet_type TEXT, text TEXT, raw TEXT)'
+        )
+        # tweets the api reported as deleted or protected, never asked for again
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS unavailable (id INTEGER PRIMARY KEY, reason TEXT)'
+        )
+        self.connection.commit()
+
+    def upsert_tweets(self, tweets):
+        '''
+        Bulk insert or update tweets of an api response. A response with fewer
+        fields (e.g. only created_at) never erases what is already stored:
+        columns keep their value when the response lacks them and the raw json
+        of the response is merged into the stored one.
+        '''
+        rows = [flatten_tweet(tweet) for tweet in tweets]
+        updates = ', '.join(
+            f'{column} = COALESCE(excluded.{column}, {column})' for column in COLUMNS[1:-1])
+
+        # json_patch merges objects key by key (RFC 7396), nested ones included
+        self.connection.executemany(
+            f'INSERT INTO tweets VALUES ({", ".join("?" * len(COLUMNS))}) '
+            f'ON CONFLICT(id) DO UPDATE SET {updates}, '
+            f"raw = json_patch(COALESCE(raw, '{{}}'), excluded.raw)",
+            rows,
+        )
+        self.connection.commit()
+
+        return len(rows)
+
+    def mark_unavailable(self, errors):
+        '''
+        Remember the ids of the errors of an api response
+        '''
+        rows = [(int(error['value']), error.get('title'))
+                for error in errors if str(error.get('value', '')).isdigit()]
+
+        self.connection.executemany('INSERT OR REPLACE INTO unavailable VALUES (?, ?)', rows)
+        self.connection.commit()
+
+    def get_many(self, ids, columns=COLUMNS[:-1]):
+        '''
+        Stored tweets among ids as a dataframe, in no particular order
+        '''
+        ids = [int(tweet_id) for tweet_id in ids]
+        frames = []
+
+        for start in range(0, len(ids), QUERY_CHUNK_SIZE):
+
+            chunk = ids[start:start + QUERY_CHUNK_SIZE]
+            rows = self.connection.execute(
+                f'SELECT {", ".join(columns)} FROM tweets '
+                f'WHERE id IN ({",".join("?" * len(chunk))})',
+                chunk,
+            ).fetchall()
+            frames.append(pd.DataFrame(rows, columns=columns))
+
+        if len(frames) == 0:
+            return pd.DataFrame(columns=columns)
+
+        return pd.concat(frames, ignore_index=True).astype({'id': np.int64})
+
+    def missing_ids(self, ids, required_column='id'):
+        '''
+        Ids that are not stored, or stored without required_column, and are
+        not known to be unavailable
+        '''
+        stored = self.get_many(ids, columns=['id', required_column])
+        stored = stored[stored[required_column].notna()]
+        missing = set(int(tweet_id) for tweet_id in ids) - set(stored['id'])
+
+        unavailable = set()
+        missing_list = list(missing)
+
+        for start in range(0, len(missing_list), QUERY_CHUNK_SIZE):
+            chunk = missing_list[start:start + QUERY_CHUNK_SIZE]
+            rows = self.connection.execute(
+                f'SELECT id FROM unavailable WHERE id IN ({",".join("?" * len(chunk))})',
+                chunk,
+            ).fetchall()
+            unavailable.update(row[0] for row in rows)
+
+        return sorted(missing - unavailable)
+
+    def fetch_missing(self, ids, client, required_column='id'):
+        '''
+        Look up only the ids the store cannot answer and store the responses.
+        Returns the json responses (None for failed batches).
+        '''
+        missing = self.missing_ids(ids, required_column)
+        print(f'{len(ids) - len(missing)} tweets known to the store, fetching {len(missing)}')
+
+        if len(missing) == 0:
+            return []
+
+        json_responses = client.lookup(make_batches(missing))
+
+        for json_response in json_responses:
+            if json_response is not None:
+                self.upsert_tweets(json_response.get('data', []))
+                self.mark_unavailable(json_response.get('errors', []))
+
+        return json_responses
+
+    def rehydrate(self, ids, client):
+        '''
+        Full tweets for ids, only the ids without text go to the network
+        '''
+        self.fetch_missing(ids, client, required_column='text')
+
+        return self.get_many(ids)
+
+    def close(self):
+
+        self.connection.close()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Rehydrate the dehydrated start_ files of a movie into the tweet store')
+    parser.add_argument('movie_dir')
+    parser.add_argument('--store', default=STORE_PATH)
+    args = parser.parse_args()
+
+    ids = []
+    for file in sorted(os.listdir(args.movie_dir)):
+        if file.startswith('start_') and file.endswith('.csv'):
+            df = pd.read_csv(os.path.join(args.movie_dir, file), usecols=['id'], dtype={'id': 'Int64'})
+            ids.extend(df['id'].dropna().astype(np.int64).tolist())
+
+    client = Lookup_Client(os.getenv('TWITTERTOKEN'), tweet_fields=REHYDRATE_FIELDS)
+    store = Tweet_Store(args.store)
+    tweets = store.rehydrate(ids, client)
+    store.close()
+
+    print(f'{int(tweets["text"].notna().sum())} of {len(ids)} tweets available with text')
+
+
+if __name__ == '__main__':
+    main()
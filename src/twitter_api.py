@@ -1,7 +1,23 @@
+import argparse
 import requests
+import json
 import os
+import threading
 import time
 import pandas as pd
+import yaml
+
+from concurrent.futures import ThreadPoolExecutor
+from tweet_store import Tweet_Store
+
+
+thisfile_path = os.path.dirname(os.path.abspath(__file__))
+project_path = os.path.abspath(os.path.join(thisfile_path, os.pardir))
+
+CONFIG_PATH = os.path.join(thisfile_path, 'twitter_search_config.yaml')
+
+COLUMNS = ['id', 'author_id', 'like_count', 'quote_count', 'reply_count', 'retweet_count',
+           'referenced_tweet_id', 'referenced_tweet_type', 'text']
 
 
 def auth():
@@ -27,116 +43,235 @@ def create_url(keyword, start_date, end_date, max_results = 10):
     return (search_url, query_params)
 
 
-def connect_to_endpoint(url, headers, params, next_token = None):
+class Request_Limiter:
+
+    """
+    Shared by all collecting threads: keeps at least min_interval seconds
+    between two requests and blocks everyone until the rate limit window
+    resets when the api answers 429. Requests of all windows are serialized
+    through it, so concurrent windows never exceed one request per
+    min_interval in total; they only overlap one window's request with the
+    parsing and writing of the others.
+    """
+
+    def __init__(self, min_interval=1.1):
+
+        self.min_interval = min_interval
+        self.next_request = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+
+        with self.lock:
+            now = time.monotonic()
+            wait = max(self.next_request - now, 0.0)
+            self.next_request = max(self.next_request, now) + self.min_interval
+
+        time.sleep(wait)
+
+    def block_until(self, reset_epoch):
+
+        with self.lock:
+            self.next_request = max(self.next_request,
+                                    time.monotonic() + max(reset_epoch - time.time(), 1.0))
+
+
+def connect_to_endpoint(url, headers, params, next_token = None, session=None, limiter=None):
     params['next_token'] = next_token
-    response = requests.request("GET", url, headers = headers, params = params)
-    if response.status_code != 200:
-        raise Exception(response.status_code, response.text)
-    return response.json()
-
-
-def append_to_df(all_data, json_response):
-    for tweet in json_response['data']:
-        tweet_id = tweet['id']
-        author_id = tweet['author_id']
-        like_count = tweet['public_metrics']['like_count']
-        quote_count = tweet['public_metrics']['quote_count']
-        reply_count = tweet['public_metrics']['reply_count']
-        retweet_count = tweet['public_metrics']['retweet_count']
-        text = tweet['text']
-        referenced_tweets_present = False
-        if 'referenced_tweets' in tweet:
-            referenced_tweets_present = True
-            referenced_tweet_id = tweet['referenced_tweets'][0]['id']
-            referenced_tweet_type = tweet['referenced_tweets'][0]['type']
-
-        new_data = pd.DataFrame({
-            "id":tweet_id,
-            "author_id":author_id,
-            "like_count":like_count,
-            "quote_count":quote_count,
-            "reply_count":reply_count,
-            "retweet_count":retweet_count,
-            "referenced_tweet_id":referenced_tweet_id if referenced_tweets_present else None,
-            "referenced_tweet_type":referenced_tweet_type if referenced_tweets_present else None,
-            "text":text,
-        }, index=[0])
-        all_data = pd.concat([all_data, new_data], ignore_index=True)
-    return all_data
+    session = session or requests
 
+    while True:
+        if limiter is not None:
+            limiter.wait()
+        response = session.request("GET", url, headers = headers, params = params)
+        if response.status_code == 429 and limiter is not None:
+            reset = float(response.headers.get('x-rate-limit-reset', time.time() + 15 * 60))
+            print(f"rate limited, waiting {max(reset - time.time(), 1.0):.0f} seconds")
+            limiter.block_until(reset)
+            continue
+        if response.status_code != 200:
+            raise Exception(response.status_code, response.text)
+        return response.json()
 
-def main():
-    bearer_token = auth()
-    headers = create_headers(bearer_token)
-    keyword = "#madmaxfuryroad lang:en"
-    max_results = 500
-
-    months = [
-        ("2015-01-01T00:00:00.000Z", "2015-02-01T00:00:00.000Z"),
-        ("2015-02-01T00:00:00.000Z", "2015-03-01T00:00:00.000Z"),
-        ("2015-03-01T00:00:00.000Z", "2015-04-01T00:00:00.000Z"),
-        ("2015-04-01T00:00:00.000Z", "2015-05-01T00:00:00.000Z"),
-        ("2015-05-01T00:00:00.000Z", "2015-06-01T00:00:00.000Z"),
-        ("2015-06-01T00:00:00.000Z", "2015-07-01T00:00:00.000Z"),
-        ("2015-07-01T00:00:00.000Z", "2015-08-01T00:00:00.000Z"),
-        ("2015-08-01T00:00:00.000Z", "2015-09-01T00:00:00.000Z"),
-        ("2015-09-01T00:00:00.000Z", "2015-10-01T00:00:00.000Z"),
-        ("2015-10-01T00:00:00.000Z", "2015-11-01T00:00:00.000Z"),
-        ("2015-11-01T00:00:00.000Z", "2015-12-01T00:00:00.000Z"),
-        ("2015-12-01T00:00:00.000Z", "2016-01-01T00:00:00.000Z"),
-        ("2016-01-01T00:00:00.000Z", "2016-02-01T00:00:00.000Z"),
-        ("2016-02-01T00:00:00.000Z", "2016-03-01T00:00:00.000Z"),
-        ("2016-03-01T00:00:00.000Z", "2016-04-01T00:00:00.000Z"),
-        ("2016-04-01T00:00:00.000Z", "2016-05-01T00:00:00.000Z"),
-        ("2016-05-01T00:00:00.000Z", "2016-06-01T00:00:00.000Z"),
-        ("2016-06-01T00:00:00.000Z", "2016-07-01T00:00:00.000Z"),
-        ("2016-07-01T00:00:00.000Z", "2016-08-01T00:00:00.000Z"),
-        ("2016-08-01T00:00:00.000Z", "2016-09-01T00:00:00.000Z"),
-        ("2016-09-01T00:00:00.000Z", "2016-10-01T00:00:00.000Z"),
-        ("2016-10-01T00:00:00.000Z", "2016-11-01T00:00:00.000Z"),
-        ("2016-11-01T00:00:00.000Z", "2016-12-01T00:00:00.000Z"),
-        ("2016-12-01T00:00:00.000Z", "2017-01-01T00:00:00.000Z"),
-    ]
 
-    for start_time, end_time in months:
-        month = start_time.split("T")[0]
-        count = 0
-        max_count = 30000
-        flag = True
-        next_token = None
+class Column_Buffer:
 
-        all_data = pd.DataFrame(columns=['id','author_id','like_count','quote_count','reply_count','retweet_count','referenced_tweet_id', 'referenced_tweet_type', 'text'])
+    """
+    Tweets of the fetched pages kept as one list per column until they are
+    flushed to the csv file of the window
+    """
 
-        while flag:
-            if count >= max_count:
-                break
+    def __init__(self):
+
+        self.columns = {column: [] for column in COLUMNS}
+
+    def __len__(self):
+
+        return len(self.columns['id'])
+
+    def append_page(self, json_response):
+
+        for tweet in json_response.get('data', []):
+            metrics = tweet['public_metrics']
+            referenced = tweet['referenced_tweets'][0] if 'referenced_tweets' in tweet else {}
+
+            self.columns['id'].append(tweet['id'])
+            self.columns['author_id'].append(tweet['author_id'])
+            self.columns['like_count'].append(metrics['like_count'])
+            self.columns['quote_count'].append(metrics['quote_count'])
+            self.columns['reply_count'].append(metrics['reply_count'])
+            self.columns['retweet_count'].append(metrics['retweet_count'])
+            self.columns['referenced_tweet_id'].append(referenced.get('id'))
+            self.columns['referenced_tweet_type'].append(referenced.get('type'))
+            self.columns['text'].append(tweet['text'])
+
+    def flush(self, out_file_path):
+
+        write_header = not os.path.exists(out_file_path) or os.path.getsize(out_file_path) == 0
+        pd.DataFrame(self.columns).to_csv(
+            out_file_path, mode='a', header=write_header, index=False)
+        self.columns = {column: [] for column in COLUMNS}
+
+
+def window_file_name(keyword, start_time, end_time):
+    '''
+    File name of a window in the convention of rename_files.py, e.g.
+    start_2015_01_01_end_2015_02_01_hashtag__madmaxfuryroad_lang_en.csv
+    '''
+    name = f"start:{start_time.split('T')[0]},end:{end_time.split('T')[0]}_hashtag:{keyword}"
+    for character in [":", "-", ",", "#", " "]:
+        name = name.replace(character, "_")
+    return name + ".csv"
+
+
+def load_state(state_path):
+
+    if not os.path.exists(state_path):
+        return {'next_token': None, 'count': 0, 'out_bytes': 0, 'done': False}
+
+    with open(state_path, 'r') as read_file:
+        return json.load(read_file)
+
+
+def save_state(state, state_path):
+
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w') as write_file:
+        json.dump(state, write_file, indent=4)
+    os.replace(tmp_path, state_path)
+
+
+def collect_window(movie_dir, keyword, start_time, end_time, headers, limiter,
+                   max_results=500, max_count=30000, flush_every=10):
+    '''
+    Collect one window of the full-archive search into its csv file. Pages are
+    flushed every flush_every pages together with the next_token to continue
+    from, so a crashed window resumes mid-pagination.
+    '''
+    out_file_path = os.path.join(movie_dir, window_file_name(keyword, start_time, end_time))
+    state_path = out_file_path + '.state.json'
+    state = load_state(state_path)
+    month = start_time.split("T")[0]
+
+    if state['done']:
+        print(f"Window {month} already collected ({state['count']} tweets)")
+        return state['count']
+
+    # drop rows written after the last saved state
+    if os.path.exists(out_file_path):
+        os.truncate(out_file_path, state['out_bytes'])
+
+    buffer = Column_Buffer()
+    url = create_url(keyword, start_time, end_time, max_results)
+    next_token = state['next_token']
+    count = state['count']
+    pages = 0
+
+    store = Tweet_Store()
+    session = requests.Session()
+
+    try:
+        while True:
             print(f"Tweets fetched ({month}): {count}")
-            url = create_url(keyword, start_time, end_time, max_results)
-            json_response = connect_to_endpoint(url[0], headers, url[1], next_token)
+            json_response = connect_to_endpoint(url[0], headers, url[1], next_token,
+                                                session=session, limiter=limiter)
             result_count = json_response['meta']['result_count']
 
-            if 'next_token' in json_response['meta']:
-                next_token = json_response['meta']['next_token']
-                if result_count is not None and result_count > 0 and next_token is not None:
-                    all_data = append_to_df(all_data, json_response)
-                    count += result_count
-                    time.sleep(1.1)                
-            # If no next token exists
-            else:
-                if result_count is not None and result_count > 0:
-                    all_data = append_to_df(all_data, json_response)
-                    count += result_count
+            if result_count is not None and result_count > 0:
+                buffer.append_page(json_response)
+                store.upsert_tweets(json_response.get('data', []))
+                count += result_count
+
+            next_token = json_response['meta'].get('next_token')
+            done = next_token is None or count >= max_count
+            pages += 1
+
+            if done or pages % flush_every == 0:
+                buffer.flush(out_file_path)
+                save_state({'next_token': next_token, 'count': count,
+                            'out_bytes': os.path.getsize(out_file_path), 'done': done}, state_path)
+
+            if done:
+                break
+
+    finally:
+        store.close()
+        session.close()
+
+    print(f"Finished {month} for {keyword}: {count} tweets")
+
+    return count
+
+
+def month_windows(start_month, end_month):
+    '''
+    Monthly (start, end) windows from start_month up to end_month, e.g.
+    2015-01 to 2015-03 gives January and February 2015
+    '''
+    starts = pd.date_range(f"{start_month}-01", f"{end_month}-01", freq="MS")
+    return [
+        (start.strftime("%Y-%m-%dT00:00:00.000Z"), end.strftime("%Y-%m-%dT00:00:00.000Z"))
+        for start, end in zip(starts[:-1], starts[1:])
+    ]
+
+
+def load_config(config_path):
+
+    with open(config_path, 'r') as read_file:
+        return yaml.safe_load(read_file)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Collect tweets from the full-archive search")
+    parser.add_argument("--config", default=CONFIG_PATH)
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    headers = create_headers(auth())
+    limiter = Request_Limiter(config.get('min_request_interval', 1.1))
+
+    jobs = []
+    for movie in config['movies']:
+        movie_dir = os.path.join(project_path, 'data', 'twitter', movie['name'])
+        os.makedirs(movie_dir, exist_ok=True)
+        windows = movie.get('windows') or month_windows(movie['start'], movie['end'])
+        for start_time, end_time in windows:
+            jobs.append((movie_dir, movie['keyword'], start_time, end_time))
 
-                #Since this is the final request, turn flag to false
-                time.sleep(1.1)
-                flag = False
-                next_token = None
+    # windows run concurrently, the shared limiter keeps them within the rate limit
+    # so more windows than a few only wait on it
+    with ThreadPoolExecutor(max_workers=config.get('max_concurrent_windows', 4)) as executor:
+        futures = [
+            executor.submit(collect_window, movie_dir, keyword, start_time, end_time, headers,
+                            limiter, config.get('max_results', 500),
+                            config.get('max_tweets_per_window', 30000))
+            for movie_dir, keyword, start_time, end_time in jobs
+        ]
+        total = sum(future.result() for future in futures)
 
-        start_time_str = start_time.split("T")[0]
-        end_time_str = end_time.split("T")[0]
-        all_data.to_csv(f"data/twitter/mad_max_fury_road/start:{start_time_str},end:{end_time_str}_hashtag:{keyword}.csv")
+    print(f"Collected {total} tweets in {len(jobs)} windows")
 
 
 if __name__ == "__main__":
     main()
-    
\ No newline at end of file
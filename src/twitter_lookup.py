@@ -0,0 +1,162 @@
+import asyncio
+import random
+import time
+import aiohttp
+
+
+LOOKUP_URL = "https://api.twitter.com/2/tweets"
+
+# The v2 tweet lookup takes at most 100 ids per request
+MAX_IDS_PER_REQUEST = 100
+
+
+class Token_Bucket:
+
+    """
+    Rate limiter allowing `capacity` requests per `period` seconds. The state
+    is corrected from the x-rate-limit-remaining / x-rate-limit-reset headers
+    of every response, so waits follow the real limit instead of fixed sleeps.
+    """
+
+    def __init__(self, capacity=300, period=15 * 60):
+
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self):
+
+        async with self.lock:
+
+            while True:
+
+                self.refill()
+                wait = max(self.blocked_until - time.monotonic(), 0.0)
+
+                if wait == 0.0 and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                if wait == 0.0:
+                    wait = (1 - self.tokens) / self.rate
+
+                await asyncio.sleep(wait)
+
+    def update_from_headers(self, headers):
+
+        remaining = headers.get("x-rate-limit-remaining")
+        reset = headers.get("x-rate-limit-reset")
+
+        if remaining is None or reset is None:
+            return
+
+        # reset is an epoch timestamp, convert it to the monotonic clock
+        reset_in = max(float(reset) - time.time(), 0.0)
+        self.refill()
+        self.tokens = min(self.tokens, float(remaining))
+
+        if int(remaining) <= 0:
+            self.block_for(reset_in)
+
+    def block_for(self, seconds):
+
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class Lookup_Client:
+
+    """
+    Asynchronous client for GET /2/tweets?ids=... sharing one pool of keep-alive
+    connections. Batches of ids are fetched concurrently, bounded by
+    max_concurrency and by the token bucket, and a batch that fails is retried
+    on its own with exponential backoff.
+    """
+
+    def __init__(self, bearer_token, base_url=LOOKUP_URL, tweet_fields="id,created_at",
+                 max_concurrency=8, max_retries=5, rate_limit=300, rate_period=15 * 60,
+                 backoff_base=2.0):
+
+        self.headers = {"Authorization": f"Bearer {bearer_token}"}
+        self.base_url = base_url
+        self.tweet_fields = tweet_fields
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.rate_limit = rate_limit
+        self.rate_period = rate_period
+        self.backoff_base = backoff_base
+
+    async def fetch_batch(self, session, bucket, semaphore, ids):
+
+        params = {"ids": ",".join(map(str, ids)), "tweet.fields": self.tweet_fields}
+
+        attempt = 0
+
+        while attempt <= self.max_retries:
+
+            await bucket.acquire()
+
+            try:
+                async with semaphore:
+                    async with session.get(self.base_url, params=params) as response:
+
+                        bucket.update_from_headers(response.headers)
+
+                        if response.status == 200:
+                            return await response.json()
+
+                        if response.status == 429:
+                            # wait for the window given by the server, not a guess
+                            reset = response.headers.get("x-rate-limit-reset")
+                            wait = float(reset) - time.time() if reset is not None else self.rate_period
+                            bucket.block_for(max(wait, 1.0))
+                            print(f"rate limited, waiting {max(wait, 1.0):.0f} seconds")
+                            continue
+
+                        error = f"{response.status} {await response.text()}"
+
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = repr(e)
+
+            # rate limiting is waited out above, only real failures count as retries
+            wait = self.backoff_base ** attempt + random.uniform(0, 1)
+            attempt += 1
+            print(f"batch of {len(ids)} ids failed ({error}), retrying in {wait:.1f} seconds")
+            await asyncio.sleep(wait)
+
+        return None
+
+    async def lookup_async(self, id_batches):
+
+        bucket = Token_Bucket(self.rate_limit, self.rate_period)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+
+        async with aiohttp.ClientSession(headers=self.headers, connector=connector) as session:
+
+            tasks = [self.fetch_batch(session, bucket, semaphore, ids) for ids in id_batches]
+
+            return await asyncio.gather(*tasks)
+
+    def lookup(self, id_batches):
+        '''
+        Fetch all batches of ids, returns the json response of each batch in
+        the same order, or None for batches that failed after all retries
+        '''
+        return asyncio.run(self.lookup_async(id_batches))
+
+
+def make_batches(ids, batch_size=MAX_IDS_PER_REQUEST):
+
+    ids = list(ids)
+
+    return [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
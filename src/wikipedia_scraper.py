@@ -1,10 +1,25 @@
+import argparse
+import hashlib
+import os
 import requests  # http requests
-from bs4 import BeautifulSoup  # xml parsing
+from bs4 import BeautifulSoup, SoupStrainer  # xml parsing
 import re  # regular expressions
 import urllib  # converting URLs properly
 import pandas as pd
 import json
 
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+
+thisfile_path = os.path.dirname(os.path.abspath(__file__))
+project_path = os.path.abspath(os.path.join(thisfile_path, os.pardir))
+
+CACHE_DIR = os.path.join(project_path, 'data', 'cache', 'wikipedia')
+
+# Only the infobox of a film page is parsed, the rest of the article is skipped
+INFOBOX_STRAINER = SoupStrainer('table', attrs={'class': 'infobox vevent'})
+
 
 def get_URL(title, base_url='https://en.wikipedia.org/wiki/'):
 
@@ -23,9 +38,108 @@ def get_htmltext(url):
         return response.text
 
 
+class Page_Cache:
+
+    """
+    Raw responses kept on disk by url together with their ETag and
+    Last-Modified headers, so a rerun only revalidates them and transfers
+    the pages and images that changed
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR):
+
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def paths(self, url):
+
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        base = os.path.join(self.cache_dir, key)
+        return base + '.body', base + '.json'
+
+    def get(self, url):
+        '''
+        Cached body and headers of url, or (None, {}) when it is not cached
+        '''
+        body_path, meta_path = self.paths(url)
+
+        if not os.path.exists(body_path) or not os.path.exists(meta_path):
+            return None, {}
+
+        with open(meta_path, 'r') as read_file:
+            meta = json.load(read_file)
+        with open(body_path, 'rb') as read_file:
+            return read_file.read(), meta
+
+    def put(self, url, body, headers):
+
+        body_path, meta_path = self.paths(url)
+        meta = {'url': url,
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified')}
+
+        # body first, a body without metadata is treated as not cached
+        for path, mode, data in [(body_path, 'wb', body), (meta_path, 'w', meta)]:
+            with open(path + '.tmp', mode) as write_file:
+                if mode == 'wb':
+                    write_file.write(data)
+                else:
+                    json.dump(data, write_file)
+            os.replace(path + '.tmp', path)
+
+
+def create_session(pool_size=16):
+    '''
+    One session for all threads, keeping up to pool_size keep-alive
+    connections to the same host
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=3)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['User-Agent'] = 'DITW_project wikipedia_scraper (python-requests)'
+    return session
+
+
+def fetch_cached(session, cache, url):
+    '''
+    Body of url, revalidated against the cache: a 304 answer reuses the
+    cached body, and so does any other failed request while a body is cached.
+    Returns (body, changed) or (None, False) on failure.
+    '''
+    body, meta = cache.get(url)
+    headers = {}
+
+    if body is not None:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    try:
+        response = session.get(url, headers=headers, timeout=30)
+    except requests.RequestException as e:
+        # one unreachable page must not stop the other scraping threads
+        print(f'request to {url} failed: {e!r}' + (', using cached copy' if body is not None else ''))
+        return body, False
+
+    if response.status_code == 304 and body is not None:
+        return body, False
+
+    if response.status_code != 200:
+        if body is not None:
+            print(f'{url} answered {response.status_code}, using cached copy')
+        return body, False
+
+    cache.put(url, response.content, response.headers)
+
+    return response.content, True
+
+
 def get_actors(infobox_data):
 
     infobox_trs = infobox_data.find_all('tr')
+    actors, actor_urls = [], []
 
     # Extract starring actor for those tags tr in infobox containing such info
     for tr in infobox_trs:
@@ -41,7 +155,7 @@ def get_actors(infobox_data):
 
 
 def get_poster(infobox_data):
-    
+
     # Get infobox image url for such film
     img_url = 'https:' + infobox_data.find_all('img', limit=1)[0]['src']
     return img_url
@@ -54,54 +168,117 @@ def get_year(soup):
     return year
 
 
+def parse_film_page(html_text):
+    '''
+    Year, poster url, actors and actor urls from the html of a film page.
+    Only the infobox table is built into a tree, with the lxml parser.
+    '''
+    soup = BeautifulSoup(html_text, features='lxml', parse_only=INFOBOX_STRAINER)
+
+    # Get infobox tag,  common in all film wiki pages
+    infobox_data = soup.find_all(
+        'table', attrs={'class': 'infobox vevent'},  limit=1)[0]
+
+    year = get_year(infobox_data)
+    poster_image = get_poster(infobox_data)
+    actors, actors_urls = get_actors(infobox_data)
+
+    return year, poster_image, actors, actors_urls
+
+
 def scrape_wikipedia(film_title):
 
     url = get_URL(film_title)
     html_text = get_htmltext(url)
 
-    soup = BeautifulSoup(html_text, features="html.parser")
+    year, poster_image, actors, actors_urls = parse_film_page(html_text)
 
-    # Get infobox tag,  common in all film wiki pages
-    infobox_data = soup.find_all(
-        'table', attrs={'class': 'infobox vevent'},  limit=1)[0]
+    return film_title, url, year, poster_image, actors, actors_urls
 
-    # year
-    year = get_year(soup)
 
-    # poster image
-    poster_image = get_poster(infobox_data)
+def scrape_film(session, cache, film_id, film_title, img_dir):
+    '''
+    Metadata of one film, its poster is saved to img_dir when it changed
+    or is missing there
+    '''
+    url = get_URL(film_title)
+    html_text, _ = fetch_cached(session, cache, url)
 
-    # actor info
-    actors, actors_urls = get_actors(infobox_data)
+    if html_text is None:
+        print(f'Could not fetch {url}')
+        return film_id, None
 
-    return film_title, url, year, poster_image, actors, actors_urls
+    try:
+        year, poster_image, actors, actors_urls = parse_film_page(html_text)
+    except IndexError:
+        print(f'No film infobox in {url}')
+        return film_id, None
+
+    image, changed = fetch_cached(session, cache, poster_image)
+    poster_path = os.path.join(img_dir, str(film_id) + '_poster.jpg')
+
+    if image is not None and (changed or not os.path.exists(poster_path)):
+        with open(poster_path, 'wb') as write_file:
+            write_file.write(image)
+
+    film_dict = {
+        'title': film_title,
+        'url': url,
+        'year': year,
+        'poster': poster_image,
+        'actors': actors,
+        'actors_urls': actors_urls}
+
+    return film_id, film_dict
+
+
+def scrape_films(films, img_dir, cache_dir=CACHE_DIR, workers=8):
+    '''
+    Scrape all films of the movies dataframe concurrently over one
+    connection pool, returns the metadata keyed by film id
+    '''
+    session = create_session(workers)
+    cache = Page_Cache(cache_dir)
+    os.makedirs(img_dir, exist_ok=True)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(
+            lambda row: scrape_film(session, cache, row[0], row[1], img_dir),
+            zip(films['id'].astype(int).tolist(), films['film_name']))
+        films_metadata = {film_id: film_dict for film_id, film_dict in results
+                          if film_dict is not None}
+
+    session.close()
+
+    return films_metadata
 
 
 def main():
 
-    films = pd.read_csv('./data/movies.csv', sep=';')
-    films_metadata = {}
+    parser = argparse.ArgumentParser(description='Scrape film metadata and posters from wikipedia')
+    parser.add_argument('--movies', default='./data/movies.csv')
+    parser.add_argument('--img-dir', default='./data/img/')
+    parser.add_argument('--out', default='./data/metadata/movies_metadata.json')
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
 
-    for index, row in films.iterrows():
+    films = pd.read_csv(args.movies, sep=';')
+    films_metadata = scrape_films(films, args.img_dir, args.cache_dir, args.workers)
 
-        film_title, url, year, poster_image, actors, actors_urls = scrape_wikipedia(
-            row['film_name'])
-        film_dict = {
-            'title': film_title,
-            'url': url,
-            'year': year,
-            'poster': poster_image,
-            'actors': actors,
-            'actors_urls': actors_urls}
+    print(f'Scraped {len(films_metadata)} of {len(films)} films')
 
-        films_metadata[row['id']] = film_dict
+    # films that could not be scraped this time keep their saved metadata
+    saved_metadata = {}
+    if os.path.exists(args.out):
+        with open(args.out, 'r') as read_file:
+            saved_metadata = json.load(read_file)
 
-        # Save images
-        urllib.request.urlretrieve(
-            poster_image, './data/img/' + str(row['id']) + '_poster.jpg')
+    films_metadata = {**saved_metadata, **{str(film_id): film_dict
+                                           for film_id, film_dict in films_metadata.items()}}
 
     # Save metadata
-    with open("./data/metadata/movies_metadata.json", "w") as write_file:
+    with open(args.out, "w") as write_file:
         json.dump(films_metadata, write_file, indent=4, ensure_ascii=False)
 
     return
@@ -0,0 +1,41 @@
+import os
+import shutil
+import sys
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src'))
+
+from calculate_moviescores import SCORES_PATH, check_scores, compute_movie_scores, save_scores
+from sentiment_aggregates import SCORE_COLUMNS
+
+
+def test_scores_match_saved_scores():
+
+    mismatches = check_scores(compute_movie_scores(), SCORES_PATH)
+
+    assert len(mismatches.index) == 0, mismatches
+
+
+def test_recomputed_scores_match_saved_scores():
+
+    mismatches = check_scores(compute_movie_scores(use_aggregates=False), SCORES_PATH)
+
+    assert len(mismatches.index) == 0, mismatches
+
+
+def test_save_keeps_scores_of_movies_without_sentiment_data(tmp_path):
+
+    scores_path = os.path.join(tmp_path, 'movies_with_scores.csv')
+    shutil.copy(SCORES_PATH, scores_path)
+
+    computed = compute_movie_scores()
+    without_data = computed.loc[computed['n_tweets'].isna(), 'id'].tolist()
+
+    save_scores(computed, scores_path)
+
+    saved = pd.read_csv(SCORES_PATH, sep=';').set_index('id')
+    written = pd.read_csv(scores_path, sep=';').set_index('id')
+
+    assert written.index.tolist() == saved.index.tolist()
+    assert written.loc[without_data, SCORE_COLUMNS].equals(saved.loc[without_data, SCORE_COLUMNS])
+    assert written[SCORE_COLUMNS].notna().all().all()